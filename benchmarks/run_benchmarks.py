@@ -0,0 +1,212 @@
+"""Measure the throughput and memory use of the components of the indexing pipeline
+
+Each component runs on synthetic data (see ``synthetic.py``) in its own process,
+so that the peak memory of one does not hide that of another.
+The schemas are read from a local directory, so no network access is needed.
+
+Example::
+
+    python benchmarks/run_benchmarks.py --records 100000 --overlap 0.3 --nesting 4
+"""
+
+from mdf_matio import _merge_records
+from mdf_matio.adapters.generic import GenericMDFAdapter
+from mdf_matio.adapters.mappable import CSVAdapter
+from mdf_matio.execution import _task_directory
+from mdf_matio.grouping import groupby_directory, groupby_file
+from mdf_matio.output import write_shards
+from mdf_matio.schemas import SchemaStore, get_schema_uri
+from mdf_matio.validator import MDFValidator
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser, Namespace
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Tuple
+import synthetic
+import resource
+import platform
+import json
+import time
+import sys
+import os
+
+_default_schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   '..', 'tests', 'data', 'schemas')
+
+
+def _peak_rss() -> int:
+    """Get the peak resident set size of this process, in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if platform.system() == 'Darwin' else usage * 1024
+
+
+def _parse_results(args: Namespace):
+    return synthetic.make_parse_results(args.records, overlap=args.overlap, depth=args.depth,
+                                        list_size=args.list_size, nesting=args.nesting,
+                                        seed=args.seed)
+
+
+def _schema_store(args: Namespace, cache_dir: str) -> SchemaStore:
+    store = SchemaStore(cache_dir, offline=True)
+    store.preload(args.schema_dir, get_schema_uri(args.schema_branch))
+    return store
+
+
+def _setup_groupby_file(args, cache_dir):
+    results = _parse_results(args)
+    return lambda: sum(1 for _ in groupby_file(results)), len(results)
+
+
+def _setup_groupby_file_ordered(args, cache_dir):
+    # Sorted by directory, as are the results of the task-based execution
+    results = sorted(_parse_results(args), key=lambda x: _task_directory(x.group))
+    return lambda: sum(1 for _ in groupby_file(results, ordered=True)), len(results)
+
+
+def _setup_groupby_directory(args, cache_dir):
+    results = _parse_results(args)
+    return lambda: sum(1 for _ in groupby_directory(results)), len(results)
+
+
+def _setup_merge_records(args, cache_dir):
+    groups = list(groupby_file(_parse_results(args)))
+    return lambda: sum(1 for g in groups if _merge_records(g)), sum(map(len, groups))
+
+
+def _setup_generic_transform(args, cache_dir):
+    adapter = GenericMDFAdapter(schema_branch=args.schema_branch,
+                                schema_store=_schema_store(args, cache_dir),
+                                persist_automap=False)
+    metadata = [x.metadata for x in _parse_results(args) if isinstance(x.metadata, dict)]
+    return lambda: sum(1 for m in metadata if adapter.transform(m)), len(metadata)
+
+
+def _setup_csv_transform(args, cache_dir):
+    metadata, context = synthetic.make_csv(args.csv_rows, seed=args.seed)
+    adapter = CSVAdapter()
+    return lambda: len(adapter.transform(metadata, context)), args.csv_rows
+
+
+def _make_validator(args, cache_dir):
+    vald = MDFValidator(schema_branch=args.schema_branch, backend=args.backend,
+                        schema_store=_schema_store(args, cache_dir))
+    vald_gen = vald.validate_mdf_dataset(synthetic.make_dataset())
+    next(vald_gen)
+    records = synthetic.make_records(args.records, files_per_record=args.files_per_record,
+                                     nesting=args.nesting, seed=args.seed)
+    return vald, vald_gen, records
+
+
+def _setup_validate_record(args, cache_dir):
+    vald, vald_gen, records = _make_validator(args, cache_dir)
+    return lambda: sum(1 for r in records if vald_gen.send(r)), len(records)
+
+
+def _setup_validate_records(args, cache_dir):
+    vald, vald_gen, records = _make_validator(args, cache_dir)
+
+    def run():
+        count = 0
+        for start in range(0, len(records), args.batch_size):
+            count += len(vald.validate_records(records[start:start + args.batch_size]))
+        return count
+    return run, len(records)
+
+
+def _setup_write_shards(args, cache_dir):
+    records = synthetic.make_records(args.records, files_per_record=args.files_per_record,
+                                     nesting=args.nesting, seed=args.seed)
+    output_dir = os.path.join(cache_dir, 'shards')
+    return lambda: write_shards(records, output_dir)['record_count'], len(records)
+
+
+COMPONENTS: Dict[str, Callable[[Namespace, str], Tuple[Callable[[], int], int]]] = {
+    'groupby_file': _setup_groupby_file,
+    'groupby_file_ordered': _setup_groupby_file_ordered,
+    'groupby_directory': _setup_groupby_directory,
+    'merge_records': _setup_merge_records,
+    'generic_transform': _setup_generic_transform,
+    'csv_transform': _setup_csv_transform,
+    'validate_record': _setup_validate_record,
+    'validate_records': _setup_validate_records,
+    'write_shards': _setup_write_shards,
+}
+"""Functions that prepare the data for a component and return a function that runs it,
+along with the number of records the component consumes"""
+
+
+def run_component(name: str, args: Namespace) -> dict:
+    """Run the benchmark of a single component
+
+    Args:
+        name (str): Name of the component
+        args (Namespace): Options of the benchmark
+    Returns:
+        (dict) Results of the benchmark
+    """
+    with TemporaryDirectory() as cache_dir:
+        func, records_in = COMPONENTS[name](args, cache_dir)
+        rss_before = _peak_rss()
+        start = time.perf_counter()
+        records_out = func()
+        elapsed = time.perf_counter() - start
+    return {'component': name, 'records_in': records_in, 'records_out': records_out,
+            'time': elapsed, 'throughput': records_in / elapsed if elapsed > 0 else None,
+            'peak_rss': _peak_rss(), 'rss_growth': _peak_rss() - rss_before}
+
+
+def make_parser() -> ArgumentParser:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--components', nargs='+', choices=sorted(COMPONENTS),
+                        default=list(COMPONENTS), help='Components to benchmark')
+    parser.add_argument('--records', type=int, default=10000,
+                        help='Number of parse results or records')
+    parser.add_argument('--overlap', type=float, default=0.2,
+                        help='Fraction of parse results that share a file with another')
+    parser.add_argument('--depth', type=int, default=3, help='Depth of the directory tree')
+    parser.add_argument('--list-size', type=int, default=0,
+                        help='Number of records in list-type metadata')
+    parser.add_argument('--nesting', type=int, default=2,
+                        help='Depth of nested metadata in parse results and records')
+    parser.add_argument('--files-per-record', type=int, default=2,
+                        help='Number of file entries in each validated record')
+    parser.add_argument('--csv-rows', type=int, default=10000, help='Number of rows in the CSV')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='Number of records validated at once by validate_records')
+    parser.add_argument('--backend', default='jsonschema', help='Validation backend')
+    parser.add_argument('--schema-dir', default=_default_schema_dir,
+                        help='Directory holding a copy of the MDF schemas')
+    parser.add_argument('--schema-branch', default='benchmark',
+                        help='Branch of the data-schemas repository the schemas are from')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run all components in this process. Peak memory is then shared')
+    parser.add_argument('--json', help='Path to which to write the results as JSON')
+    return parser
+
+
+def main(argv=None) -> list:
+    args = make_parser().parse_args(argv)
+
+    results = []
+    print('{:<20} {:>10} {:>10} {:>14} {:>12} {:>12}'.format(
+        'component', 'records', 'time (s)', 'records/s', 'peak (MiB)', 'growth (MiB)'))
+    for name in args.components:
+        if args.in_process:
+            result = run_component(name, args)
+        else:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_component, name, args).result()
+        results.append(result)
+        print('{component:<20} {records_in:>10} {time:>10.3f} {throughput:>14,.0f} '
+              '{:>12.1f} {:>12.1f}'.format(result['peak_rss'] / 2 ** 20,
+                                           result['rss_growth'] / 2 ** 20, **result))
+        sys.stdout.flush()
+
+    if args.json is not None:
+        with open(args.json, 'w') as fp:
+            json.dump({'options': vars(args), 'results': results}, fp, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
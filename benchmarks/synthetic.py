@@ -0,0 +1,184 @@
+"""Synthetic parse results and records for benchmarking the indexing pipeline
+
+The generators are deterministic for a given seed and need no files on disk.
+"""
+
+from materials_io.utils.interface import ParseResult
+from typing import List, Tuple
+import random
+import os
+
+COMPOSITIONS = ['NaCl', 'Al2O3', 'Ca(OH)2', 'CuSO4*5H2O', 'Fe3O4', 'LiFePO4', 'NdFeB', 'SrTiO3',
+                'Ba0.5Sr0.5Co0.8Fe0.2O3', 'AlNi', 'GaAs', 'MoS2']
+"""Compositions used in the synthetic records. Real datasets share few distinct compositions"""
+
+PARSERS = ['crystal_structure', 'dft', 'electron_microscopy', 'image', 'json']
+"""Parser names assigned to the synthetic parse results"""
+
+DATA_TYPES = ['text', 'image', 'binary', 'ASCII text']
+
+
+def make_directory(index: int, depth: int, fanout: int = 8, root: str = '/data') -> str:
+    """Get the path of a directory in a synthetic directory tree
+
+    Directories with consecutive indices are neighbours in the tree, so records generated
+    in index order are in the same order as the tasks of :mod:`mdf_matio.execution`
+
+    Args:
+        index (int): Index of the directory
+        depth (int): Number of levels below the root
+        fanout (int): Number of subdirectories in each directory
+        root (str): Path of the top directory
+    Returns:
+        (str) Path of the directory
+    """
+    parts = []
+    for _ in range(depth):
+        index, digit = divmod(index, fanout)
+        parts.append('d{}'.format(digit))
+    return os.path.join(root, *reversed(parts))
+
+
+def make_nested(rng: random.Random, nesting: int, width: int = 3) -> dict:
+    """Make nested metadata that is not part of the MDF schema
+
+    Args:
+        rng (Random): Random number generator
+        nesting (int): Number of levels of dictionaries
+        width (int): Number of values at each level
+    Returns:
+        (dict) Nested metadata
+    """
+    output = dict(('value_{}'.format(i), rng.random()) for i in range(width))
+    output['series'] = [rng.randint(0, 100) for _ in range(width)]
+    if nesting > 1:
+        output['child'] = make_nested(rng, nesting - 1, width)
+    return output
+
+
+def make_metadata(rng: random.Random, nesting: int = 2) -> dict:
+    """Make the metadata of a parse result, as produced by an adapter
+
+    Args:
+        rng (Random): Random number generator
+        nesting (int): Depth of the nested, non-MDF block of the metadata
+    Returns:
+        (dict) Metadata with MDF blocks, which the validator accepts, and other fields
+    """
+    output = {
+        'material': {'composition': rng.choice(COMPOSITIONS)},
+        'dft': {'converged': rng.random() > 0.1, 'cutoff_energy': rng.choice([400, 520, 600]),
+                'exchange_correlation_functional': rng.choice(['PBE', 'LDA'])},
+        'crystal_structure': {'space_group_number': rng.randint(1, 230),
+                              'number_of_atoms': rng.randint(1, 200)},
+    }
+    if nesting > 0:
+        output['extra'] = make_nested(rng, nesting)
+    return output
+
+
+def make_parse_results(n_records: int, overlap: float = 0.2, depth: int = 3,
+                       list_size: int = 0, list_fraction: float = 0.05, nesting: int = 2,
+                       files_per_directory: int = 16, seed: int = 0) -> List[ParseResult]:
+    """Make the parse results of a synthetic dataset
+
+    Args:
+        n_records (int): Number of parse results
+        overlap (float): Fraction of parse results that share a file with an earlier result
+            in the same or a nearby directory
+        depth (int): Depth of the directory tree
+        list_size (int): Number of records in list-type metadata, such as from a CSV file.
+            If 0, all metadata are dictionaries
+        list_fraction (float): Fraction of parse results with list-type metadata
+        nesting (int): Depth of the nested blocks in the metadata
+        files_per_directory (int): Number of parse results in each directory
+        seed (int): Random seed
+    Returns:
+        ([ParseResult]) Parse results, in directory order
+    """
+    rng = random.Random(seed)
+    results = []
+    shareable = []  # Files that can appear in more than one group
+    for i in range(n_records):
+        directory = make_directory(i // files_per_directory, depth)
+        group = [os.path.join(directory, 'file{}.dat'.format(i))]
+        parser = rng.choice(PARSERS)
+
+        # Only dictionary-type metadata can be merged with other records
+        if list_size > 0 and rng.random() < list_fraction:
+            metadata = [make_metadata(rng, nesting) for _ in range(list_size)]
+        else:
+            if len(shareable) > 0 and rng.random() < overlap:
+                group.append(rng.choice(shareable[-files_per_directory * 2:]))
+            metadata = make_metadata(rng, nesting)
+            shareable.append(group[0])
+        results.append(ParseResult(group, parser, metadata))
+    return results
+
+
+def make_records(n_records: int, files_per_record: int = 2, nesting: int = 0,
+                 seed: int = 0) -> List[dict]:
+    """Make records as they are sent to the validator
+
+    Args:
+        n_records (int): Number of records
+        files_per_record (int): Number of entries in the files block of each record
+        nesting (int): Depth of the nested metadata in the custom block of each record,
+            which the validator converts to a string as it does any custom value
+        seed (int): Random seed
+    Returns:
+        ([dict]) Records
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(n_records):
+        record = make_metadata(rng, nesting=0)
+        record['files'] = [{'filename': 'file{}-{}.dat'.format(i, j),
+                            'path': '/data/file{}-{}.dat'.format(i, j),
+                            'length': rng.randint(1, 1 << 20),
+                            'data_type': rng.choice(DATA_TYPES),
+                            'mime_type': None}
+                           for j in range(files_per_record)]
+        record['custom'] = {'index': i, 'label': 'sample-{}'.format(i % 100)}
+        if nesting > 0:
+            record['custom']['extra'] = make_nested(rng, nesting)
+        records.append(record)
+    return records
+
+
+def make_dataset() -> dict:
+    """Make the metadata of a dataset that contains synthetic records
+
+    Returns:
+        (dict) Dataset metadata
+    """
+    return {
+        'mdf': {'source_id': 'benchmark_v1', 'source_name': 'benchmark'},
+        'dc': {'titles': [{'title': 'Synthetic benchmark dataset'}],
+               'creators': [{'creatorName': 'Benchmark, Synthetic'}],
+               'publisher': 'Materials Data Facility', 'publicationYear': '2020',
+               'resourceType': {'resourceTypeGeneral': 'Dataset', 'resourceType': 'Dataset'}}
+    }
+
+
+def make_csv(n_rows: int, n_columns: int = 8, seed: int = 0) -> Tuple[dict, dict]:
+    """Make the metadata of a CSV file and a mapping for the CSV adapter
+
+    Args:
+        n_rows (int): Number of rows
+        n_columns (int): Number of columns that are mapped to MDF fields.
+            One unmapped column is always added
+        seed (int): Random seed
+    Returns:
+        - (dict) Metadata, as produced by the CSV parser
+        - (dict) Context for the CSV adapter
+    """
+    rng = random.Random(seed)
+    fields = ['material.composition', 'dft.cutoff_energy', 'dft.converged',
+              'crystal_structure.space_group_number', 'crystal_structure.number_of_atoms',
+              'crystal_structure.volume', 'dft.exchange_correlation_functional']
+    fields += ['custom.column_{}'.format(i) for i in range(max(0, n_columns - len(fields)))]
+    fields = fields[:n_columns]
+    columns = ['col{}'.format(i) for i in range(len(fields))]
+    records = [dict((c, rng.random()) for c in columns + ['unmapped']) for _ in range(n_rows)]
+    return {'records': records}, {'mapping': dict(zip(fields, columns))}
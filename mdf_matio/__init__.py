@@ -3,21 +3,26 @@
 from mdf_matio.version import __version__  # noqa: F401
 from materials_io.utils.interface import (get_available_adapters, ParseResult,
                                           get_available_parsers, run_all_parsers)
-from mdf_matio.grouping import groupby_file, groupby_directory
+from mdf_matio.adapters.generic import get_automap
+from mdf_matio.cache import ParseCache
+from mdf_matio.checkpoint import IndexCheckpoint, make_run_key
+from mdf_matio.execution import identify_tasks, run_tasks
+from mdf_matio.grouping import DirectoryIndex, groupby_file, _get_directory, _split_path
+from mdf_matio.incremental import run_incremental
+from mdf_matio.instrumentation import IndexingStats, measure, track_stage
+from mdf_matio.isolation import Isolation
+from mdf_matio.merging import BroadcastRecords, broadcast_metadata, merge_metadata
+from mdf_matio.scheduling import Schedule
+from mdf_matio.schemas import get_schema_uri
+from mdf_matio.spill import RecordBuffer
 from mdf_matio.validator import MDFValidator
-from mdf_toolbox import dict_merge
-from typing import Iterable, Set, List
-from functools import reduce, partial
+from typing import Iterable, Iterator, Set, List, Optional
+from functools import partial
 import logging
-import os
 
 logger = logging.getLogger(__name__)
 
 
-_merge_func = partial(dict_merge, append_lists=True)
-"""Function used to merge records"""
-
-
 def get_mdf_parsers() -> Set[str]:
     """Get the list of parsers defined for the MDF
 
@@ -36,71 +41,132 @@ def _merge_records(group: List[ParseResult]):
     """
 
     # Group the file list and parsers
-    group_files = list(set(sum([tuple(x.group) for x in group], ())))
-    group_parsers = '-'.join(sorted(set(sum([[x.parser] for x in group], []))))
+    group_files = list(dict.fromkeys(f for x in group for f in x.group))
+    group_parsers = '-'.join(sorted(set(x.parser for x in group)))
 
-    # Merge the metadata
-    is_list = [isinstance(x.metadata, list) for x in group]
+    # Merge the metadata. Metadata that are not dictionaries are lists of records
+    is_list = [not isinstance(x.metadata, dict) for x in group]
     if sum(is_list) > 1:
         raise NotImplementedError('We have not defined how to merge >1 list-type data')
+    elif len(group) == 1:
+        group_metadata = group[0].metadata
     elif sum(is_list) == 1:
         list_data = group[is_list.index(True)].metadata
-        if len(is_list) > 1:
-            other_metadata = reduce(_merge_func,
-                                    [x.metadata for x, t in zip(group, is_list) if not t])
-            group_metadata = [_merge_func(x, other_metadata) for x in list_data]
+        other_metadata = [x.metadata for x, t in zip(group, is_list) if not t]
+        if len(other_metadata) > 1:
+            other_metadata = [merge_metadata(other_metadata)]
+        if isinstance(list_data, list):
+            group_metadata = broadcast_metadata(list_data, other_metadata[0])
         else:
-            group_metadata = list_data
+            group_metadata = BroadcastRecords(list_data, other_metadata[0])
     else:
-        group_metadata = reduce(_merge_func, [x.metadata for x in group])
+        group_metadata = merge_metadata(x.metadata for x in group)
     return ParseResult(group_files, group_parsers, group_metadata)
 
 
-def _merge_files(parse_results: Iterable[ParseResult]) -> Iterable[ParseResult]:
+def _merge_files(parse_results: Iterable[ParseResult], spill_threshold: Optional[int] = None,
+                 stats: Optional[IndexingStats] = None, ordered: bool = False,
+                 held: Optional[dict] = None) -> Iterable[ParseResult]:
     """Merge metadata of records associated with the same file(s)
 
     Args:
         parse_results (ParseResult): Generator of ParseResults
+        spill_threshold (int): Number of records to hold in memory before grouping on disk
+        stats (IndexingStats): Statistics for the grouping and merging stages
+        ordered (bool): Whether the parse results are sorted by directory.
+            If so, each group of records is merged as soon as it is complete
+        held (dict): Directories of records held by :func:`_merge_directories`
     Yields:
         (ParseResult): ParserResults merged for each file.
     """
-    return map(_merge_records, groupby_file(parse_results))
+    groups = track_stage(stats, 'groupby_file', parse_results,
+                         partial(groupby_file, spill_threshold=spill_threshold, ordered=ordered,
+                                 held=held), size=len)
+    return track_stage(stats, 'merge_records', groups, partial(map, _merge_records))
 
 
-def _merge_directories(parse_results: Iterable[ParseResult], dirs_to_group: List[str])\
-        -> Iterable[ParseResult]:
+def _merge_directories(parse_results: Iterable[ParseResult], dirs_to_group: List[str],
+                       spill_threshold: Optional[int] = None,
+                       stats: Optional[IndexingStats] = None,
+                       ordered: bool = False,
+                       held: Optional[dict] = None) -> Iterable[ParseResult]:
     """Merge records from user-specified directories
 
+    Records with files in one of the grouped directories, or any of their subdirectories,
+    are merged with the other such records from the same directory, which is the
+    common directory of their files (see :func:`~.grouping.groupby_directory`).
+
     Args:
         parse_results (ParseResult): Generator of ParseResults
+        dirs_to_group ([str]): Directories whose records are grouped together
+        spill_threshold (int): Number of records to hold in memory before grouping on disk
+        stats (IndexingStats): Statistics for the directory grouping stage
+        ordered (bool): Whether the parse results are sorted by directory,
+            as are the results of :func:`~mdf_matio.execution.run_tasks`.
+            If so, the held records of each directory are merged as soon as
+            the results move past that directory, rather than after all results.
+            The records are merged into the same groups either way
+        held (dict): Filled, if ordered, with the directory of each group of records being held.
+            Later steps must not treat the groups of files in or after those directories
+            as complete (see :func:`~.grouping.groupby_file`)
     Yields:
         (ParseResult): ParserResults merged for each record
     """
-
-    # Add a path separator to the end of each directory
-    #  Used to simplify checking whether each file is a subdirectory of the matched groups
-    dirs_to_group = [d + os.path.sep for d in dirs_to_group]
-
-    def is_in_directory(f):
-        """Check whether a file is in one fo the directories to group"""
-        f = os.path.dirname(f) + os.path.sep
-        return any(f.startswith(d) for d in dirs_to_group)
-
-    # Gather records that are in directories to group or any of their subdirectories
-    flagged_records = []
-    for record in parse_results:
-        if any(is_in_directory(f) for f in record.group):
-            flagged_records.append(record)
-        else:
-            yield record
-
-    # Once all of the parse results are through, group by directory
-    for group in groupby_directory(flagged_records):
-        yield _merge_records(group)
+    index = DirectoryIndex(dirs_to_group)
+    pending = {}  # Held records, keyed by the path components of their directory if ordered
+
+    def flush(key):
+        with pending.pop(key) as buffer:
+            # Records are stored with their directory, so they are grouped without another copy
+            if stats is not None:
+                stats.get_stage('groupby_directory').records_in += len(buffer)
+            groups = track_stage(stats, 'groupby_directory', buffer.groups(), size=len)
+            yield from map(_merge_records, groups)
+        if held is not None:
+            held.pop(key, None)
+
+    try:
+        for record in parse_results:
+            # Records are merged by the directory used by `groupby_directory`, which is
+            #  also the order of the results. Merge any directory the results have moved past
+            directory = _get_directory(record)
+            key = _split_path(directory) if ordered else ()
+            if ordered and len(pending) > 0:
+                for my_key in sorted(x for x in pending if key > x):
+                    yield from flush(my_key)
+
+            # Hold records in the grouped directories
+            if index.find_record_owner(record) is None:
+                yield record
+                continue
+            buffer = pending.get(key)
+            if buffer is None:
+                buffer = pending[key] = RecordBuffer(spill_threshold)
+                if ordered and held is not None:
+                    held[key] = key
+            buffer.append(record, directory)
+
+        # Once all of the parse results are through, merge the remaining directories
+        for key in sorted(pending):
+            yield from flush(key)
+    finally:
+        for buffer in pending.values():
+            buffer.close()
 
 
 def generate_search_index(data_url: str, validate_records=True, parse_config=None,
-                          exclude_parsers=None, index_options=None) -> Iterable[dict]:
+                          exclude_parsers=None, index_options=None,
+                          spill_threshold: Optional[int] = None,
+                          workers: Optional[int] = None,
+                          manifest_path: Optional[str] = None,
+                          use_hash: bool = False,
+                          validation_batch_size: int = 256,
+                          stats: Optional[IndexingStats] = None,
+                          checkpoint_path: Optional[str] = None,
+                          checkpoint_interval: float = 300,
+                          cache: Optional[ParseCache] = None,
+                          schedule: Optional[Schedule] = None,
+                          isolation: Optional[Isolation] = None) -> Iterable[dict]:
     """Generate a search index from a directory of data
 
     Args:
@@ -113,6 +179,46 @@ def generate_search_index(data_url: str, validate_records=True, parse_config=Non
                         directory as single records
         exclude_parsers ([str]): Names of parsers to exclude
         index_options (dict): Indexing options used by MDF Connect
+        spill_threshold (int): Number of records the grouping steps hold in memory before
+            moving them to a temporary database on disk.
+            Default is :data:`~mdf_matio.spill.DEFAULT_SPILL_THRESHOLD`
+        workers (int): Number of processes used to run parsers and adapters.
+            If provided, the groups of files to parse are identified first and then
+            executed as independent tasks (see :mod:`mdf_matio.execution`), and the records
+            are produced in the same order for any number of workers.
+            As the tasks run in directory order, each record is produced as soon as the
+            tasks for its directories finish, rather than after the whole dataset is parsed.
+            Default is to run all parsers in this process with MaterialsIO's ``run_all_parsers``
+        manifest_path (str): Path to a manifest of the results from earlier runs on this dataset.
+            If provided, only files that are new or changed since the last run are parsed
+            (see :mod:`mdf_matio.incremental`) and the manifest is updated.
+            Runs the parsers as independent tasks, using one worker if ``workers`` is not set
+        use_hash (bool): Whether the manifest stores the hash of each file, so that files whose
+            modification time changed but whose contents did not are not parsed again.
+            Used only with ``manifest_path`` or ``checkpoint_path``
+        validation_batch_size (int): Number of records validated together
+        stats (IndexingStats): Statistics to fill in with the time spent and records processed
+            in each stage (see :mod:`mdf_matio.instrumentation`). Statistics for each parser,
+            which combine the time to parse and adapt, are only recorded when the parsers
+            are run as tasks, as with ``workers``. Default is to not measure
+        checkpoint_path (str): Path to a file in which to save the progress of the run
+            (see :mod:`mdf_matio.checkpoint`). If the file holds the progress of an interrupted
+            run with the same options, the run continues from there and yields only
+            the records not produced before the interruption.
+            Runs the parsers as independent tasks, storing their results in a manifest
+            next to the checkpoint unless ``manifest_path`` is given
+        checkpoint_interval (float): Time between checkpoints, in seconds
+        cache (ParseCache): Cache of parse results keyed by the contents of the files,
+            which may be shared between datasets (see :mod:`mdf_matio.cache`).
+            Runs the parsers as independent tasks, using one worker if ``workers`` is not set
+        schedule (Schedule): Separate pools of workers for each parser, with priorities and
+            limits on how many tasks of a parser run at once (see :mod:`mdf_matio.scheduling`).
+            Runs the parsers as independent tasks, in place of ``workers``
+        isolation (Isolation): Limits on the time and memory used for each group of files.
+            Groups that exceed them are skipped, and recorded in
+            :attr:`~mdf_matio.isolation.Isolation.skipped`
+            (see :mod:`mdf_matio.isolation`).
+            Runs the parsers as independent tasks, using one worker if ``workers`` is not set
     Yields:
         (dict): Metadata records ready for ingestion in MDF search index
     """
@@ -134,17 +240,48 @@ def generate_search_index(data_url: str, validate_records=True, parse_config=Non
     # TODO (wardlt): Figure out how this works with Globus URLs
     index_options['generic'] = {'root_dir': data_url}
 
+    # Load the progress of an interrupted run
+    checkpoint = None
+    if checkpoint_path is not None:
+        run_key = make_run_key(data_url=data_url, validate_records=validate_records,
+                               parse_config=parse_config, parsers=sorted(target_parsers),
+                               index_options=index_options)
+        checkpoint = IndexCheckpoint(checkpoint_path, run_key, checkpoint_interval)
+        if manifest_path is None:
+            manifest_path = checkpoint.manifest_path
+
     # Run the target parsers with their matching adapters on the directory
-    parse_results = run_all_parsers(data_url, include_parsers=list(target_parsers),
-                                    adapter_map='match', parser_context=index_options,
-                                    adapter_context=index_options)
+    ordered = workers is not None or manifest_path is not None or cache is not None or \
+        schedule is not None or isolation is not None
+    if not ordered:
+        parse_results = run_all_parsers(data_url, include_parsers=list(target_parsers),
+                                        adapter_map='match', parser_context=index_options,
+                                        adapter_context=index_options)
+    else:
+        # Build the schema mapping used by the adapters before forking, so workers inherit it
+        get_automap(get_schema_uri())
+        tasks = identify_tasks(data_url, target_parsers, index_options)
+        if manifest_path is None:
+            parse_results = run_tasks(tasks, index_options, workers=workers or 1, stats=stats,
+                                      cache=cache, schedule=schedule, isolation=isolation)
+        else:
+            parse_results = run_incremental(tasks, manifest_path, index_options,
+                                            workers=workers or 1, use_hash=use_hash,
+                                            stats=stats, cache=cache,
+                                            schedule=schedule, isolation=isolation)
+    parse_results = track_stage(stats, 'parse', parse_results)
+
     # Merge by directory in the user-specified directories
     grouped_dirs = []
     for path, cfg in parse_config.items():
         if cfg.get('group_by_directory', False):
             grouped_dirs.append(path)
     logging.info(f'Grouping {len(grouped_dirs)} directories')
-    parse_results = _merge_directories(parse_results, grouped_dirs)
+    held = {}
+    parse_results = track_stage(stats, 'merge_directories', parse_results,
+                                partial(_merge_directories, dirs_to_group=grouped_dirs,
+                                        spill_threshold=spill_threshold, stats=stats,
+                                        ordered=ordered, held=held))
 
     # TODO: Add these variables as arguments or fetch in other way
     dataset_metadata = None   # Provided by MDF directly
@@ -154,21 +291,81 @@ def generate_search_index(data_url: str, validate_records=True, parse_config=Non
     # Validate metadata and tweak into final MDF feedstock format
     # Will fail if any entry fails validation - no invalid entries can be allowed
     vald = MDFValidator(schema_branch=schema_branch)
-    vald_gen = vald.validate_mdf_dataset(dataset_metadata, validation_params)
-    # Yield validated dataset entry
-    yield next(vald_gen)
 
     # Merge records associated with the same file
-    for group in _merge_files(parse_results):
-        # Skip records that include only generic metadata
-        if group.parser == 'generic':
-            continue
+    #  Ordered results are merged as each group completes, so records are produced during parsing
+    groups = _merge_files(parse_results, spill_threshold, stats, ordered, held)
+    yield from _validate_groups(groups, vald, dataset_metadata, validation_params,
+                                validation_batch_size, stats, checkpoint)
+
+    if stats is not None:
+        stats.report()
 
-        # Loop over all produced records
-        metadata = group.metadata if isinstance(group.metadata, list) else [group.metadata]
 
-        # Record validation
-        for record in metadata:
-            yield vald_gen.send(record)
+def _validate_groups(groups: Iterable[ParseResult], vald: MDFValidator,
+                     dataset_metadata: dict, validation_params: Optional[dict] = None,
+                     batch_size: int = 256, stats: Optional[IndexingStats] = None,
+                     checkpoint: Optional[IndexCheckpoint] = None) -> Iterator[dict]:
+    """Validate the records from each group of files, starting with the dataset entry
+
+    Args:
+        groups ([ParseResult]): Merged parse results, in the same order for every run
+        vald (MDFValidator): Validator for the dataset
+        dataset_metadata (dict): Metadata of the dataset
+        validation_params (dict): Additional validation configuration
+        batch_size (int): Number of records validated together
+        stats (IndexingStats): Statistics in which to record the validation time
+        checkpoint (IndexCheckpoint): Checkpoint to save progress to and, if it holds
+            the state of an interrupted run, to resume from
+    Yields:
+        (dict) Dataset entry, unless resuming, and then the validated records
+    """
+    state = None if checkpoint is None else checkpoint.state
+    vald_gen = vald.validate_mdf_dataset(dataset_metadata, validation_params,
+                                         None if state is None else state['validator'])
+    dataset = next(vald_gen)
+    # Yield validated dataset entry
+    if state is None:
+        yield dataset
+        yielded, skip = 1, 0
+    else:
+        yielded, skip = state['yielded'], state['groups']
+
+    def _validate(batch):
+        with measure(stats, 'validation') as stage:
+            records = vald.validate_records(batch)
+            if stage is not None:
+                stage.records_in += len(batch)
+                stage.records_out += len(records)
+        return records
+
+    batch = []
+    for i, group in enumerate(groups):
+        # Skip the groups finished before the run was interrupted
+        if i < skip:
+            continue
+
+        # Skip records that include only generic metadata
+        if group.parser != 'generic':
+            # Loop over all produced records, which may be created as they are iterated over
+            metadata = [group.metadata] if isinstance(group.metadata, dict) else group.metadata
+
+            # Record validation, in batches
+            for record in metadata:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    yield from _validate(batch)
+                    yielded += len(batch)
+                    batch = []
+
+        # Checkpoints are only made between groups, once every record has been consumed
+        if checkpoint is not None and checkpoint.is_due():
+            yield from _validate(batch)
+            yielded += len(batch)
+            batch = []
+            checkpoint.save(i + 1, yielded, vald.get_state())
+    yield from _validate(batch)
 
     vald_gen.send(None)
+    if checkpoint is not None:
+        checkpoint.finish()
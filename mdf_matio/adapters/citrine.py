@@ -1,16 +1,268 @@
 """Adapters that pull metadata from parsers that produce PIF-format data"""
 
 from materials_io.adapters.base import BaseAdapter
-from pypif_sdk.interop.mdf import _to_user_defined as pif_to_feedstock
-from typing import Dict, Tuple, Type
+from pypif_sdk.interop.mdf import _to_user_defined as pif_to_feedstock, _construct_new_key
+from typing import Callable, Dict, Iterable, List, Tuple, Type, Union
 from mdf_toolbox import dict_merge
 from pypif.pif import loado
+from functools import lru_cache
+import json
+
+_make_key = lru_cache(maxsize=4096)(_construct_new_key)
+"""Name of a value in a flattened PIF, made from its name and units"""
+
+_atomic_types = (str, int, float, bool)
+"""Types of the values in a PIF that are not objects"""
+
+
+def _text(value) -> bool:
+    return value is None or type(value) is str
+
+
+def _flag(value) -> bool:
+    return value is None or type(value) is bool
+
+
+def _atom(value) -> bool:
+    return value is None or type(value) in _atomic_types
+
+
+def _tags(value) -> bool:
+    if isinstance(value, list):
+        return all(type(x) in _atomic_types for x in value)
+    return _atom(value)
+
+
+def _names(value) -> bool:
+    if isinstance(value, list):
+        return all(type(x) is str for x in value)
+    return _text(value)
+
+
+def _scalar(value) -> bool:
+    if type(value) in _atomic_types:
+        return True
+    return isinstance(value, dict) and _check_fields(value, _scalar_fields)
+
+
+def _scalars(value) -> bool:
+    return isinstance(value, list) and all(map(_scalar, value))
+
+
+def _vectors(value) -> bool:
+    return isinstance(value, list) and all(map(_scalars, value))
+
+
+def _optional(check: Callable[[object], bool]) -> Callable[[object], bool]:
+    """Make a check that also accepts None"""
+    return lambda value: value is None or check(value)
+
+
+def _objects(fields: dict) -> Callable[[object], bool]:
+    """Make a check for a list of PIF objects with certain fields"""
+    def check(value):
+        return value is None or (isinstance(value, list) and all(
+            isinstance(x, dict) and _check_fields(x, fields) for x in value))
+    return check
+
+
+def _check_fields(obj: dict, fields: dict) -> bool:
+    """Check whether every field of a PIF object is one the fast path handles"""
+    for key, value in obj.items():
+        check = fields.get(key)
+        if check is None or not check(value):
+            return False
+    return True
+
+
+_scalar_fields = {'value': _atom, 'minimum': _atom, 'maximum': _atom, 'uncertainty': _atom,
+                  'inclusiveMinimum': _flag, 'inclusiveMaximum': _flag, 'approximate': _flag,
+                  'tags': _tags}
+_value_fields = {'name': _text, 'units': _text, 'scalars': _optional(_scalars),
+                 'vectors': _optional(_vectors),
+                 'matrices': _optional(lambda x: isinstance(x, list) and all(map(_vectors, x))),
+                 'tags': _tags}
+_software_fields = {'name': _text, 'version': _text, 'producer': _text, 'url': _text,
+                    'tags': _tags}
+_method_fields = {'name': _text, 'software': _objects(_software_fields), 'tags': _tags}
+_property_fields = dict(_value_fields, conditions=_objects(_value_fields),
+                        methods=_objects(_method_fields), dataType=_text)
+_system_fields = {'category': _text, 'uid': _text, 'names': _names, 'tags': _tags,
+                  'properties': _objects(_property_fields)}
+_chemical_fields = dict(_system_fields, chemicalFormula=_text,
+                        composition=_optional(lambda x: x == []))
+"""Fields of each type of PIF object handled by the fast path, and checks on their values.
+Composition is only handled if it is empty"""
+
+_system_categories = {'system': _system_fields, 'system.chemical': _chemical_fields,
+                      'system.chemical.alloy.phase': _chemical_fields}
+"""Categories of PIF that are read into System or ChemicalSystem objects"""
+
+_inlines = {
+    'system': (('properties', 'property'),),
+    'property': (('conditions', 'value'), ('methods', 'method')),
+    'method': (('software', 'software'),),
+}
+"""Fields that hold PIF objects indexed by name, in the order of the attributes of each class"""
+
+
+def _prune(value):
+    """Remove the fields set to None, which are not serialized by pypif"""
+    if isinstance(value, dict):
+        return dict((k, _prune(v)) for k, v in value.items() if v is not None)
+    elif isinstance(value, list):
+        return [_prune(v) for v in value]
+    return value
+
+
+class _PIFView:
+    """PIF object indexed while flattening a PIF, equivalent to a pypif_sdk ``ReadView``"""
+
+    __slots__ = ('raw', 'kind', '_serialized')
+
+    def __init__(self, raw: dict, kind: str):
+        self.raw = raw
+        self.kind = kind
+        self._serialized = None
+
+    def serialized(self) -> str:
+        if self._serialized is None:
+            self._serialized = json.dumps(_prune(self.raw), sort_keys=True)
+        return self._serialized
+
+    def __eq__(self, other):
+        return self.serialized() == other.serialized()
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def _add_key(key, value, ambig: set, unambig: dict):
+    """Add an object to the index, unless another object with the same name differs from it"""
+    if key in ambig:
+        return
+    if key in unambig and value != unambig[key]:
+        ambig.add(key)
+        del unambig[key]
+        return
+    unambig[key] = value
+
+
+def _index_objects(obj: dict, kind: str) -> Tuple[set, dict]:
+    """Index the objects within a PIF object by name, as in ``ReadView``
+
+    Returns:
+        - (set) Names of more than one different object
+        - (dict) Objects with a unique name
+    """
+    ambig = set()
+    unambig = {}
+    for field, child_kind in _inlines.get(kind, ()):
+        for child in obj.get(field) or ():
+            key = child.get('name')
+            if not key:
+                continue
+            _add_key(key, _PIFView(child, child_kind), ambig, unambig)
+            child_ambig, child_unambig = _index_objects(child, child_kind)
+            for k in child_ambig:
+                ambig.add(k)
+                unambig.pop(k, None)
+            for k, v in child_unambig.items():
+                _add_key(k, v, ambig, unambig)
+    return ambig, unambig
+
+
+def _scalar_value(scalar):
+    return scalar.get('value') if isinstance(scalar, dict) else scalar
+
+
+@lru_cache(maxsize=1024)
+def _parse_formula(formula: str) -> Tuple[Tuple[str, Union[int, float]], ...]:
+    """Get the amount of each element in a chemical formula, as in ``pif_to_feedstock``"""
+    elements = {}
+    symbol = ""
+    num = ""
+    for char in formula:
+        if char.isupper():
+            if symbol:
+                try:
+                    elements[symbol] = int(num)
+                except ValueError:
+                    elements[symbol] = float(num) if num else 1
+                symbol = ""
+                num = ""
+            symbol += char
+        elif char.islower():
+            symbol += char
+        elif char.isdigit() or char == ".":
+            num += char
+    return tuple(elements.items())
+
+
+def _flatten_simple(pif: dict, make_key: Callable = _make_key) -> Union[None, dict]:
+    """Flatten a PIF without making pypif objects
+
+    Args:
+        pif (dict): PIF, as a dictionary
+        make_key (callable): Function that makes the name of a value from its name and units
+    Returns:
+        (dict) Flattened PIF, or None if the PIF contains fields this function does not handle
+    """
+    fields = _system_categories.get(pif.get('category'))
+    if fields is None or not _check_fields(pif, fields):
+        return None
+
+    # Get the value of each uniquely-named Property or Value
+    output = {}
+    for view in _index_objects(pif, 'system')[1].values():
+        if view.kind not in ('property', 'value'):
+            continue
+        obj = view.raw
+        name = make_key(obj['name'], obj.get('units'))
+        value = []
+        if obj.get('scalars'):
+            value = [_scalar_value(x) for x in obj['scalars']]
+        elif obj.get('vectors') and len(obj['vectors']) == 1:
+            value = [_scalar_value(x) for x in obj['vectors'][0]]
+        if len(value) == 1:
+            value = value[0]
+        elif len(value) == 0:
+            value = None
+        if name and value is not None:
+            output[name] = value
+
+    if pif.get('chemicalFormula'):
+        elements = dict(_parse_formula(pif['chemicalFormula']))
+        if elements:
+            output['elemental_proportion'] = elements
+    return output
+
+
+def flatten_pif(pif: dict, make_key: Callable = _make_key) -> dict:
+    """Flatten a PIF into a dictionary of named values
+
+    Produces the same output as ``pif_to_feedstock(loado(pif))``. PIFs holding only
+    the fields commonly written by parsers (properties, conditions, methods, software
+    and a chemical formula) are read directly from the dictionary, which is much faster
+    than making pypif objects. Other PIFs are read through pypif.
+
+    Args:
+        pif (dict): PIF, as a dictionary
+        make_key (callable): Function that makes the name of a value from its name and units
+    Returns:
+        (dict) Values from the PIF, keyed by their name and units
+    """
+    output = _flatten_simple(pif, make_key) if isinstance(pif, dict) else None
+    if output is None:
+        output = pif_to_feedstock(loado(pif))
+    return output
 
 
 class CitrineAdapter(BaseAdapter):
     """Base class for Citrine adapters
 
-    Requires users to define the translation table"""
+    Requires users to define the translation table. The table is compiled
+    the first time each class uses it"""
 
     def get_translations(self) -> Dict[str, Dict[str, Tuple[str, Type]]]:
         """The translation table from PIF field to MDF field
@@ -29,23 +281,63 @@ class CitrineAdapter(BaseAdapter):
             'material': {'elemental_proportion': ('elemental_proportions', dict)},
         }
 
-    def transform(self, pif: dict, context=None) -> dict:
-        # Flatten the pif into smaller records
-        pif = pif_to_feedstock(loado(pif))
+    def get_compiled_translations(self) -> Tuple[Tuple[str, Tuple[Tuple[str, str, Type], ...]],
+                                                 ...]:
+        """The translation table as flat tuples, made once for each class
+
+        Returns:
+            (tuple): Pairs of the MDF block and a tuple of the PIF field, MDF field
+                and translation function for each field in that block
+        """
+        cls = type(self)
+        compiled = cls.__dict__.get('_compiled_translations')
+        if compiled is None:
+            compiled = tuple(
+                (block, tuple((pif_field, info[0], info[1]) for pif_field, info in mapping.items()))
+                for block, mapping in self.get_translations().items()
+            )
+            cls._compiled_translations = compiled
+        return compiled
+
+    @staticmethod
+    def _map_record(pif: dict, translations) -> dict:
+        """Map the values of a flattened PIF to the blocks of an MDF record
 
-        # Map the records to an MDF field
+        Args:
+            pif (dict): Flattened PIF
+            translations (tuple): Compiled translation table
+        Returns:
+            (dict) MDF record
+        """
         record = {}
-        for block, mapping in self.get_translations().items():
+        for block, fields in translations:
             new_block = {}
-            for pif_field, mdf_field_info in mapping.items():
-                mdf_field = mdf_field_info[0]
-                translator = mdf_field_info[1]
+            for pif_field, mdf_field, translator in fields:
                 if pif_field in pif:
                     new_block[mdf_field] = translator(pif[pif_field])
             if new_block:
                 record[block] = new_block
         return record
 
+    def transform(self, pif: dict, context=None) -> dict:
+        return self._map_record(flatten_pif(pif), self.get_compiled_translations())
+
+    def transform_many(self, pifs: Iterable[dict], context=None) -> List[dict]:
+        """Transform many PIFs, such as the calculations of a DFT dataset
+
+        The translation table is retrieved once for the batch, and the name of each
+        value is made once for each name and units in the batch
+
+        Args:
+            pifs ([dict]): PIFs to transform
+            context (dict): Context for the adapter
+        Returns:
+            ([dict]) Record for each PIF, the same as from :meth:`transform`
+        """
+        translations = self.get_compiled_translations()
+        make_key = lru_cache(maxsize=None)(_construct_new_key)
+        return [self._map_record(flatten_pif(pif, make_key), translations) for pif in pifs]
+
 
 class PIFDFTAdapter(CitrineAdapter):
     """Adapter for the PIF DFT parser"""
@@ -64,16 +356,40 @@ class PIFDFTAdapter(CitrineAdapter):
             },
         })
 
+    @staticmethod
+    def _get_software(pif: dict) -> dict:
+        """Get the description of the software used in a calculation"""
+        return pif['properties'][0]['methods'][0]['software'][0]
+
+    @staticmethod
+    def _make_origin(software: dict) -> dict:
+        """Make the origin block of a record from the description of its software"""
+        origin = {'type': 'computation', 'name': software['name']}
+        if 'version' in software:
+            origin['version'] = software['version']
+        return origin
+
     def transform(self, pif: dict, context=None) -> dict:
         output = super().transform(pif)
 
         # Add in the method types
-        software = pif['properties'][0]['methods'][0]['software'][0]
-        output['origin'] = {'type': 'computation', 'name': software['name']}
-        if 'version' in software:
-            output['origin']['version'] = software['version']
-
+        output['origin'] = self._make_origin(self._get_software(pif))
         return output
 
+    def transform_many(self, pifs: Iterable[dict], context=None) -> List[dict]:
+        pifs = list(pifs)
+        records = super().transform_many(pifs, context)
+
+        # Make the origin once for each software, as most calculations share the same one
+        origins = {}
+        for pif, record in zip(pifs, records):
+            software = self._get_software(pif)
+            key = (software['name'], 'version' in software, software.get('version'))
+            origin = origins.get(key)
+            if origin is None:
+                origin = origins[key] = self._make_origin(software)
+            record['origin'] = dict(origin)
+        return records
+
     def version(self):
         return '0.0.1'
@@ -1,9 +1,116 @@
-import os
+from threading import Lock
+from urllib.parse import urldefrag, urljoin
+from weakref import WeakKeyDictionary
+import hashlib
+import json
+import time
 
-import jsonschema
 import mdf_toolbox
 
 from materials_io.adapters.base import BaseAdapter
+from mdf_matio.schemas import get_default_store, get_schema_uri
+
+
+_automaps = WeakKeyDictionary()
+"""Automaps built in this process and when they were built, keyed by schema store and then
+by schema URI"""
+_automap_lock = Lock()
+
+
+def _find_refs(schema):
+    """Find the values of every "$ref" in a schema
+
+    Arguments:
+        schema: Part of a schema
+
+    Yields:
+        str: Each reference
+    """
+    if isinstance(schema, dict):
+        for key, value in schema.items():
+            if key == "$ref" and isinstance(value, str):
+                yield value
+            else:
+                yield from _find_refs(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            yield from _find_refs(value)
+
+
+def _get_schema_documents(resolver, schema_name):
+    """Get a schema and every schema it references, directly or through other schemas
+
+    Arguments:
+        resolver (RefResolver): Resolver for the directory holding the schemas
+        schema_name (str): The name of the schema file (e.g., "record.json")
+
+    Returns:
+        dict: Each schema document, keyed by its URI
+    """
+    documents = {}
+    pending = [urljoin(resolver.resolution_scope, schema_name)]
+    while pending:
+        uri = pending.pop()
+        if uri in documents:
+            continue
+        documents[uri] = document = resolver.resolve_from_url(uri)
+        for ref in _find_refs(document):
+            pending.append(urldefrag(urljoin(uri, ref))[0])
+    return documents
+
+
+def get_automap(schema_uri, schema_store=None, persist=True):
+    """Get the self-mapping of all fields in the MDF record schema (mdf.field:mdf.field).
+
+    The automap is built once per process for each schema and store and shared by all adapters,
+    so that worker processes forked after it is built inherit it without copying.
+    Automaps of schemas that may change, such as those of a branch, are built again
+    once older than the ``max_age`` of the store.
+    Saved automaps are identified by the record schema and every schema it references,
+    so they are rebuilt if any of those schemas change.
+
+    Arguments:
+        schema_uri (str): The URI of the directory holding the MDF schemas.
+        schema_store (SchemaStore): The store used to retrieve the MDF schemas.
+                Default None, to use the store shared by the whole process.
+        persist (bool): Whether to save the automap in the schema store, so that
+                other processes can load it rather than rebuild it. Default True.
+
+    Returns:
+        dict: The automap. Must not be modified.
+    """
+    schema_store = schema_store or get_default_store()
+
+    with _automap_lock:
+        # Re-use the automap already built for this store
+        built = _automaps.setdefault(schema_store, {})
+        automap, built_time = built.get(schema_uri, (None, None))
+        if automap is not None and schema_store.is_fresh(schema_uri, built_time):
+            return automap
+
+        # Fetch record schema and the schemas it references with resolver
+        resolver = schema_store.get_resolver(schema_uri)
+        documents = _get_schema_documents(resolver, "record.json")
+        key = hashlib.sha256((schema_uri + json.dumps(sorted(documents.items()), sort_keys=True))
+                             .encode()).hexdigest()
+        automap = schema_store.load_artifact("automap", key) if persist else None
+
+        if automap is None:
+            # Expand JSONSchema (can provider premade resolver)
+            base_schema = resolver.resolve("record.json")[1]
+            full_schema = mdf_toolbox.expand_jsonschema(base_schema, resolver=resolver)
+
+            # Turn full MDF schema into self-mapping/automap (mdf.field:mdf.field)
+            # Condense into mdf_field: type, then replace type value with field name
+            automap = {}
+            for field in mdf_toolbox.condense_jsonschema(full_schema, include_containers=False,
+                                                         list_items=False).keys():
+                automap[field] = field
+            if persist:
+                schema_store.save_artifact("automap", key, automap)
+
+        built[schema_uri] = (automap, time.time())
+        return automap
 
 
 class GenericMDFAdapter(BaseAdapter):
@@ -24,7 +131,8 @@ class GenericMDFAdapter(BaseAdapter):
     to gain forwards-compatibility.
     """
 
-    def __init__(self, schema_branch="master", schema_uri=None):
+    def __init__(self, schema_branch="master", schema_uri=None, schema_store=None,
+                 persist_automap=True):
         """Create a GenericMDFAdapter object, using a specified MDF schema.
 
         Arguments:
@@ -32,36 +140,17 @@ class GenericMDFAdapter(BaseAdapter):
                     download and validate against. Default "master".
             schema_uri (str): The uri to the MDF schema location. Local and nonlocal locations
                     are supported. Default None, to use the Github branch instead.
+            schema_store (SchemaStore): The store used to retrieve the MDF schemas.
+                    Default None, to use the store shared by the whole process.
+            persist_automap (bool): Whether to save the field mapping derived from the schema
+                    in the schema store, for reuse by other processes. Default True.
 
         Note:
             schema_uri supercedes schema_branch - if schema_uri is specified,
             schema_branch is ignored.
         """
-        if schema_uri:
-            schema_branch = None
-
-        # Generate URI from Github if branch supplied
-        if schema_branch:
-            schema_uri = ("https://raw.githubusercontent.com/materials-data-facility/"
-                          "data-schemas/{}/schemas/".format(schema_branch))
-        # If URI is bare file path, make into URI
-        elif os.path.exists(schema_uri):
-            schema_uri = "{}{}{}".format(
-                                    "file://" if not schema_uri.startswith("file://") else "",
-                                    os.path.abspath(schema_uri),
-                                    "/" if schema_uri.endswith("/") else "")
-        # Fetch record schema with resolver
-        resolver = jsonschema.RefResolver(schema_uri, None)
-        base_schema = resolver.resolve("record.json")[1]
-        # Expand JSONSchema (can provider premade resolver)
-        full_schema = mdf_toolbox.expand_jsonschema(base_schema, resolver=resolver)
-
-        # Turn full MDF schema into self-mapping/automap (mdf.field:mdf.field)
-        # Condense into mdf_field: type, then replace type value with field name
-        self.automap = {}
-        for field in mdf_toolbox.condense_jsonschema(full_schema, include_containers=False,
-                                                     list_items=False).keys():
-            self.automap[field] = field
+        schema_uri = get_schema_uri(schema_branch, schema_uri)
+        self.automap = get_automap(schema_uri, schema_store, persist=persist_automap)
 
     def transform(self, metadata, context=None):
         """Transform the metadata by filtering non-MDF fields away.
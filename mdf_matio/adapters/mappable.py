@@ -1,23 +1,200 @@
 """Adapters for structured files"""
 from materials_io.adapters.base import BaseAdapter
-from typing import List, Tuple, Union
+from typing import Dict, Iterator, List, Tuple, Union
+from numbers import Integral, Number
+from itertools import islice
+from threading import Lock
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def _add_value(record, key: Tuple[str], value):
-    """Adds value to MDF record
+_missing = object()
+"""Marker for a column that is not present in a row"""
+
+_native_types = {int, float}
+"""Numeric types that need no conversion"""
+
+
+class RecordBuilder:
+    """Mapping from the columns of a table to MDF fields, compiled for repeated use
+
+    The fields are held as a tree of the nested blocks of a record,
+    so each row is converted to a record without parsing the mapping again.
+    """
+
+    def __init__(self, mapping: Dict[str, str]):
+        """
+        Args:
+            mapping (dict): Map of the MDF field (with '.'s separating keys at different levels)
+                to the name of the column
+        """
+        # Each column maps to a single field, the last one listed in the mapping
+        col_to_mdf = dict((y, tuple(x.split('.'))) for x, y in mapping.items())
+        self.fields: List[Tuple[str, Tuple[str, ...]]] = list(col_to_mdf.items())
+        """Columns and the field each is stored in"""
+
+        # Build the tree of blocks, whose leaves are column names
+        tree = {}
+        for col, key in self.fields:
+            node = tree
+            for part in key[:-1]:
+                node = node.setdefault(part, {})
+                if not isinstance(node, dict):
+                    raise ValueError('Field {} is inside of another mapped field'
+                                     .format('.'.join(key)))
+            if key[-1] in node:
+                raise ValueError('Field {} contains another mapped field'.format('.'.join(key)))
+            node[key[-1]] = col
+        self._block = self._compile(tree)
+
+    @classmethod
+    def _compile(cls, tree: dict) -> tuple:
+        """Convert a tree of blocks into pairs of the fields and sub-blocks of each block"""
+        leaves = tuple((k, v) for k, v in tree.items() if not isinstance(v, dict))
+        children = tuple((k, cls._compile(v)) for k, v in tree.items() if isinstance(v, dict))
+        return leaves, children
+
+    @property
+    def columns(self) -> List[str]:
+        """Names of the mapped columns"""
+        return [x[0] for x in self.fields]
+
+    def build(self, row: dict) -> dict:
+        """Make a record from one row of a table
+
+        Args:
+            row (dict): Values of each column
+        Returns:
+            (dict) Record holding the mapped columns present in the row.
+                Empty if no mapped column is present
+        """
+        return self._build(self._block, row)
+
+    def _build(self, block: tuple, row: dict) -> dict:
+        leaves, children = block
+        output = {key: row[col] for key, col in leaves if col in row}
+        for key, child in children:
+            value = self._build(child, row)
+            if len(value) > 0:
+                output[key] = value
+        return output
+
+    def build_columns(self, columns: Dict[str, list], n_rows: int) -> List[dict]:
+        """Make records from a table stored as columns
+
+        Args:
+            columns (dict): Values of each column. Missing values are marked by ``_missing``
+            n_rows (int): Number of rows in the table
+        Returns:
+            ([dict]) Record for each row, empty if no mapped column is present
+        """
+        records = [{} for _ in range(n_rows)]
+        for col, key in self.fields:
+            values = columns.get(col)
+            if values is None:
+                continue
+            if len(key) == 1:
+                leaf = key[0]
+                for record, value in zip(records, values):
+                    if value is not _missing:
+                        record[leaf] = value
+            else:
+                parents, leaf = key[:-1], key[-1]
+                for record, value in zip(records, values):
+                    if value is not _missing:
+                        for part in parents:
+                            record = record.setdefault(part, {})
+                        record[leaf] = value
+        return records
+
+
+def _coerce_column(values: list) -> list:
+    """Convert a numeric column to native integers or floats, using NumPy
+
+    Columns are numeric if every value that is present and not None is a number,
+    such as the ``Decimal`` values produced by some table readers.
+    Integer columns stay integers and other numeric columns become floats.
+    Values that are not finite stay NaN or infinite, so records holding them are rejected
+    by validation as they are when rows are converted one at a time.
+    Other columns are not changed.
 
     Args:
-        record (dict): Record to be added to
-        key ((str)): Location of new record as a listing of the
-        value: Value to be stored
+        values (list): Values of the column, including ``_missing`` and None
+    Returns:
+        (list) Converted values
     """
+    present = [i for i, v in enumerate(values) if v is not _missing and v is not None]
+    if len(present) == 0:
+        return values
+    data = [values[i] for i in present]
+    types = set(map(type, data))
+    if types <= _native_types or any(t is bool or not issubclass(t, Number) for t in types):
+        return values
 
-    if len(key) == 1:
-        record[key[0]] = value
+    if all(issubclass(t, Integral) for t in types):
+        converted = [int(v) for v in data]
+    elif np is None:
+        converted = [float(v) for v in data]
     else:
-        if key[0] not in record:
-            record[key[0]] = {}
-        _add_value(record[key[0]], key[1:], value)
+        converted = np.asarray(data, dtype=np.float64).tolist()
+    output = list(values)
+    for i, value in zip(present, converted):
+        output[i] = value
+    return output
+
+
+class CSVRecords:
+    """Records from a CSV file, created as they are iterated over
+
+    Only the parsed table is held in memory, and records are made a chunk of rows at a time.
+    Instances can be pickled, so they can be sent between processes or stored on disk.
+    """
+
+    def __init__(self, rows: List[dict], mapping: Dict[str, str], columnar: bool = False,
+                 chunk_size: int = 4096):
+        """
+        Args:
+            rows ([dict]): Rows of the table
+            mapping (dict): Map of MDF fields to column names
+            columnar (bool): Whether to make records by column, converting numeric columns
+            chunk_size (int): Number of rows converted at a time
+        """
+        self.rows = rows
+        self.mapping = mapping
+        self.columnar = columnar
+        self.chunk_size = chunk_size
+
+    def has_mapped_columns(self) -> bool:
+        """Whether the table holds any mapped column, without making any records
+
+        The rows of a table share their columns, so only the first row is checked
+
+        Returns:
+            (bool) Whether iterating produces any records
+        """
+        if len(self.rows) == 0:
+            return False
+        header = self.rows[0]
+        return any(col in header for col in CSVAdapter.get_builder(self.mapping).columns)
+
+    def __iter__(self) -> Iterator[dict]:
+        builder = CSVAdapter.get_builder(self.mapping)
+        rows = iter(self.rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if len(chunk) == 0:
+                return
+            if self.columnar:
+                records = builder.build_columns(
+                    dict((col, _coerce_column([row.get(col, _missing) for row in chunk]))
+                         for col in builder.columns), len(chunk))
+            else:
+                records = map(builder.build, chunk)
+            for record in records:
+                if len(record) > 0:
+                    yield record
 
 
 class CSVAdapter(BaseAdapter):
@@ -26,26 +203,65 @@ class CSVAdapter(BaseAdapter):
     The CSV adapter requires a single context parameter: ``mapping``.
     Mapping defines the name of the MDF field (using '.'s to separate keys at different levels)
     to the name of the column.
+
+    Other optional context parameters are:
+        - ``columnar``: Make records a column at a time, converting numeric columns
+          (e.g., ``Decimal`` values) to native numbers. Default False
+        - ``chunk_size``: Number of rows converted at a time. Default 4096
+        - ``stream``: Return a :class:`CSVRecords` that makes the records as it is
+          iterated over, rather than a list, or ``None`` if the table has none of the
+          mapped columns. Default False
     """
 
+    _builders = {}
+    """Builders compiled for each mapping, keyed by its items"""
+    _builders_lock = Lock()
+
+    @classmethod
+    def get_builder(cls, mapping: Dict[str, str]) -> RecordBuilder:
+        """Get the record builder for a mapping, compiling it if needed
+
+        Args:
+            mapping (dict): Map of MDF fields to column names
+        Returns:
+            (RecordBuilder) Compiled mapping
+        """
+        key = tuple(mapping.items())
+        builder = cls._builders.get(key)
+        if builder is None:
+            builder = RecordBuilder(mapping)
+            with cls._builders_lock:
+                if len(cls._builders) > 1024:
+                    cls._builders.clear()
+                cls._builders[key] = builder
+        return builder
+
+    def iter_records(self, metadata: dict, context: dict) -> Iterator[dict]:
+        """Make records from the rows of a CSV file, a chunk of rows at a time
+
+        Args:
+            metadata (dict): Output of the CSV parser
+            context (dict): Context for the adapter, including the ``mapping``
+        Yields:
+            (dict) Record for each row with at least one mapped column
+        """
+        return iter(CSVRecords(metadata['records'], context['mapping'],
+                               columnar=context.get('columnar', False),
+                               chunk_size=context.get('chunk_size', 4096)))
+
     def transform(self, metadata: dict,
-                  context: Union[None, dict] = None) -> Union[None, List[dict]]:
+                  context: Union[None, dict] = None) -> Union[None, List[dict], CSVRecords]:
         # We cannot handle CSV files if the user does not define a mapping
         if context is None:
             return None
         if 'mapping' not in context:
             return None
 
-        # Parse the mapping
-        col_to_mdf = dict((y, x.split('.')) for x, y in context['mapping'].items())
-
         # Generate entries
-        sub_records = []
-        for record in metadata['records']:
-            new_record = {}
-            for col, key in col_to_mdf.items():
-                if col in record:
-                    _add_value(new_record, key, record[col])
-            if len(new_record) > 0:
-                sub_records.append(new_record)
+        if context.get('stream', False):
+            records = CSVRecords(metadata['records'], context['mapping'],
+                                 columnar=context.get('columnar', False),
+                                 chunk_size=context.get('chunk_size', 4096))
+            return records if records.has_mapped_columns() else None
+        sub_records = list(self.iter_records(metadata, context))
         return sub_records if len(sub_records) > 0 else None
@@ -0,0 +1,341 @@
+"""Share parse results between datasets that hold identical files
+
+The cache stores the result of each parser and adapter keyed by the contents of the files
+they parsed, rather than by their paths, so a file re-published in another dataset,
+or in another directory of the same dataset, is not parsed again.
+
+The key of a result combines:
+
+- the name and version of the parser, and the version of this package, which holds the adapters
+- the context of the parser, without the ``root_dir`` of the dataset
+- the hash of each file, and its path relative to the directory holding the group of files
+
+Paths in the results depend on where the files are, so they are not stored as they are.
+Paths within the directory of the group, whether absolute (including as part of a longer string,
+such as a URL) or relative to the ``root_dir`` of the dataset, are replaced with placeholders
+when a result is stored and filled in with the location of the new files when it is used.
+Results that still hold other absolute paths within the dataset, such as those of files
+in another directory or of the ``root_dir`` itself, would show the paths of this dataset
+in the records of another, so they are not stored.
+
+The cache is an SQLite database, shared safely by several processes through SQLite's
+write-ahead log. Once the results exceed a size limit, those used least recently are removed.
+
+Example::
+
+    cache = ParseCache('/scratch/mdf-parse-cache.db', max_bytes=10 * 1024 ** 3)
+    records = generate_search_index('/path/to/data', workers=8, cache=cache)
+"""
+
+from materials_io.utils.interface import ParseResult
+from mdf_matio import execution
+from mdf_matio.execution import ParseTask
+from mdf_matio.incremental import _hash_file, _hash_context
+from mdf_matio.version import __version__
+from typing import Dict, Optional, Tuple
+import logging
+import hashlib
+import sqlite3
+import pickle
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 4 * 1024 ** 3
+"""Default size limit of the cache, in bytes"""
+
+_abs_marker = '\x00mdf_matio:dir\x00'
+"""Placeholder for the absolute path of the directory holding a group of files"""
+
+_rel_marker = '\x00mdf_matio:rel\x00'
+"""Placeholder for the path of that directory relative to the root of the dataset"""
+
+
+def _group_directory(group: Tuple[str, ...]) -> str:
+    """Get the directory holding a group of files"""
+    return os.path.dirname(group[0]) if len(group) == 1 else os.path.commonpath(group)
+
+
+def _relative_directory(directory: str, context: Optional[dict]) -> str:
+    """Get the path of a directory relative to the ``root_dir`` given in a context,
+    or an empty string if there is no ``root_dir``"""
+    if not isinstance(context, dict) or context.get('root_dir') is None:
+        return ''
+    return os.path.relpath(directory, context['root_dir'])
+
+
+class _Rebaser:
+    """Replace paths within a directory with placeholders, or the reverse"""
+
+    def __init__(self, group: Tuple[str, ...], context: Optional[dict]):
+        """
+        Args:
+            group ((str)): Paths of the files in a group
+            context (dict): Context of the parser, which may include the ``root_dir``
+        """
+        self.directory = _group_directory(group)
+        self.prefix = self.directory.rstrip(os.path.sep)
+        self.relative = _relative_directory(self.directory, context)
+        if self.relative in (os.curdir, os.pardir) or \
+                self.relative.startswith(os.pardir + os.path.sep):
+            self.relative = ''  # Relative paths are names of files, which are not changed
+
+        # Paths in the dataset outside of the group cannot be replaced
+        if isinstance(context, dict) and context.get('root_dir') is not None:
+            self.dataset = os.path.abspath(context['root_dir']).rstrip(os.path.sep)
+        else:
+            self.dataset = os.path.dirname(self.prefix).rstrip(os.path.sep)
+
+    def _strip_path(self, value: str) -> str:
+        sep = os.path.sep
+        if value == self.directory != '':
+            return _abs_marker
+        if self.prefix != '':
+            # Absolute paths may also be part of other strings, such as URLs
+            if self.prefix + sep in value:
+                return value.replace(self.prefix + sep, _abs_marker + sep)
+        elif self.directory == sep and value.startswith(sep):
+            return _abs_marker + value
+        if self.relative != '' and value.startswith(self.relative + sep):
+            return _rel_marker + value[len(self.relative):]
+        return value
+
+    def _fill_path(self, value: str) -> str:
+        if value == _abs_marker:
+            return self.directory
+        if _abs_marker in value:
+            return value.replace(_abs_marker, self.prefix)
+        if value.startswith(_rel_marker):
+            return self.relative + value[len(_rel_marker):]
+        return value
+
+    def _apply(self, value, func):
+        if isinstance(value, str):
+            return func(value)
+        elif isinstance(value, dict):
+            return dict((k, self._apply(v, func)) for k, v in value.items())
+        elif isinstance(value, list):
+            return [self._apply(v, func) for v in value]
+        elif type(value) is tuple:
+            return tuple(self._apply(v, func) for v in value)
+        return value
+
+    def has_dataset_paths(self, metadata) -> bool:
+        """Whether a stripped result holds absolute paths within the dataset
+
+        Args:
+            metadata: Result with its paths replaced by :meth:`strip`
+        Returns:
+            (bool) Whether any string, including the keys of dictionaries,
+                contains the path to the dataset
+        """
+        if self.dataset == '':
+            return False  # The dataset is the root of the file system
+        if isinstance(metadata, str):
+            return metadata == self.dataset or self.dataset + os.path.sep in metadata
+        elif isinstance(metadata, dict):
+            return any(self.has_dataset_paths(k) or self.has_dataset_paths(v)
+                       for k, v in metadata.items())
+        elif isinstance(metadata, (list, tuple)):
+            return any(self.has_dataset_paths(v) for v in metadata)
+        return False
+
+    def strip(self, metadata):
+        """Replace the paths in a parse result with placeholders"""
+        return self._apply(metadata, self._strip_path)
+
+    def fill(self, metadata):
+        """Replace the placeholders in a stored result with the paths of this group"""
+        return self._apply(metadata, self._fill_path)
+
+
+class ParseCache:
+    """Cache of parse results keyed by the contents of the parsed files
+
+    Instances can be sent to worker processes, which each open their own connection
+    to the database.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_BYTES, timeout: float = 60):
+        """
+        Args:
+            path (str): Path to the database. Created if it does not exist
+            max_bytes (int): Largest total size of the stored results, in bytes
+            timeout (float): Time to wait for another process to finish writing, in seconds
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        """Number of results found in the cache by this process"""
+        self.misses = 0
+        """Number of results not found in the cache by this process"""
+        self._conn = None
+        self._pid = None
+        self._versions: Dict[str, str] = {}
+        self._connect()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = state['_pid'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get the connection of this process to the database"""
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        # Connections cannot be shared with a forked process, so each opens a new one
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data BLOB, '
+                     'size INTEGER, used INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        conn.execute('CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)')
+        conn.execute("INSERT OR IGNORE INTO totals VALUES ('size', 0)")
+        conn.execute('COMMIT')
+        self._conn, self._pid = conn, os.getpid()
+        return conn
+
+    @property
+    def size(self) -> int:
+        """Total size of the stored results, in bytes"""
+        return self._connect().execute("SELECT value FROM totals WHERE name = 'size'")\
+            .fetchone()[0]
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def _get_version(self, parser: str) -> str:
+        """Get the version of a parser, or an empty string if it has none"""
+        version = self._versions.get(parser)
+        if version is None:
+            try:
+                version = str(execution.get_parser(parser).version())
+            except Exception:
+                version = ''
+            self._versions[parser] = version
+        return version
+
+    def make_key(self, task: ParseTask, context: Optional[dict] = None) -> Optional[str]:
+        """Compute the key of the result of a task
+
+        Args:
+            task (ParseTask): Task to be run
+            context (dict): Context of the parser
+        Returns:
+            (str) Key of the result, or ``None`` if the files cannot be read
+        """
+        directory = _group_directory(task.group)
+        # Paths of files at the root of the dataset, relative to the root, are their names.
+        #  Those results cannot be used elsewhere in a dataset, or the reverse
+        at_root = _relative_directory(directory, context) == os.curdir
+        if isinstance(context, dict):
+            context = dict((k, v) for k, v in context.items() if k != 'root_dir')
+        try:
+            files = [[os.path.relpath(f, directory), _hash_file(f)] for f in task.group]
+        except OSError:
+            return None
+        key = [task.parser, self._get_version(task.parser), __version__,
+               _hash_context(context), at_root, files]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def load(self, key: str, task: ParseTask, context: Optional[dict] = None) \
+            -> Tuple[bool, Optional[ParseResult]]:
+        """Get a stored result, with its paths changed to those of a task
+
+        Args:
+            key (str): Key of the result, from :meth:`make_key`
+            task (ParseTask): Task whose result is needed
+            context (dict): Context of the parser
+        Returns:
+            - (bool) Whether the result was found
+            - (ParseResult) Stored result, ``None`` if the task produced no metadata
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT data FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        try:
+            conn.execute('UPDATE results SET used = ? WHERE key = ?', (time.time_ns(), key))
+        except sqlite3.OperationalError:
+            pass  # The cache is busy. The result is still valid
+        if row[0] is None:
+            return True, None
+        metadata = _Rebaser(task.group, context).fill(pickle.loads(row[0]))
+        return True, ParseResult(task.group, task.parser, metadata)
+
+    def store(self, key: str, task: ParseTask, context: Optional[dict],
+              result: Optional[ParseResult]):
+        """Store the result of a task, removing old results if the cache is full
+
+        Args:
+            key (str): Key of the result, from :meth:`make_key`
+            task (ParseTask): Task that produced the result
+            context (dict): Context of the parser
+            result (ParseResult): Result of the task, ``None`` if it produced no metadata
+        """
+        data = None
+        if result is not None:
+            metadata = result.metadata
+            if not isinstance(metadata, (dict, list)):
+                metadata = list(metadata)  # Records made as they are iterated over
+            rebaser = _Rebaser(task.group, context)
+            metadata = rebaser.strip(metadata)
+            if rebaser.has_dataset_paths(metadata):
+                logger.debug(f'Not caching the result for {task.group}, '
+                             'which holds paths to other files in the dataset')
+                return
+            data = pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL)
+        size = len(key) + (0 if data is None else len(data))
+        if size > self.max_bytes:
+            return
+
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (key, data, size, time.time_ns()))
+            conn.execute("UPDATE totals SET value = value + ? WHERE name = 'size'",
+                         (size - (0 if old is None else old[0]),))
+            self._evict(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Remove the least recently used results until the cache is below its size limit"""
+        total, = conn.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        # Free a tenth of the cache at once, so that eviction is not needed on every store
+        target = total - int(self.max_bytes * 0.9)
+        removed, keys = 0, []
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY used'):
+            keys.append((key,))
+            removed += size
+            if removed >= target:
+                break
+        conn.executemany('DELETE FROM results WHERE key = ?', keys)
+        conn.execute("UPDATE totals SET value = value - ? WHERE name = 'size'", (removed,))
+        logger.debug(f'Removed {len(keys)} results ({removed} bytes) from the parse cache')
+
+    def close(self):
+        """Close the connection of this process to the database"""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = self._pid = None
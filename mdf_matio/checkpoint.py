@@ -0,0 +1,111 @@
+"""Save the progress of long indexing runs so that they can be resumed
+
+A checkpoint records how many merged groups of files have been turned into records,
+how many records were produced, and the state of the validator (scroll IDs, ingest date
+and dataset aggregates). A run restarted from a checkpoint skips the groups that were finished
+and produces the remaining records exactly as the interrupted run would have.
+
+Checkpoints are saved only when the consumer of the records asks for the next record,
+so every record counted in a checkpoint has been received by the consumer.
+A consumer that writes records somewhere should, when resuming, keep only the first
+``yielded`` records it wrote (see :attr:`IndexCheckpoint.state`) and then append the records
+produced by the resumed run.
+
+The parse results of a checkpointed run are stored in a manifest (see :mod:`mdf_matio.incremental`)
+next to the checkpoint, so that the parsers are not run again for files parsed before the
+interruption.
+"""
+
+from typing import Optional
+import hashlib
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+"""Version of the checkpoint format"""
+
+
+def make_run_key(**options) -> str:
+    """Make a key that identifies the options of an indexing run
+
+    Args:
+        options: Options that change the records produced by the run
+    Returns:
+        (str) Hex digest of the options
+    """
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IndexCheckpoint:
+    """Checkpoint of an indexing run, saved as a JSON file
+
+    The file is replaced atomically each time the checkpoint is saved and removed once
+    the run finishes, so that the next run starts from the beginning.
+    """
+
+    def __init__(self, path: str, run_key: Optional[str] = None, interval: float = 300):
+        """
+        Args:
+            path (str): Path to the checkpoint file. Loaded if it exists
+            run_key (str): Key identifying the options of the run (see :func:`make_run_key`).
+                A checkpoint saved by a run with different options is not used
+            interval (float): Shortest time between saves, in seconds
+        Raises:
+            ValueError: If the checkpoint is from a run with different options
+        """
+        self.path = path
+        self.run_key = run_key
+        self.interval = interval
+        self.state: Optional[dict] = None
+        """State of the interrupted run: the number of ``groups`` finished, the number of
+        items ``yielded`` (including the dataset entry) and the ``validator`` state.
+        ``None`` if there is no run to resume"""
+        self._last_save = time.monotonic()
+
+        if os.path.exists(path):
+            with open(path) as fp:
+                state = json.load(fp)
+            if state.get('version') != CHECKPOINT_VERSION:
+                raise ValueError(f'Unsupported checkpoint version: {state.get("version")}')
+            if state.get('run_key') != run_key:
+                raise ValueError(f'Checkpoint at {path} is from a run with different options')
+            self.state = state
+            logger.info(f'Resuming from checkpoint after {state["groups"]} groups '
+                        f'and {state["yielded"]} records')
+
+    @property
+    def manifest_path(self) -> str:
+        """Path of the manifest holding the parse results of the run"""
+        return self.path + '.parsed'
+
+    def is_due(self) -> bool:
+        """Whether enough time has passed since the last save"""
+        return time.monotonic() - self._last_save >= self.interval
+
+    def save(self, groups: int, yielded: int, validator: dict):
+        """Save the progress of the run
+
+        Args:
+            groups (int): Number of merged groups fully processed
+            yielded (int): Number of items produced, including the dataset entry
+            validator (dict): State of the validator, from
+                :meth:`~mdf_matio.validator.MDFValidator.get_state`
+        """
+        state = {'version': CHECKPOINT_VERSION, 'run_key': self.run_key, 'groups': groups,
+                 'yielded': yielded, 'validator': validator}
+        with open(self.path + '.part', 'w') as fp:
+            json.dump(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(self.path + '.part', self.path)
+        self._last_save = time.monotonic()
+
+    def finish(self):
+        """Remove the checkpoint once the run is complete"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.state = None
@@ -0,0 +1,314 @@
+"""Run parsers and adapters over a dataset as independent tasks
+
+Each task is a single parser applied to one group of files.
+The tasks are identified before any parsing begins and sorted by directory, which
+makes the order of the parse results independent of how many processes execute them.
+"""
+
+from materials_io.utils.interface import ParseResult, get_adapter, get_parser, execute_parser
+from mdf_matio.instrumentation import IndexingStats
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from collections import deque
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class ParseTask(NamedTuple):
+    """A group of files to be parsed with a certain parser"""
+
+    parser: str
+    """Name of the parser and its matching adapter"""
+    group: Tuple[str, ...]
+    """Paths of the files to be parsed together"""
+
+
+class TaskFailure(NamedTuple):
+    """Outcome of a task that failed for a reason that may not recur, such as a lack of memory
+
+    Unlike a task that produced no metadata, such a task should be run again in later runs
+    """
+
+    reason: str
+    """Why the task failed"""
+
+
+def _has_result(result: Union[ParseResult, TaskFailure, None]) -> bool:
+    """Whether the outcome of a task holds metadata"""
+    return result is not None and not isinstance(result, TaskFailure)
+
+
+def _task_directory(group: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Get the directory containing a group of files, as a list of path components
+
+    Sorting by the path components, rather than the path, keeps
+    each directory next to its subdirectories
+
+    Args:
+        group ((str)): Paths of the files in a group
+    Returns:
+        ((str)) Components of the path to the directory
+    """
+    directory = os.path.dirname(group[0]) if len(group) == 1 else os.path.commonpath(group)
+    return tuple(directory.split(os.path.sep))
+
+
+def get_versions(name: str) -> Tuple[str, str]:
+    """Get the versions of a parser and its matching adapter
+
+    Args:
+        name (str): Name of the parser and adapter
+    Returns:
+        - (str) Version of the parser, or an empty string if it has none
+        - (str) Version of the adapter, or an empty string if it has none
+    """
+    versions = []
+    for getter in [get_parser, get_adapter]:
+        try:
+            versions.append(str(getter(name).version()))
+        except Exception:
+            versions.append('')
+    return versions[0], versions[1]
+
+
+def identify_tasks(data_url: str, parsers: Iterable[str], contexts: Optional[dict] = None)\
+        -> List[ParseTask]:
+    """Find the groups of files each parser will process
+
+    Args:
+        data_url (str): Location of dataset to be parsed
+        parsers ([str]): Names of the parsers to run
+        contexts (dict): Context for each parser, keyed by parser name
+    Returns:
+        ([ParseTask]) Tasks sorted by directory, parser name and file names
+    """
+    contexts = contexts or {}
+    tasks = []
+    for name in sorted(parsers):
+        parser = get_parser(name)
+        for group in parser.identify_files(data_url, contexts.get(name)):
+            tasks.append(ParseTask(name, tuple(group)))
+    tasks.sort(key=lambda x: (_task_directory(x.group), x.parser, x.group))
+    logger.info(f'Identified {len(tasks)} groups of files to parse')
+    return tasks
+
+
+def run_task(task: ParseTask, contexts: Optional[dict] = None,
+             cache=None) -> Optional[ParseResult]:
+    """Run a parser and its adapter on a group of files
+
+    Args:
+        task (ParseTask): Task to be executed
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        cache (ParseCache): Cache of results keyed by file contents (see :mod:`mdf_matio.cache`).
+            Default is to always run the parser
+    Returns:
+        (ParseResult) Result of the parsing, or ``None`` if the parser failed
+            or the adapter produced no metadata
+    """
+    result = _execute_task(task, contexts, cache)
+    return None if isinstance(result, TaskFailure) else result
+
+
+def _execute_task(task: ParseTask, contexts: Optional[dict] = None,
+                  cache=None) -> Union[ParseResult, TaskFailure, None]:
+    """Run a parser and its adapter on a group of files, reporting failures that may not recur
+
+    Args:
+        task (ParseTask): Task to be executed
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        cache (ParseCache): Cache of results keyed by file contents
+    Returns:
+        (ParseResult) Result of the parsing, a :class:`TaskFailure` if the parser failed
+            reading the files or for lack of memory, or ``None`` if the parser failed
+            otherwise or the adapter produced no metadata
+    """
+    contexts = contexts or {}
+    context = contexts.get(task.parser)
+    key = None
+    if cache is not None:
+        key = cache.make_key(task, context)
+        if key is not None:
+            found, result = cache.load(key, task, context)
+            if found:
+                return result
+
+    try:
+        metadata = execute_parser(task.parser, task.group, context=context, adapter=task.parser)
+    except Exception as exc:
+        logger.debug(f'Parser {task.parser} failed on {task.group}: {exc}')
+        # Failures from reading the files or lack of memory may not happen again
+        if isinstance(exc, (OSError, MemoryError)):
+            return TaskFailure(f'{type(exc).__name__}: {exc}')
+        if key is not None:
+            cache.store(key, task, context, None)
+        return None
+    if key is not None and metadata is not None and not isinstance(metadata, (dict, list)):
+        metadata = list(metadata)  # Records made as they are iterated over are read by the cache
+    result = None if metadata is None else ParseResult(task.group, task.parser, metadata)
+    if key is not None:
+        cache.store(key, task, context, result)
+    return result
+
+
+def _run_timed(task: ParseTask, contexts: Optional[dict], cache=None) \
+        -> Tuple[Union[ParseResult, TaskFailure, None], float]:
+    """Run a task and measure how long it takes
+
+    Args:
+        task (ParseTask): Task to be executed
+        contexts (dict): Context for each parser and adapter
+        cache (ParseCache): Cache of parse results
+    Returns:
+        - (ParseResult) Result of the task, or a :class:`TaskFailure`
+        - (float) Execution time in seconds
+    """
+    start = time.perf_counter()
+    result = _execute_task(task, contexts, cache)
+    return result, time.perf_counter() - start
+
+
+def _run_chunk(tasks: List[ParseTask], contexts: Optional[dict], cache=None) \
+        -> List[Tuple[Union[ParseResult, TaskFailure, None], float]]:
+    """Run a batch of tasks in a worker process
+
+    Args:
+        tasks ([ParseTask]): Tasks to be executed
+        contexts (dict): Context for each parser and adapter
+        cache (ParseCache): Cache of parse results
+    Returns:
+        ([(ParseResult, float)]) Result of each task and its execution time
+    """
+    return [_run_timed(task, contexts, cache) for task in tasks]
+
+
+def _chunk(tasks: Iterable[ParseTask], chunksize: int) -> Iterator[List[ParseTask]]:
+    """Break a list of tasks into batches
+
+    Args:
+        tasks ([ParseTask]): Tasks to be batched
+        chunksize (int): Maximum number of tasks per batch
+    Yields:
+        ([ParseTask]) Batches of tasks, in order
+    """
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def execute_tasks(tasks: Iterable[ParseTask], contexts: Optional[dict] = None, workers: int = 1,
+                  chunksize: int = 16, stats: Optional[IndexingStats] = None,
+                  cache=None, schedule=None, isolation=None, keep_failures: bool = False) \
+        -> Iterator[Union[ParseResult, TaskFailure, None]]:
+    """Execute parsing tasks, potentially across many processes
+
+    Results are produced in the same order as the tasks regardless of the number of workers.
+    Only a few batches per worker are in flight at a time,
+    so results do not accumulate if the consumer is slower than the parsers.
+
+    Args:
+        tasks ([ParseTask]): Tasks to be executed
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        workers (int): Number of processes to use. If 1, tasks are run in this process
+        chunksize (int): Number of tasks sent to a worker at a time
+        stats (IndexingStats): Statistics in which to record the execution time of each task
+        cache (ParseCache): Cache of results keyed by file contents (see :mod:`mdf_matio.cache`)
+        schedule (Schedule): Pools of workers for each parser (see :mod:`mdf_matio.scheduling`).
+            If provided, ``workers`` and ``chunksize`` are ignored
+        isolation (Isolation): Limits on the time and memory of each task, which are then
+            run one at a time in ``workers`` processes (see :mod:`mdf_matio.isolation`).
+            Cannot be combined with ``schedule``
+        keep_failures (bool): Whether to produce a :class:`TaskFailure` for tasks that failed
+            for reasons that may not recur, such as a lack of memory or the limits of
+            ``isolation``, rather than ``None``
+    Yields:
+        (ParseResult) Result of each task, ``None`` if the task produced no metadata
+    """
+    if schedule is not None and isolation is not None:
+        raise ValueError('Tasks cannot be both scheduled in pools and isolated')
+    if schedule is not None:
+        results = schedule.execute(tasks, contexts, stats, cache)
+    elif isolation is not None:
+        results = isolation.execute(tasks, contexts, workers, stats, cache)
+    else:
+        results = _execute_tasks(tasks, contexts, workers, chunksize, stats, cache)
+    for result in results:
+        if not keep_failures and isinstance(result, TaskFailure):
+            result = None
+        yield result
+
+
+def _execute_tasks(tasks: Iterable[ParseTask], contexts: Optional[dict], workers: int,
+                   chunksize: int, stats: Optional[IndexingStats], cache) \
+        -> Iterator[Union[ParseResult, TaskFailure, None]]:
+    """Execute parsing tasks in this process or a pool of processes
+
+    See :func:`execute_tasks` for the arguments
+    """
+    if workers < 1:
+        raise ValueError('Number of workers must be at least 1')
+
+    if workers == 1:
+        for task in tasks:
+            if stats is None:
+                yield _execute_task(task, contexts, cache)
+            else:
+                result, duration = _run_timed(task, contexts, cache)
+                stats.record_task(task.parser, duration, _has_result(result))
+                yield result
+        return
+
+    max_pending = workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        chunks = _chunk(tasks, chunksize)
+        while True:
+            # Keep the pool busy with new chunks
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(_run_chunk, chunk, contexts, cache)))
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                return
+
+            # Return the results from the oldest chunk
+            chunk, future = pending.popleft()
+            for task, (result, duration) in zip(chunk, future.result()):
+                if stats is not None:
+                    stats.record_task(task.parser, duration, _has_result(result))
+                yield result
+
+
+def run_tasks(tasks: Iterable[ParseTask], contexts: Optional[dict] = None, workers: int = 1,
+              chunksize: int = 16, stats: Optional[IndexingStats] = None,
+              cache=None, schedule=None, isolation=None) -> Iterator[ParseResult]:
+    """Execute parsing tasks and produce the successful results
+
+    See :func:`execute_tasks` for details
+
+    Args:
+        tasks ([ParseTask]): Tasks to be executed
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        workers (int): Number of processes to use. If 1, tasks are run in this process
+        chunksize (int): Number of tasks sent to a worker at a time
+        stats (IndexingStats): Statistics in which to record the execution time of each task
+        cache (ParseCache): Cache of results keyed by file contents (see :mod:`mdf_matio.cache`)
+        schedule (Schedule): Pools of workers for each parser (see :mod:`mdf_matio.scheduling`).
+            If provided, ``workers`` and ``chunksize`` are ignored
+        isolation (Isolation): Limits on the time and memory of each task
+            (see :mod:`mdf_matio.isolation`)
+    Yields:
+        (ParseResult) Results of each successful task
+    """
+    for result in execute_tasks(tasks, contexts, workers, chunksize, stats, cache, schedule,
+                                isolation):
+        if result is not None:
+            yield result
@@ -1,14 +1,68 @@
 from materials_io.utils.interface import ParseResult
-from typing import Iterable, List
+from mdf_matio.spill import RecordBuffer, SQLiteStore, _get_threshold
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from operator import itemgetter
-from itertools import groupby
+from itertools import chain, groupby
+from collections import deque
+from array import array
 import os
 
 
-# TODO (wardlt): Grouping requires entire parsed data, memory intensive for larger filesystems
-#  Potential Plan: Write to a temporary database with SQLite and sqlalchemy
-#    Pros: No external database to manage, can handle temporary file with context manager
-#    Cons: Disk access slow (avoidable?), would recreate database on each step
+# Grouping requires the entire parsed data, unless the records arrive sorted by directory.
+#  Above a threshold number of records, records are moved to a temporary SQLite database
+#  to keep memory use bounded (see `spill`)
+
+
+class _DisjointSet:
+    """Disjoint-set forest over consecutive integer IDs
+
+    The root of each set is always its smallest member, which keeps the
+    output of the grouping functions in the order records were received.
+    """
+
+    def __init__(self):
+        self.parents = array('q')
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self) -> int:
+        """Create a new set containing only one new member
+
+        Returns:
+            (int) ID of the new member
+        """
+        new_id = len(self.parents)
+        self.parents.append(new_id)
+        return new_id
+
+    def find(self, x: int) -> int:
+        """Get the root of the set containing a member
+
+        Args:
+            x (int): ID of the member
+        Returns:
+            (int) ID of the root of its set
+        """
+        parents = self.parents
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]  # Path halving
+            x = parents[x]
+        return x
+
+    def union(self, x: int, y: int):
+        """Merge the sets containing two members
+
+        Args:
+            x (int): ID of a member of the first set
+            y (int): ID of a member of the second set
+        """
+        x = self.find(x)
+        y = self.find(y)
+        if x < y:
+            self.parents[y] = x
+        elif y < x:
+            self.parents[x] = y
 
 
 def _get_directory(group: ParseResult) -> str:
@@ -26,90 +80,280 @@ def _get_directory(group: ParseResult) -> str:
         return os.path.commonpath(files)
 
 
-def groupby_directory(records: Iterable[ParseResult]) -> Iterable[List[ParseResult]]:
+def _split_path(path: str) -> Tuple[str, ...]:
+    """Split a path into its components, ignoring any trailing separator
+
+    Args:
+        path (str): Path to split
+    Returns:
+        ((str)) Components of the path
+    """
+    return tuple(path.rstrip(os.path.sep).split(os.path.sep)) if path else ()
+
+
+class DirectoryIndex:
+    """Trie of directories, used to find which of them contain a file
+
+    Finding the directories for a file takes time proportional to the depth of the file,
+    regardless of the number of directories in the index
+    """
+
+    def __init__(self, directories: Iterable[str]):
+        """
+        Args:
+            directories ([str]): Paths of the directories to index
+        """
+        self._root = {}
+        for path in directories:
+            node = self._root
+            for component in _split_path(path):
+                node = node.setdefault(component, {})
+            node[None] = path  # Components are strings, so None marks the end of a path
+
+    def find_owner(self, path: str) -> Optional[str]:
+        """Get the outermost indexed directory that contains a file
+
+        Args:
+            path (str): Path of the file
+        Returns:
+            (str) Path of the directory, as given to the index, or ``None`` if no
+                indexed directory contains the file
+        """
+        node = self._root
+        for component in _split_path(os.path.dirname(path)):
+            node = node.get(component)
+            if node is None:
+                return None
+            owner = node.get(None)
+            if owner is not None:
+                return owner
+        return None
+
+    def find_record_owner(self, record: ParseResult) -> Optional[str]:
+        """Get the outermost indexed directory that contains any file of a record
+
+        Args:
+            record (ParseResult): Record to be checked
+        Returns:
+            (str) Path of the directory, or ``None`` if no indexed directory contains the files
+        """
+        owner = None
+        for f in record.group:
+            my_owner = self.find_owner(f)
+            if my_owner is not None and (owner is None or
+                                         len(_split_path(my_owner)) < len(_split_path(owner))):
+                owner = my_owner
+        return owner
+
+
+def groupby_directory(records: Iterable[ParseResult], spill_threshold: Optional[int] = None)\
+        -> Iterable[List[ParseResult]]:
     """Group parsing results by directory
 
     Args:
         records ([ParseResult])): Iterable of data coming from the parser
+        spill_threshold (int): Number of records to hold in memory before moving them
+            to a temporary database on disk.
+            Default is :data:`~mdf_matio.spill.DEFAULT_SPILL_THRESHOLD`
     Yields:
         ([ParseResult]) after grouping based on directory, sorted by directory name
     """
 
     # Sort by the directory name, so that `groupby` see consecutive keys of the
-    sorted_data = sorted(zip(map(_get_directory, records), records), key=itemgetter(0))
-    for gid, group in groupby(sorted_data, key=itemgetter(0)):
-        yield [x[1] for x in group]  # Remove directory name
+    with RecordBuffer(spill_threshold) as buffer:
+        for record in records:
+            buffer.append(record, _get_directory(record))
+        yield from buffer.groups()
 
 
-def groupby_file(records: Iterable[ParseResult], max_passes=-1) -> Iterable[List[ParseResult]]:
+def groupby_file(records: Iterable[ParseResult], max_passes=-1,
+                 spill_threshold: Optional[int] = None, ordered: bool = False,
+                 held: Optional[Dict[object, Tuple[str, ...]]] = None) \
+        -> Iterable[List[ParseResult]]:
     """Group together parsing results that reference the same files
 
-    Files are grouped in an iterative procedure, which can be costly.
-    The number of grouping iterations can be truncated for speed.
+    Records are grouped in a single pass using an inverted index from each file to the
+    first record that contained it and a disjoint-set (union-find) structure that merges
+    records which share a file. Grouping is transitive: if records A and B share a file
+    and B and C share another, all three are placed in the same group.
+
+    Groups are yielded in the order of their first member in ``records``,
+    and the records within each group retain their input order.
+
+    If the records are sorted by directory, as are the results of
+    :func:`~mdf_matio.execution.run_tasks`, a group is complete once the records have moved
+    past the directories of all of its files, as later records can only contain files
+    in or below their own directory. In this ``ordered`` mode, each group is yielded as soon as
+    it and all groups that started before it are complete, rather than after all records.
+    The groups are the same, and in the same order, as without ordering.
 
     Args:
         records (ParseResult): Results of parsing
-        max_passes (int): Maximum number of grouping passes
-        # TODO: Consider a timeout-based solution
+        max_passes (int): Ignored. Retained for compatibility with the earlier, iterative
+            grouping algorithm, which could be truncated after a number of passes
+        spill_threshold (int): Number of records to hold in memory before moving them and the
+            file index to a temporary database on disk.
+            Default is :data:`~mdf_matio.spill.DEFAULT_SPILL_THRESHOLD`
+        ordered (bool): Whether the records are sorted by directory
+        held (dict): Directories, as path components, of records received by an earlier step
+            but not yet passed on to this one, such as those held by
+            :func:`~mdf_matio._merge_directories`. Used only if ``ordered``.
+            Groups with files in or after the earliest of these directories are not complete
     Yields:
         ([ParseResult]) Lists of parsed records that contain the same files
     """
 
-    # Initialize each file into its own group
-    current_groups = [(set(x[0]), [x]) for x in records]
-
-    # Perform grouping passes
-    grouping_pass = 0
-    while True:
-        grouping_pass += 1
-        matched_groups = []  # Groups that are matched and may have to be grouped again
-
-        while len(current_groups) > 0:
-            # Pick a record to attempt to match other records
-            to_match = current_groups.pop()
-            matched_ids = set()
-
-            # See if it matches any already-matched group
-            my_files = to_match[0]
-            matched = False
-            for files, records in matched_groups:
-                if not my_files.isdisjoint(files):
-                    matched = True
-                    files.update(my_files)
-                    records.extend(to_match[1])
-                    break
-            if matched:
-                continue
+    spill_threshold = _get_threshold(spill_threshold)
+    if ordered:
+        yield from _groupby_file_ordered(records, spill_threshold, held)
+        return
 
-            # Loop over all other records, find those that have similar
-            for i, record in enumerate(current_groups):
-                if not record[0].isdisjoint(my_files):
-                    matched_ids.add(i)
+    # Assign each record to a group, merging groups that share a file
+    all_records = []
+    groups = _DisjointSet()
+    file_owner = {}  # Maps each file to the first record that contained it
+    store = None
+    try:
+        for record in records:
+            # Move the records and file index to disk if there are too many
+            if store is None and len(all_records) >= spill_threshold:
+                store = SQLiteStore()
+                for my_record in all_records:
+                    store.add(my_record)
+                for f, owner in file_owner.items():
+                    store.claim_file(f, owner)
+                all_records = file_owner = None
 
-            if len(matched_ids) == 0:
-                # Take it out of circulation as there will be no matches on later passes
-                yield to_match[1]  # Return the group
+            my_id = groups.add()
+            if store is None:
+                all_records.append(record)
+                for f in record[0]:
+                    owner = file_owner.setdefault(f, my_id)
+                    if owner != my_id:
+                        groups.union(owner, my_id)
             else:
-                # Get the matched entries, and delete them from current groups
-                my_matched_groups = [e for i, e in enumerate(current_groups) if i in matched_ids]
-                current_groups = [e for i, e in enumerate(current_groups) if i not in matched_ids]
-
-                # Merge the matched groups
-                my_records = to_match[1]
-                for group in my_matched_groups:
-                    my_files.update(group[0])
-                    my_records.extend(group[1])
-
-                # Add new groups to the "must be grouped again list"
-                matched_groups.append((my_files, my_records))
-
-        # Check if we are done
-        if grouping_pass == max_passes:
-            # Return the current matched groups
-            for group in matched_groups:
-                yield group[1]
-        elif len(matched_groups) == 0:
-            return  # Nothing left to group
+                store.add(record)
+                for f in record[0]:
+                    owner = store.claim_file(f, my_id)
+                    if owner != my_id:
+                        groups.union(owner, my_id)
+
+        # Gather the records for each group
+        #  The root of each group is its first member, so the groups are created in input order
+        if store is None:
+            output = {}
+            for my_id, record in enumerate(all_records):
+                output.setdefault(groups.find(my_id), []).append(record)
+            yield from output.values()
+        else:
+            store.set_keys((my_id, groups.find(my_id)) for my_id in range(len(groups)))
+            for _, group in groupby(store.iterate(ordered=True), key=itemgetter(0)):
+                yield [x[1] for x in group]
+    finally:
+        if store is not None:
+            store.close()
+
+
+def _groupby_file_ordered(records: Iterable[ParseResult], spill_threshold: int,
+                          held: Optional[Dict[object, Tuple[str, ...]]])\
+        -> Iterator[List[ParseResult]]:
+    """Group records sorted by directory, yielding each group once it is complete
+
+    Falls back to grouping all remaining records at once if the incomplete groups
+    hold more than ``spill_threshold`` records.
+    """
+    # Most groups hold a single record, so the state of each group is kept in
+    #  flat dictionaries rather than in a container per group, which would slow garbage collection
+    records = iter(records)
+    groups = _DisjointSet()
+    file_owner = {}  # Maps each file of an incomplete group to the first record containing it
+    held_records = {}  # Records of the incomplete groups, keyed by their ID
+    horizons = {}  # Last directory of the files of each incomplete group, keyed by its root
+    members = {}  # IDs of the records of each incomplete group with more than one record
+    roots = deque()  # Roots of the incomplete groups, in order. Includes those merged away
+    position = ()  # Latest directory of the records
+    complete = ()  # Groups with files only before this directory are complete
+    parents = {}  # Path components of each directory, which are shared by many files
+
+    def pop_group(root):
+        ids = members.pop(root, None)
+        if ids is None:
+            ids = [root]
         else:
-            # Prepare to group again
-            current_groups = matched_groups
+            ids.sort()
+        group = [held_records.pop(i) for i in ids]
+        for member in group:
+            for f in member[0]:
+                file_owner.pop(f, None)
+        return group
+
+    for record in records:
+        my_id = groups.add()
+
+        # Find the first and last directories of the files. Their common part is where
+        #  the record is in the sorted order, which may be above the directory of the group
+        horizon = start = None
+        for f in record[0]:
+            key = f[:f.rfind(os.path.sep) + 1]
+            parent = parents.get(key)
+            if parent is None:
+                parent = parents[key] = _split_path(key)
+            if horizon is None:
+                horizon = start = parent
+            elif parent != start:
+                horizon = max(horizon, parent)
+                start = os.path.commonprefix([start, parent])
+        if horizon is None:
+            horizon = start = ()
+        if start > position:
+            position = start
+        held_records[my_id] = record
+        horizons[my_id] = horizon
+        roots.append(my_id)
+
+        # Merge with the groups that contain the same files
+        my_root = my_id
+        for f in record[0]:
+            owner = file_owner.setdefault(f, my_id)
+            if owner == my_id:
+                continue
+            root = groups.find(owner)
+            if root != my_root:
+                groups.union(root, my_root)
+                root, other = min(root, my_root), max(root, my_root)
+                ids = members.get(root)
+                if ids is None:
+                    ids = members[root] = [root]
+                ids.extend(members.pop(other, (other,)))
+                horizons[root] = max(horizons[root], horizons.pop(other))
+                my_root = root
+
+        # Group the rest of the records together if too many are held
+        if len(held_records) >= spill_threshold:
+            remaining = [held_records[i] for i in sorted(held_records)]
+            yield from groupby_file(chain(remaining, records), spill_threshold=spill_threshold)
+            return
+
+        # Yield the complete groups, in the order of their first member
+        #  The root of each group is its first member, so `roots` is in that order.
+        #  More groups can only be complete once the records move to another directory
+        new_complete = min(position, min(held.values())) if held else position
+        if new_complete == complete:
+            continue
+        complete = new_complete
+        while len(roots) > 0:
+            root = roots[0]
+            horizon = horizons.get(root)
+            if horizon is None:
+                roots.popleft()  # Merged into an earlier group
+                continue
+            if horizon >= complete:
+                break
+            roots.popleft()
+            del horizons[root]
+            yield pop_group(root)
+
+    # Yield the remaining groups
+    for root in roots:
+        if root in horizons:
+            yield pop_group(root)
@@ -0,0 +1,233 @@
+"""Re-use the parse results from earlier indexing runs of a dataset
+
+A manifest records the size, modification time and, optionally, the hash of each group
+of files that was parsed along with the result of parsing it.
+Later runs only execute the parsers for groups that are new or whose files changed,
+and for all groups of a parser whose context, version or adapter version changed,
+or if the version of this package changed.
+Groups that no longer exist are removed from the manifest.
+"""
+
+from materials_io.utils.interface import ParseResult
+from mdf_matio.execution import ParseTask, TaskFailure, execute_tasks, get_versions
+from mdf_matio.instrumentation import IndexingStats
+from mdf_matio.version import __version__
+from typing import Iterable, Iterator, List, Optional
+import logging
+import hashlib
+import sqlite3
+import pickle
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _hash_file(path: str) -> str:
+    """Compute the SHA256 hash of a file
+
+    Args:
+        path (str): Path to the file
+    Returns:
+        (str) Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hash_context(context) -> str:
+    """Compute a hash of the options given to a parser and adapter
+
+    Args:
+        context (dict): Context for the parser
+    Returns:
+        (str) Hex digest of the context
+    """
+    return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ParseManifest:
+    """SQLite database of the groups of files parsed in earlier runs and their results
+
+    Each row is identified by the parser and the paths of the files it parsed,
+    and holds the size and modification time of each file when it was parsed,
+    a hash of the parser context and versions, and the parse result.
+    """
+
+    def __init__(self, path: str, use_hash: bool = False):
+        """
+        Args:
+            path (str): Path to the manifest. Created if it does not exist
+            use_hash (bool): Whether to store the hash of each file. If enabled, a file whose
+                size or modification time changed but whose contents did not
+                is not parsed again
+        """
+        self.path = path
+        self.use_hash = use_hash
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS results (parser TEXT, files TEXT, '
+                           'context TEXT, stats TEXT, data BLOB, run INTEGER, '
+                           'PRIMARY KEY (parser, files))')
+        self.run, = self._conn.execute('SELECT COALESCE(MAX(run), 0) + 1 FROM results').fetchone()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def _key(task: ParseTask):
+        return task.parser, '\n'.join(task.group)
+
+    def _get_stats(self, group: Iterable[str], hashes: bool) -> List[list]:
+        """Get the size, modification time and, optionally, hash of each file in a group"""
+        output = []
+        for path in group:
+            stat = os.stat(path)
+            output.append([stat.st_size, stat.st_mtime_ns, _hash_file(path) if hashes else None])
+        return output
+
+    def is_current(self, task: ParseTask, context_hash: str) -> bool:
+        """Determine whether the stored result for a task is still valid
+
+        Args:
+            task (ParseTask): Task to be checked
+            context_hash (str): Hash of the context used for this parser
+        Returns:
+            (bool) Whether the task has a stored result and its files have not changed
+        """
+        row = self._conn.execute('SELECT context, stats FROM results '
+                                 'WHERE parser = ? AND files = ?', self._key(task)).fetchone()
+        if row is None or row[0] != context_hash:
+            return False
+        stored = json.loads(row[1])
+        try:
+            current = self._get_stats(task.group, False)
+        except OSError:
+            return False
+
+        # Compare stats, falling back to the file hashes if they are known
+        changed = False
+        for path, old, new in zip(task.group, stored, current):
+            if old[:2] != new[:2]:
+                if old[2] is None or old[2] != _hash_file(path):
+                    return False
+                old[:2] = new[:2]
+                changed = True
+        if changed:
+            self._conn.execute('UPDATE results SET stats = ? WHERE parser = ? AND files = ?',
+                               (json.dumps(stored), *self._key(task)))
+        return True
+
+    def load(self, task: ParseTask) -> Optional[ParseResult]:
+        """Get the stored result of a task and mark it as used in this run
+
+        Args:
+            task (ParseTask): Task whose result to retrieve
+        Returns:
+            (ParseResult) Stored result, ``None`` if the task produced no metadata
+        """
+        key = self._key(task)
+        data, = self._conn.execute('SELECT data FROM results WHERE parser = ? AND files = ?',
+                                   key).fetchone()
+        self._conn.execute('UPDATE results SET run = ? WHERE parser = ? AND files = ?',
+                           (self.run, *key))
+        return None if data is None else pickle.loads(data)
+
+    def store(self, task: ParseTask, context_hash: str, result: Optional[ParseResult]):
+        """Store the result of a task
+
+        Args:
+            task (ParseTask): Task that was executed
+            context_hash (str): Hash of the context used for this parser
+            result (ParseResult): Result of the task
+        """
+        try:
+            stats = self._get_stats(task.group, self.use_hash)
+        except OSError:
+            return  # File was removed while parsing. Do not store anything
+        data = None if result is None else pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        self._conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                           (*self._key(task), context_hash, json.dumps(stats), data, self.run))
+
+    def finish(self):
+        """Remove the results of any task not seen in this run and save the manifest"""
+        cursor = self._conn.execute('DELETE FROM results WHERE run != ?', (self.run,))
+        logger.info(f'Removed {cursor.rowcount} groups of files that no longer exist')
+        self._conn.commit()
+
+    def commit(self):
+        """Save the manifest"""
+        self._conn.commit()
+
+    def close(self):
+        """Close the manifest without removing old results"""
+        self._conn.commit()
+        self._conn.close()
+
+
+def run_incremental(tasks: Iterable[ParseTask], manifest_path: str,
+                    contexts: Optional[dict] = None, workers: int = 1, use_hash: bool = False,
+                    commit_interval: int = 1000, stats: Optional[IndexingStats] = None,
+                    cache=None, schedule=None, isolation=None) -> Iterator[ParseResult]:
+    """Execute parsing tasks, re-using the results of unchanged tasks from earlier runs
+
+    Results are produced in the same order, and are the same, as running all tasks.
+    Tasks that fail for reasons that may not recur (see :class:`~mdf_matio.execution.TaskFailure`)
+    are not stored, so they run again in the next run
+
+    Args:
+        tasks ([ParseTask]): Tasks to be executed
+        manifest_path (str): Path to the manifest of earlier results
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        workers (int): Number of processes to use for the new or changed tasks
+        use_hash (bool): Whether to compare file hashes when modification times change
+        commit_interval (int): Number of tasks between saves of the manifest
+        stats (IndexingStats): Statistics in which to record the execution time of
+            the new or changed tasks
+        cache (ParseCache): Cache of results keyed by file contents, used for the new or
+            changed tasks (see :mod:`mdf_matio.cache`)
+        schedule (Schedule): Pools of workers for each parser, used for the new or changed tasks
+            instead of ``workers`` (see :mod:`mdf_matio.scheduling`)
+        isolation (Isolation): Limits on the time and memory of each new or changed task
+            (see :mod:`mdf_matio.isolation`)
+    Yields:
+        (ParseResult) Results of each successful task
+    """
+    tasks = list(tasks)
+    contexts = contexts or {}
+    # Results are also out of date once the parser, its adapter or this package change
+    context_hashes = dict((name, _hash_context([contexts.get(name), *get_versions(name),
+                                                __version__]))
+                          for name in set(x.parser for x in tasks))
+
+    with ParseManifest(manifest_path, use_hash=use_hash) as manifest:
+        # Determine which tasks must be run again
+        is_current = [manifest.is_current(task, context_hashes[task.parser]) for task in tasks]
+        stale_tasks = [task for task, current in zip(tasks, is_current) if not current]
+        logger.info(f'Re-using {len(tasks) - len(stale_tasks)} results. '
+                    f'Running {len(stale_tasks)} tasks')
+
+        # Combine the stored and new results, in task order
+        new_results = execute_tasks(stale_tasks, contexts, workers=workers, stats=stats,
+                                    cache=cache, schedule=schedule, isolation=isolation,
+                                    keep_failures=True)
+        for i, (task, current) in enumerate(zip(tasks, is_current)):
+            if current:
+                result = manifest.load(task)
+            else:
+                result = next(new_results)
+                if isinstance(result, TaskFailure):
+                    # The failure may not recur, so leave the task to be run again
+                    result = None
+                else:
+                    manifest.store(task, context_hashes[task.parser], result)
+            if (i + 1) % commit_interval == 0:
+                manifest.commit()
+            if result is not None:
+                yield result
+        manifest.finish()
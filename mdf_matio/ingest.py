@@ -0,0 +1,266 @@
+"""Send records to a Globus Search index in bulk
+
+Records are grouped into GMetaList ingest documents holding at most a fixed number of records
+and bytes, and sent over a single HTTP session that keeps its connections open between requests.
+Several batches may be in flight at once, and failed requests are retried with exponential
+backoff. Records are only read from the input once a batch can be sent,
+so a slow index applies backpressure to the generator producing the records
+and the number of records held in memory stays bounded.
+
+Example::
+
+    client = SearchIngestClient(index_id, authorizer=authorizer)
+    summary = client.ingest(generate_search_index('/path/to/data'))
+"""
+
+from mdf_matio.output import DEFAULT_SHARD_BYTES
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from mdf_toolbox import format_gmeta
+from requests.adapters import HTTPAdapter
+import requests
+import logging
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEARCH_URL = 'https://search.api.globus.org'
+"""Address of the Globus Search API"""
+
+DEFAULT_BATCH_RECORDS = 1000
+"""Default largest number of records in a batch"""
+
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+"""HTTP status codes of requests that are retried"""
+
+
+class IngestError(Exception):
+    """A batch of records could not be ingested"""
+    pass
+
+
+class IngestBatch(NamedTuple):
+    """Ingest document for a batch of records"""
+
+    index: int
+    """Position of the batch in the order batches were made"""
+    records: int
+    """Number of records in the batch"""
+    body: bytes
+    """Serialized GMetaList ingest document"""
+
+
+def default_subject(record: dict) -> str:
+    """Get the subject of a record in the search index
+
+    Args:
+        record (dict): Validated record
+    Returns:
+        (str) Subject made from the source ID and scroll ID of the record
+    """
+    return '{}.{}'.format(record['mdf']['source_id'], record['mdf']['scroll_id'])
+
+
+def _gmeta_wrapper() -> Tuple[bytes, bytes]:
+    """Get the serialized start and end of a GMetaList ingest document"""
+    document = json.dumps(format_gmeta([]), separators=(',', ':'))
+    head, tail = document.split('"gmeta":[]')
+    return (head + '"gmeta":[').encode(), (']' + tail).encode()
+
+
+def make_batches(records: Iterable[dict], max_bytes: int = DEFAULT_SHARD_BYTES,
+                 max_records: Optional[int] = DEFAULT_BATCH_RECORDS,
+                 subject: Callable[[dict], str] = default_subject) -> Iterator[IngestBatch]:
+    """Group records into GMetaList ingest documents
+
+    Records are read from the input only as the batches are consumed.
+
+    Args:
+        records ([dict]): Validated records, each with an ``mdf.acl`` field
+        max_bytes (int): Largest size of the body of a batch, in bytes.
+            A record too large for this limit is placed in a batch of its own
+        max_records (int): Largest number of records in a batch. ``None`` for no limit
+        subject (Callable): Function that gets the subject of a record
+    Yields:
+        (IngestBatch) Batches of records
+    """
+    head, tail = _gmeta_wrapper()
+    overhead = len(head) + len(tail)
+    entries = []
+    size = overhead
+    index = 0
+    for record in records:
+        entry = format_gmeta({}, record['mdf']['acl'], subject(record))
+        entry['content'] = record
+        entry = json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+        # Send the current batch if this entry does not fit. Each entry after the first adds a comma
+        full = len(entries) > 0 and (
+            size + len(entry) + 1 > max_bytes
+            or (max_records is not None and len(entries) >= max_records))
+        if full:
+            yield IngestBatch(index, len(entries), head + b','.join(entries) + tail)
+            index += 1
+            entries = []
+            size = overhead
+        if overhead + len(entry) > max_bytes:
+            logger.warning(f'Record of {len(entry)} bytes is larger than the batch size limit')
+        size += len(entry) + (1 if len(entries) > 0 else 0)
+        entries.append(entry)
+    if len(entries) > 0:
+        yield IngestBatch(index, len(entries), head + b','.join(entries) + tail)
+
+
+class SearchIngestClient:
+    """Send batches of records to a Globus Search index
+
+    The client holds a pool of HTTP connections, which is re-used by each call to :meth:`ingest`.
+    Close the client, or use it as a context manager, to release the connections.
+    """
+
+    def __init__(self, index_id: str, base_url: str = DEFAULT_SEARCH_URL, authorizer=None,
+                 max_bytes: int = DEFAULT_SHARD_BYTES,
+                 max_records: Optional[int] = DEFAULT_BATCH_RECORDS,
+                 max_in_flight: int = 4, max_retries: int = 5, backoff: float = 0.5,
+                 max_backoff: float = 60, timeout: float = 120,
+                 subject: Callable[[dict], str] = default_subject):
+        """
+        Args:
+            index_id (str): ID of the search index
+            base_url (str): Address of the search service
+            authorizer: Object providing the ``Authorization`` header of each request through
+                a ``get_authorization_header()`` method, such as a Globus SDK authorizer.
+                Default is to send requests without authorization
+            max_bytes (int): Largest size of a batch, in bytes
+            max_records (int): Largest number of records in a batch. ``None`` for no limit
+            max_in_flight (int): Largest number of batches being sent at once
+            max_retries (int): Number of times a failed request is retried
+            backoff (float): Time to wait before the first retry, in seconds.
+                Doubles after each further retry
+            max_backoff (float): Longest time to wait before a retry, in seconds
+            timeout (float): Time to wait for a response to a request, in seconds
+            subject (Callable): Function that gets the subject of a record in the index
+        """
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self.url = '{}/v1/index/{}/ingest'.format(base_url.rstrip('/'), index_id)
+        self.authorizer = authorizer
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.subject = subject
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close the connections to the search service"""
+        self.session.close()
+
+    def _get_delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """Get the time to wait before retrying a request"""
+        if response is not None:
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except (KeyError, ValueError):
+                pass
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    def send_batch(self, batch: IngestBatch) -> dict:
+        """Send a single batch, retrying if the request fails
+
+        Args:
+            batch (IngestBatch): Batch to send
+        Returns:
+            (dict) Response from the search service, and the number of ``retries``
+        Raises:
+            (IngestError) If the batch is rejected, or still fails after all retries
+        """
+        attempt = 0
+        while True:
+            headers = {}
+            if self.authorizer is not None:
+                headers['Authorization'] = self.authorizer.get_authorization_header()
+            response = None
+            try:
+                response = self.session.post(self.url, data=batch.body, headers=headers,
+                                             timeout=self.timeout)
+                if response.status_code < 300:
+                    output = response.json() if len(response.content) > 0 else {}
+                    output['retries'] = attempt
+                    return output
+                error = f'HTTP {response.status_code}: {response.text[:512]}'
+                retry = response.status_code in RETRY_STATUS
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = str(exc)
+                retry = True
+
+            if not retry or attempt >= self.max_retries:
+                raise IngestError(f'Batch {batch.index} of {batch.records} records failed '
+                                  f'after {attempt + 1} attempts. {error}')
+            delay = self._get_delay(attempt, response)
+            logger.info(f'Batch {batch.index} failed ({error}). Retrying in {delay:.1f} s')
+            time.sleep(delay)
+            attempt += 1
+
+    def ingest(self, records: Iterable[dict]) -> dict:
+        """Send records to the search index
+
+        Args:
+            records ([dict]): Validated records, such as from
+                :func:`~mdf_matio.generate_search_index`
+        Returns:
+            (dict) Summary of the ingest: number of ``batches``, ``records``, ``bytes``
+            and ``retries``, and the ``task_ids`` reported by the search service
+        Raises:
+            (IngestError) If any batch fails. Batches already sent are not removed from the index
+        """
+        summary = {'batches': 0, 'records': 0, 'bytes': 0, 'retries': 0}
+        task_ids: List[str] = []
+
+        def collect(done):
+            for future in done:
+                batch, result = future.result()
+                summary['batches'] += 1
+                summary['records'] += batch.records
+                summary['bytes'] += len(batch.body)
+                summary['retries'] += result['retries']
+                if 'task_id' in result:
+                    task_ids.append(result['task_id'])
+
+        def send(batch):
+            return batch, self.send_batch(batch)
+
+        in_flight = set()
+        with ThreadPoolExecutor(self.max_in_flight, thread_name_prefix='mdf_matio-ingest') as pool:
+            try:
+                for batch in make_batches(records, self.max_bytes, self.max_records,
+                                          self.subject):
+                    # Wait for a batch to finish before reading more records
+                    while len(in_flight) >= self.max_in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    in_flight.add(pool.submit(send, batch))
+                done, in_flight = wait(in_flight)
+                collect(done)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                raise
+
+        summary['task_ids'] = task_ids
+        return summary
@@ -0,0 +1,361 @@
+"""Measure where an indexing job spends its time
+
+:class:`IndexingStats` collects, for each stage of :func:`~mdf_matio.generate_search_index`,
+the wall and CPU time spent in the stage, the number of records into and out of it and,
+for the grouping stages, the size of the largest group.
+When parsers are run as tasks (see :mod:`mdf_matio.execution`), it also records the number
+of calls and a latency histogram for each parser and its matching adapter and,
+with a :class:`~mdf_matio.scheduling.Schedule`, the queue depth and utilization of each pool.
+
+The latency of a task is the combined time to parse a group of files and adapt the result.
+MaterialsIO runs a parser and its adapter in a single call, so the two are not timed
+separately, and a parser and its adapter share one entry under ``parsers``.
+When the parsers are not run as tasks, MaterialsIO runs them all in one iterator and
+no statistics are recorded for each parser: their time is only counted in the ``parse`` stage.
+
+The stages are chained generators, so the time of a stage excludes the time spent
+waiting on the stages that feed it.
+CPU times only include work done in this process, not in worker processes.
+When no stats object is given, :func:`track_stage` and :func:`measure` return their
+inputs unchanged, so instrumentation costs nothing when it is off.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+import time
+
+_done = object()
+"""Marker for the end of an iterator"""
+
+
+class StageStats:
+    """Time spent and records processed by one stage"""
+
+    def __init__(self):
+        self.wall_time = 0.
+        """Wall time spent in the stage, in seconds"""
+        self.cpu_time = 0.
+        """CPU time spent in the stage by this process, in seconds"""
+        self.calls = 0
+        """Number of times the stage was entered"""
+        self.records_in = 0
+        """Number of records consumed by the stage"""
+        self.records_out = 0
+        """Number of records produced by the stage"""
+        self.max_size = 0
+        """Largest record produced by the stage, for stages that measure size"""
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class LatencyHistogram:
+    """Histogram of durations with logarithmically-spaced buckets"""
+
+    bounds = [1e-4 * 2 ** i for i in range(24)]
+    """Upper bound of each bucket, in seconds. The last bucket holds all longer durations"""
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration: float):
+        """Add a duration to the histogram
+
+        Args:
+            duration (float): Duration in seconds
+        """
+        self.counts[bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'bounds': list(self.bounds), 'counts': list(self.counts)}
+
+
+class ParserStats:
+    """Calls to one parser and its matching adapter"""
+
+    def __init__(self):
+        self.calls = 0
+        """Number of groups of files processed"""
+        self.results = 0
+        """Number of groups that produced metadata"""
+        self.skipped = 0
+        """Number of groups skipped for exceeding the limits of an isolated worker"""
+        self.latency = LatencyHistogram()
+        """Combined time to parse and adapt each group of files"""
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'results': self.results, 'skipped': self.skipped,
+                'latency': self.latency.to_dict()}
+
+
+class PoolStats:
+    """Queue depth and utilization of one pool of worker processes"""
+
+    def __init__(self, workers: int):
+        """
+        Args:
+            workers (int): Number of processes in the pool
+        """
+        self.workers = workers
+        """Number of processes in the pool"""
+        self.tasks = 0
+        """Number of tasks completed"""
+        self.busy_time = 0.
+        """Time the workers spent running tasks, in seconds"""
+        self.wall_time = 0.
+        """Time since the pool received its first task, in seconds"""
+        self.queue_depth = 0
+        """Number of tasks waiting for a worker"""
+        self.max_queue_depth = 0
+        """Largest number of tasks that waited for a worker"""
+        self.running = 0
+        """Number of tasks sent to the workers"""
+        self._queue_area = 0.
+        self._last_update = None
+
+    def update(self, queue_depth: int, running: int):
+        """Record the current state of the pool
+
+        Args:
+            queue_depth (int): Number of tasks waiting for a worker
+            running (int): Number of tasks sent to the workers
+        """
+        now = time.perf_counter()
+        if self._last_update is not None:
+            elapsed = now - self._last_update
+            self.wall_time += elapsed
+            self._queue_area += self.queue_depth * elapsed
+        elif queue_depth == 0 and running == 0:
+            return  # The pool has not been used yet
+        self._last_update = now
+        self.queue_depth = queue_depth
+        self.running = running
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_task(self, duration: float):
+        """Record a task completed by a worker
+
+        Args:
+            duration (float): Time to execute the task, in seconds
+        """
+        self.tasks += 1
+        self.busy_time += duration
+
+    def to_dict(self) -> dict:
+        capacity = self.workers * self.wall_time
+        return {'workers': self.workers, 'tasks': self.tasks, 'busy_time': self.busy_time,
+                'wall_time': self.wall_time,
+                'utilization': self.busy_time / capacity if capacity > 0 else 0.,
+                'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth,
+                'mean_queue_depth': self._queue_area / self.wall_time if self.wall_time > 0
+                else 0., 'running': self.running}
+
+
+class IndexingStats:
+    """Timing and counters for each stage of an indexing job
+
+    Pass an instance to :func:`~mdf_matio.generate_search_index` and read its contents
+    with :meth:`to_dict`, or provide a callback that receives them during and after the job.
+    """
+
+    def __init__(self, callback: Optional[Callable[[dict], None]] = None,
+                 report_interval: Optional[float] = None):
+        """
+        Args:
+            callback (callable): Function called with the output of :meth:`to_dict`
+                when the job finishes and, if ``report_interval`` is set, periodically during it
+            report_interval (float): Minimum time between periodic reports, in seconds
+        """
+        self.callback = callback
+        self.report_interval = report_interval
+        self.stages: Dict[str, StageStats] = {}
+        self.parsers: Dict[str, ParserStats] = {}
+        self.pools: Dict[str, PoolStats] = {}
+        self._stack: List[list] = []
+        self._last_report = time.perf_counter()
+
+    def get_stage(self, name: str) -> StageStats:
+        """Get the statistics for a stage, creating them if needed
+
+        Args:
+            name (str): Name of the stage
+        Returns:
+            (StageStats) Statistics for the stage
+        """
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats()
+        return stage
+
+    def _start(self, stage: StageStats):
+        self._stack.append([stage, time.perf_counter(), time.process_time(), 0., 0.])
+
+    def _stop(self):
+        stage, wall_start, cpu_start, child_wall, child_cpu = self._stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        stage.wall_time += wall - child_wall
+        stage.cpu_time += cpu - child_cpu
+        stage.calls += 1
+
+        # Remove this time from the stage that called this one
+        if len(self._stack) > 0:
+            self._stack[-1][3] += wall
+            self._stack[-1][4] += cpu
+
+    @staticmethod
+    def _count_inputs(stage: StageStats, source: Iterable) -> Iterator:
+        for item in source:
+            stage.records_in += 1
+            yield item
+
+    def stage(self, name: str, source: Iterable, transform: Optional[Callable] = None,
+              size: Optional[Callable] = None) -> Iterator:
+        """Measure a stage of a pipeline of generators
+
+        Args:
+            name (str): Name of the stage
+            source (iterable): Records produced by the stage or, if ``transform`` is provided,
+                records consumed by the stage
+            transform (callable): Function that takes an iterable of records and
+                produces the output of the stage
+            size (callable): Function that computes the size of each output record
+        Yields:
+            Records produced by the stage
+        """
+        stage = self.get_stage(name)
+        if transform is not None:
+            source = transform(self._count_inputs(stage, source))
+        iterator = iter(source)
+        while True:
+            self._start(stage)
+            try:
+                item = next(iterator, _done)
+            finally:
+                self._stop()
+            if item is _done:
+                return
+            stage.records_out += 1
+            if size is not None:
+                stage.max_size = max(stage.max_size, size(item))
+            if self.report_interval is not None:
+                self._maybe_report()
+            yield item
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[StageStats]:
+        """Measure a block of code as part of a stage
+
+        The caller is responsible for updating the record counts of the stage
+
+        Args:
+            name (str): Name of the stage
+        Yields:
+            (StageStats) Statistics for the stage
+        """
+        stage = self.get_stage(name)
+        self._start(stage)
+        try:
+            yield stage
+        finally:
+            self._stop()
+
+    def record_task(self, parser: str, duration: float, has_result: bool,
+                    skipped: bool = False):
+        """Record the execution of a parsing task
+
+        Args:
+            parser (str): Name of the parser and adapter
+            duration (float): Time to parse the files and adapt the result, in seconds
+            has_result (bool): Whether the task produced metadata
+            skipped (bool): Whether the task was stopped by :mod:`mdf_matio.isolation`
+        """
+        stats = self.parsers.get(parser)
+        if stats is None:
+            stats = self.parsers[parser] = ParserStats()
+        stats.calls += 1
+        stats.results += int(has_result)
+        stats.skipped += int(skipped)
+        stats.latency.add(duration)
+
+    def get_pool(self, name: str, workers: int) -> PoolStats:
+        """Get the statistics for a pool of workers, creating them if needed
+
+        Args:
+            name (str): Name of the pool
+            workers (int): Number of processes in the pool
+        Returns:
+            (PoolStats) Statistics for the pool
+        """
+        pool = self.pools.get(name)
+        if pool is None:
+            pool = self.pools[name] = PoolStats(workers)
+        return pool
+
+    def _maybe_report(self):
+        now = time.perf_counter()
+        if now - self._last_report >= self.report_interval:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        """Send the current statistics to the callback, if one is defined"""
+        if self.callback is not None:
+            self.callback(self.to_dict())
+
+    def to_dict(self) -> dict:
+        """Get the statistics as a dictionary
+
+        Returns:
+            (dict) Statistics of each stage, under ``stages``, each parser, under ``parsers``,
+                and each pool of workers of a :class:`~mdf_matio.scheduling.Schedule`,
+                under ``pools``
+        """
+        return {
+            'stages': dict((k, v.to_dict()) for k, v in self.stages.items()),
+            'parsers': dict((k, v.to_dict()) for k, v in self.parsers.items()),
+            'pools': dict((k, v.to_dict()) for k, v in self.pools.items())
+        }
+
+
+def track_stage(stats: Optional[IndexingStats], name: str, source: Iterable,
+                transform: Optional[Callable] = None, size: Optional[Callable] = None) \
+        -> Iterable:
+    """Measure a stage of a pipeline if statistics are being collected
+
+    See :meth:`IndexingStats.stage` for details
+
+    Args:
+        stats (IndexingStats): Statistics to update. If ``None``, nothing is measured
+        name (str): Name of the stage
+        source (iterable): Records produced or consumed by the stage
+        transform (callable): Function that produces the output of the stage from its inputs
+        size (callable): Function that computes the size of each output record
+    Returns:
+        (iterable) Records produced by the stage
+    """
+    if stats is None:
+        return source if transform is None else transform(source)
+    return stats.stage(name, source, transform, size)
+
+
+def measure(stats: Optional[IndexingStats], name: str):
+    """Measure a block of code if statistics are being collected
+
+    Args:
+        stats (IndexingStats): Statistics to update. If ``None``, nothing is measured
+        name (str): Name of the stage
+    Returns:
+        Context manager that yields the :class:`StageStats`, or ``None`` if not measuring
+    """
+    if stats is None:
+        return nullcontext()
+    return stats.measure(name)
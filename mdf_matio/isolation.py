@@ -0,0 +1,280 @@
+"""Run each parsing task in a worker process that can be stopped if the task misbehaves
+
+A single pathological file, such as a corrupted multi-GB image or a truncated output file
+that makes a parser loop forever, can otherwise stall or exhaust the memory of a whole
+indexing run. With an :class:`Isolation`, the parser and adapter for each group of files
+run in a separate worker process, one task at a time, and the worker is stopped if the task:
+
+- runs for longer than the ``timeout``
+- uses more memory (resident set size) than ``max_rss``
+- crashes the process
+
+The files of that task are skipped, and the task is recorded in :attr:`Isolation.skipped`
+along with the reason. A new worker takes its place. The limits may not be exceeded again,
+such as on a less busy node, so skipped tasks are not stored as producing no metadata
+by :mod:`mdf_matio.incremental` and are run again in the next run.
+Workers are also replaced after running ``max_tasks`` tasks, which limits the growth of
+memory from parsers that do not free it, and when they exceed ``max_rss`` between tasks.
+
+Results are produced in task order, as with :func:`~mdf_matio.execution.execute_tasks`.
+Memory use is read from ``/proc``, so ``max_rss`` is only enforced on Linux.
+
+Example::
+
+    isolation = Isolation(timeout=600, max_rss=8 * 1024 ** 3, max_tasks=1000)
+    records = list(generate_search_index('/path/to/data', workers=8, isolation=isolation))
+    for task, reason in isolation.skipped:
+        print(task.group, reason)
+"""
+
+from materials_io.utils.interface import ParseResult
+from mdf_matio.execution import ParseTask, TaskFailure, _has_result, _run_timed
+from mdf_matio.instrumentation import IndexingStats
+from multiprocessing.connection import Connection, wait
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Union
+from collections import deque
+from itertools import islice
+import multiprocessing
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class SkippedTask(NamedTuple):
+    """A task whose worker was stopped"""
+
+    task: ParseTask
+    """Task that was skipped"""
+    reason: str
+    """Why the worker was stopped"""
+
+
+def _get_rss(pid: int) -> Optional[int]:
+    """Get the resident set size of a process
+
+    Args:
+        pid (int): ID of the process
+    Returns:
+        (int) Resident set size in bytes, or ``None`` if it cannot be read
+    """
+    try:
+        with open(f'/proc/{pid}/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _worker_main(conn: Connection, contexts: Optional[dict], cache, max_tasks: Optional[int]):
+    """Run the tasks sent by the parent process until told to stop or the task limit is reached
+
+    Args:
+        conn (Connection): Connection to the parent process
+        contexts (dict): Context for each parser and adapter
+        cache (ParseCache): Cache of parse results
+        max_tasks (int): Number of tasks after which to exit
+    """
+    count = 0
+    while max_tasks is None or count < max_tasks:
+        message = conn.recv()
+        if message is None:
+            break
+        result, duration = _run_timed(message, contexts, cache)
+        conn.send((result, duration))
+        count += 1
+    conn.close()
+
+
+class _Worker:
+    """Worker process and the task it is running"""
+
+    def __init__(self, contexts: Optional[dict], cache, max_tasks: Optional[int]):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child_conn, contexts, cache, max_tasks),
+                                               daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0  # Number of tasks completed
+        self.index: Optional[int] = None  # Index of the task being run
+        self.task: Optional[ParseTask] = None
+        self.started = 0.  # Time the task was sent
+
+    def send(self, index: int, task: ParseTask):
+        self.index, self.task, self.started = index, task, time.perf_counter()
+        self.conn.send(task)
+
+    def stop(self, kill: bool = False):
+        """Stop the worker
+
+        Args:
+            kill (bool): Whether to stop the worker immediately, rather than letting it
+                finish its task
+        """
+        if not kill and self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Isolation:
+    """Limits on the time and memory used to parse each group of files"""
+
+    def __init__(self, timeout: Optional[float] = None, max_rss: Optional[int] = None,
+                 max_tasks: Optional[int] = None, poll_interval: float = 0.1,
+                 lookahead: int = 4096):
+        """
+        Args:
+            timeout (float): Longest time a task may run, in seconds. Default is no limit
+            max_rss (int): Largest resident set size of a worker, in bytes. Default is no limit
+            max_tasks (int): Number of tasks after which a worker is replaced.
+                Default is to keep workers for the whole run
+            poll_interval (float): Time between checks of the memory use of the workers,
+                in seconds
+            lookahead (int): Largest number of tasks in progress or holding a result
+                that waits on an earlier task
+        """
+        for name, value in [('timeout', timeout), ('max_rss', max_rss),
+                            ('max_tasks', max_tasks)]:
+            if value is not None and value <= 0:
+                raise ValueError(f'{name} must be positive')
+        if poll_interval <= 0 or lookahead < 1:
+            raise ValueError('Poll interval must be positive and lookahead at least 1 task')
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.max_tasks = max_tasks
+        self.poll_interval = poll_interval
+        self.lookahead = lookahead
+        self.skipped: List[SkippedTask] = []
+        """Tasks that were stopped, and why, from all runs"""
+
+    def _check_memory(self, worker: _Worker) -> Optional[str]:
+        """Get why a worker must be stopped for its memory use, if it must be"""
+        if self.max_rss is not None:
+            rss = _get_rss(worker.process.pid)
+            if rss is not None and rss > self.max_rss:
+                return f'Exceeded the memory limit of {self.max_rss} bytes, using {rss}'
+        return None
+
+    def _check(self, worker: _Worker, now: float) -> Optional[str]:
+        """Get why a worker must be stopped during its task, if it must be"""
+        if self.timeout is not None and now - worker.started > self.timeout:
+            return f'Exceeded the time limit of {self.timeout} s'
+        return self._check_memory(worker)
+
+    def execute(self, tasks: Iterable[ParseTask], contexts: Optional[dict] = None,
+                workers: int = 1, stats: Optional[IndexingStats] = None,
+                cache=None) -> Iterator[Union[ParseResult, TaskFailure, None]]:
+        """Execute parsing tasks in isolated worker processes
+
+        Args:
+            tasks ([ParseTask]): Tasks to be executed
+            contexts (dict): Context for each parser and adapter, keyed by parser name
+            workers (int): Number of worker processes
+            stats (IndexingStats): Statistics in which to record the execution time of each task
+            cache (ParseCache): Cache of results keyed by file contents
+                (see :mod:`mdf_matio.cache`)
+        Yields:
+            (ParseResult) Result of each task in task order, ``None`` if the task produced
+                no metadata or a :class:`~mdf_matio.execution.TaskFailure` if it was skipped
+                or failed for a reason that may not recur
+        """
+        if workers < 1:
+            raise ValueError('Number of workers must be at least 1')
+        if self.max_rss is not None and _get_rss(os.getpid()) is None:
+            logger.warning('Memory use cannot be measured on this system. '
+                           'The memory limit is not enforced')
+
+        tasks = iter(tasks)
+        queue = deque()  # Indices and tasks waiting for a worker
+        read = 0  # Number of tasks taken from the input
+        done = 0  # Number of results produced
+        results = {}  # Results waiting on an earlier task, keyed by task index
+        pool: List[Optional[_Worker]] = [None] * workers
+
+        def finish(worker: _Worker, result: Union[ParseResult, TaskFailure, None],
+                   duration: float, skipped: bool):
+            results[worker.index] = result
+            if stats is not None:
+                stats.record_task(worker.task.parser, duration, _has_result(result), skipped)
+            worker.index = worker.task = None
+
+        def skip(slot: int, reason: str):
+            worker = pool[slot]
+            logger.warning(f'Skipped {worker.task.group} with parser {worker.task.parser}: '
+                           f'{reason}')
+            self.skipped.append(SkippedTask(worker.task, reason))
+            worker.stop(kill=True)
+            finish(worker, TaskFailure(reason), time.perf_counter() - worker.started, True)
+            pool[slot] = None
+
+        try:
+            while True:
+                # Send tasks to the idle workers, replacing those that have stopped
+                for task in islice(tasks, self.lookahead - (read - done)):
+                    queue.append((read, task))
+                    read += 1
+                for slot, worker in enumerate(pool):
+                    if len(queue) == 0:
+                        break
+                    if worker is not None and worker.task is not None:
+                        continue
+                    if worker is None:
+                        worker = pool[slot] = _Worker(contexts, cache, self.max_tasks)
+                    worker.send(*queue.popleft())
+
+                # Produce the results that are ready, in order
+                if done in results:
+                    while done in results:
+                        yield results.pop(done)
+                        done += 1
+                    continue
+                busy = [w for w in pool if w is not None and w.task is not None]
+                if len(busy) == 0:
+                    return
+
+                # Wait for a worker to finish, or until it is time to check on them
+                timeout = self.poll_interval if self.max_rss is not None else None
+                if self.timeout is not None:
+                    now = time.perf_counter()
+                    deadline = min(w.started for w in busy) + self.timeout - now
+                    timeout = max(0., deadline if timeout is None else min(timeout, deadline))
+                ready = set(wait([w.conn for w in busy], timeout))
+
+                now = time.perf_counter()
+                for slot, worker in enumerate(pool):
+                    if worker is None or worker.task is None:
+                        continue
+                    if worker.conn in ready:
+                        try:
+                            result, duration = worker.conn.recv()
+                        except (EOFError, OSError):
+                            worker.process.join()  # The worker crashed
+                            skip(slot, f'Worker exited with code {worker.process.exitcode}')
+                            continue
+                        finish(worker, result, duration, False)
+                        worker.tasks += 1
+
+                        # Replace workers that reached their task limit or use too much memory
+                        if (self.max_tasks is not None and worker.tasks >= self.max_tasks) or \
+                                self._check_memory(worker) is not None:
+                            worker.stop()
+                            pool[slot] = None
+                        continue
+                    reason = self._check(worker, now)
+                    if reason is not None:
+                        skip(slot, reason)
+        finally:
+            for worker in pool:
+                if worker is not None:
+                    worker.stop(kill=worker.task is not None)
@@ -0,0 +1,215 @@
+"""Merge the metadata of many parse results in linear time
+
+Metadata are merged with the same rules as ``mdf_toolbox.dict_merge(..., append_lists=True)``
+applied left-to-right over a group: keys missing from the accumulated record are added,
+dictionaries are merged recursively, lists at the top level are extended with the values
+they do not already contain, and values of conflicting types are discarded.
+
+``reduce(dict_merge, ...)`` copies the whole accumulated record and scans every list once
+per merged item, so its cost grows with the square of the group size.
+:class:`MetadataMerger` instead updates one accumulator in place and tracks the contents
+of each top-level list in a hash set.
+"""
+
+from copy import deepcopy
+from typing import Iterable, Iterator, List
+
+_dict_tag = object()
+_list_tag = object()
+"""Markers for dictionaries and lists converted to hashable form"""
+
+_no_key = object()
+"""Marker for values that cannot be converted to hashable form"""
+
+_atomic_types = (str, int, float, bool, type(None))
+"""Types that are not copied"""
+
+
+def _copy(value):
+    """Copy a JSON-like value, faster than ``deepcopy`` for dictionaries and lists"""
+    value_type = type(value)
+    if value_type is dict:
+        return dict((k, _copy(v)) for k, v in value.items())
+    elif value_type is list:
+        return [_copy(v) for v in value]
+    elif value_type in _atomic_types:
+        return value
+    return deepcopy(value)
+
+
+def _freeze(value):
+    """Convert a value into a hashable object that is equal for equal values
+
+    Raises:
+        TypeError: If the value cannot be made hashable
+    """
+    value_type = type(value)
+    if value_type is dict:
+        return _dict_tag, frozenset((k, _freeze(v)) for k, v in value.items())
+    elif value_type is list:
+        return _list_tag, tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+class _ListIndex:
+    """Set of the values in a list, used to append only values not already in the list"""
+
+    def __init__(self, items: list):
+        """
+        Args:
+            items (list): List to be extended. Modified in place
+        """
+        self.items = items
+        self._keys = set()
+        self._unhashable = []  # Values that cannot be frozen are compared one by one
+        for item in items:
+            key = self._get_key(item)
+            if key is _no_key:
+                self._unhashable.append(item)
+            else:
+                self._keys.add(key)
+
+    @staticmethod
+    def _get_key(item):
+        """Get the hashable form of a value, or ``_no_key`` if it has none"""
+        try:
+            return _freeze(item)
+        except TypeError:
+            return _no_key
+
+    def extend(self, values: list):
+        """Append the values that are not already in the list
+
+        Args:
+            values (list): Values to be appended
+        """
+        for item in values:
+            key = self._get_key(item)
+            if key is _no_key:
+                # Compare to every item, as unhashable values may equal any type of value
+                if item in self.items:
+                    continue
+                self._unhashable.append(item)
+            elif key in self._keys or (len(self._unhashable) > 0 and item in self._unhashable):
+                continue
+            else:
+                self._keys.add(key)
+            self.items.append(_copy(item))
+
+
+def _merge_nested(base: dict, addition: dict):
+    """Merge a dictionary below the top level of a record, where lists are not merged
+
+    Args:
+        base (dict): Dictionary to be updated in place
+        addition (dict): Dictionary with additional data
+    """
+    for key, value in addition.items():
+        if key not in base:
+            base[key] = _copy(value)
+        else:
+            current = base[key]
+            if isinstance(value, dict) and isinstance(current, dict):
+                _merge_nested(current, value)
+
+
+class MetadataMerger:
+    """Accumulate the merged metadata of many records
+
+    The result never shares lists or dictionaries with the merged records,
+    which are not modified
+    """
+
+    def __init__(self, base: dict):
+        """
+        Args:
+            base (dict): Metadata of the first record. Takes precedence over all later records
+        """
+        if not isinstance(base, dict):
+            raise TypeError('Only dictionaries can be merged')
+        self.result = _copy(base)
+        self._indices = {}
+
+    def add(self, addition: dict):
+        """Merge the metadata of another record into the result
+
+        Args:
+            addition (dict): Metadata to be merged
+        """
+        if not isinstance(addition, dict):
+            raise TypeError('Only dictionaries can be merged')
+        result = self.result
+        for key, value in addition.items():
+            if key not in result:
+                result[key] = _copy(value)
+                continue
+
+            current = result[key]
+            if isinstance(value, dict) and isinstance(current, dict):
+                _merge_nested(current, value)
+            elif isinstance(value, list) and isinstance(current, list):
+                index = self._indices.get(key)
+                if index is None or index.items is not current:
+                    index = self._indices[key] = _ListIndex(current)
+                index.extend(value)
+
+
+def merge_metadata(metadata: Iterable[dict]) -> dict:
+    """Merge the metadata of many records
+
+    Equivalent to ``reduce(partial(dict_merge, append_lists=True), metadata)``,
+    but takes time proportional to the total size of the metadata
+
+    Args:
+        metadata ([dict]): Metadata to be merged. Earlier records take precedence
+    Returns:
+        (dict) Merged metadata
+    """
+    metadata = iter(metadata)
+    merger = MetadataMerger(next(metadata))
+    for addition in metadata:
+        merger.add(addition)
+    return merger.result
+
+
+def broadcast_metadata(rows: List[dict], addition: dict) -> List[dict]:
+    """Merge the same metadata into each record from a list-type record
+
+    Args:
+        rows ([dict]): Records to be extended
+        addition (dict): Metadata to add to each record
+    Returns:
+        ([dict]) New records, which share no lists or dictionaries with each other
+    """
+    output = []
+    for row in rows:
+        merger = MetadataMerger(row)
+        merger.add(addition)
+        output.append(merger.result)
+    return output
+
+
+class BroadcastRecords:
+    """Records from list-type metadata, each merged with the same metadata
+    as it is iterated over
+
+    Used for list-type metadata that makes its records lazily, such as
+    :class:`~mdf_matio.adapters.mappable.CSVRecords`, so that the records are not all
+    held in memory at once
+    """
+
+    def __init__(self, rows: Iterable[dict], addition: dict):
+        """
+        Args:
+            rows ([dict]): Records to be extended
+            addition (dict): Metadata to add to each record
+        """
+        self.rows = rows
+        self.addition = addition
+
+    def __iter__(self) -> Iterator[dict]:
+        for row in self.rows:
+            merger = MetadataMerger(row)
+            merger.add(self.addition)
+            yield merger.result
@@ -0,0 +1,303 @@
+"""Write validated records to sharded NDJSON files
+
+Records are written as newline-delimited JSON to a series of shards, each holding at most
+a fixed number of bytes of (uncompressed) JSON so that a shard fits within a single
+Globus Search ingest request. Shards may be compressed with gzip.
+
+Records are serialized as they are written, so later changes to a record, such as the
+dataset entry whose aggregates are updated as records are validated, do not change the output.
+Compression and file I/O happen in a background thread,
+so they overlap with parsing and validation in the thread producing the records.
+Serialized records pass to the writer through a bounded queue, which keeps memory use constant
+for any number of records.
+
+Once all records are written, a manifest listing each shard is saved in the output directory::
+
+    {"format": "ndjson", "compression": "gzip", "record_count": 2500, "total_bytes": ...,
+     "shards": [{"path": "records-00000.ndjson.gz", "records": 1200, "bytes": ...,
+                 "size": ...}, ...]}
+"""
+
+from typing import Iterable, Iterator, List, Optional
+from threading import Thread
+from queue import Queue, Full
+import logging
+import json
+import gzip
+import os
+
+logger = logging.getLogger(__name__)
+
+GLOBUS_INGEST_LIMIT = 10 * 1000 * 1000
+"""Largest request accepted by the Globus Search ingest API, in bytes"""
+
+DEFAULT_SHARD_BYTES = 9 * 1000 * 1000
+"""Default size limit of a shard, in bytes of JSON. Leaves room for the GMetaList
+that wraps the records when they are ingested"""
+
+MANIFEST_NAME = 'manifest.json'
+"""Name of the manifest file in the output directory"""
+
+_stop = object()
+"""Marker placed in the queue when no more records will be written"""
+
+
+class ShardedWriter:
+    """Write records to size-bounded NDJSON shards from a background thread
+
+    Use as a context manager, or call :meth:`close` once all records are written.
+    The manifest is only saved if every record was written successfully.
+    Shards are written with a ``.part`` suffix, which is removed once the shard is complete.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_SHARD_BYTES,
+                 max_records: Optional[int] = None, compress: bool = True,
+                 compresslevel: int = 6, prefix: str = 'records',
+                 batch_size: int = 256, queue_size: int = 8):
+        """
+        Args:
+            directory (str): Directory in which to write the shards. Created if it does not exist.
+                Shards from earlier runs with the same names are overwritten
+            max_bytes (int): Largest size of a shard, in bytes of uncompressed JSON.
+                A record larger than this limit is written to a shard of its own
+            max_records (int): Largest number of records in a shard. Default is no limit
+            compress (bool): Whether to compress the shards with gzip
+            compresslevel (int): Compression level used by gzip
+            prefix (str): Start of the name of each shard
+            batch_size (int): Number of serialized records sent to the writer thread at a time
+            queue_size (int): Number of batches that can wait for the writer thread.
+                Together with ``batch_size``, sets the number of records held in memory
+        """
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be positive')
+        if max_records is not None and max_records <= 0:
+            raise ValueError('max_records must be positive')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.prefix = prefix
+        self.batch_size = batch_size
+
+        self.shards: List[dict] = []
+        """Description of each completed shard"""
+        self.manifest: Optional[dict] = None
+        """Manifest of the output, set once the writer is closed"""
+
+        os.makedirs(directory, exist_ok=True)
+        self._batch = []
+        self._queue = Queue(maxsize=queue_size)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+
+        # State of the shard being written, used only by the writer thread
+        self._fp = None
+        self._shard_records = 0
+        self._shard_bytes = 0
+
+        self._thread = Thread(target=self._run, name='mdf_matio-writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def record_count(self) -> int:
+        """Number of records in the completed shards"""
+        return sum(x['records'] for x in self.shards)
+
+    def write(self, record: dict):
+        """Add a record to the output
+
+        Args:
+            record (dict): Record to be written. Serialized immediately, so it may be
+                modified afterwards
+        """
+        if self._closed:
+            raise ValueError('Writer is closed')
+        self._batch.append((json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+                           .encode('utf-8'))
+        if len(self._batch) >= self.batch_size:
+            self._send(self._batch)
+            self._batch = []
+
+    def write_all(self, records: Iterable[dict]) -> dict:
+        """Write all records from an iterable, such as :func:`~mdf_matio.generate_search_index`,
+        and then close the writer
+
+        Args:
+            records ([dict]): Records to be written
+        Returns:
+            (dict) Manifest of the output
+        """
+        try:
+            for record in records:
+                self.write(record)
+        except BaseException:
+            self.abort()
+            raise
+        return self.close()
+
+    def close(self) -> dict:
+        """Write the remaining records, wait for the writer thread and save the manifest
+
+        Returns:
+            (dict) Manifest of the output
+        Raises:
+            Any exception raised while writing the records
+        """
+        if self._closed:
+            if self._error is not None:
+                raise self._error
+            return self.manifest
+        if len(self._batch) > 0:
+            self._send(self._batch)
+            self._batch = []
+        self._send(_stop)
+        self._closed = True
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        self.manifest = {
+            'format': 'ndjson',
+            'compression': 'gzip' if self.compress else None,
+            'record_count': self.record_count,
+            'total_bytes': sum(x['bytes'] for x in self.shards),
+            'max_bytes': self.max_bytes,
+            'shards': self.shards,
+        }
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        with open(path + '.part', 'w') as fp:
+            json.dump(self.manifest, fp, indent=2)
+        os.replace(path + '.part', path)
+        return self.manifest
+
+    def abort(self):
+        """Stop the writer thread without saving the manifest
+
+        Shards completed before the writer stops are left in the output directory
+        """
+        if self._closed:
+            return
+        self._batch = []
+        try:
+            self._send(_stop)
+        except BaseException:
+            pass  # The writer thread has already stopped
+        self._closed = True
+        self._thread.join()
+
+    def _send(self, item):
+        """Put an item in the queue, unless the writer thread has failed"""
+        while True:
+            if self._error is not None:
+                self._closed = True
+                raise self._error
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _run(self):
+        """Write the records from the queue until the stop marker is received"""
+        try:
+            while True:
+                batch = self._queue.get()
+                if batch is _stop:
+                    break
+                self._write_batch(batch)
+            self._finish_shard()
+        except BaseException as exc:
+            self._error = exc
+            if self._fp is not None:
+                self._fp.close()
+                os.unlink(self._fp.name)
+                self._fp = None
+
+    def _write_batch(self, lines: List[bytes]):
+        """Write serialized records to the shards, starting new shards as needed"""
+        pending = []
+        for line in lines:
+            size = len(line)
+            full = self._shard_records > 0 and (
+                self._shard_bytes + size > self.max_bytes
+                or (self.max_records is not None and self._shard_records >= self.max_records))
+            if full:
+                self._fp.write(b''.join(pending))
+                pending = []
+                self._finish_shard()
+            if self._fp is None:
+                self._start_shard()
+            if size > self.max_bytes:
+                logger.warning(f'Record of {size} bytes is larger than the shard size limit')
+            pending.append(line)
+            self._shard_records += 1
+            self._shard_bytes += size
+        if len(pending) > 0:
+            self._fp.write(b''.join(pending))
+
+    def _shard_name(self) -> str:
+        suffix = '.ndjson.gz' if self.compress else '.ndjson'
+        return f'{self.prefix}-{len(self.shards):05d}{suffix}'
+
+    def _start_shard(self):
+        path = os.path.join(self.directory, self._shard_name() + '.part')
+        if self.compress:
+            self._fp = gzip.GzipFile(path, 'wb', compresslevel=self.compresslevel, mtime=0)
+        else:
+            self._fp = open(path, 'wb')
+        self._shard_records = 0
+        self._shard_bytes = 0
+
+    def _finish_shard(self):
+        """Close the current shard and add it to the list of shards"""
+        if self._fp is None:
+            return
+        self._fp.close()
+        name = self._shard_name()
+        path = os.path.join(self.directory, name)
+        os.replace(path + '.part', path)
+        self.shards.append({'path': name, 'records': self._shard_records,
+                            'bytes': self._shard_bytes, 'size': os.path.getsize(path)})
+        self._fp = None
+
+
+def write_shards(records: Iterable[dict], directory: str, **kwargs) -> dict:
+    """Write records to NDJSON shards
+
+    Args:
+        records ([dict]): Records to write, such as the output of
+            :func:`~mdf_matio.generate_search_index`
+        directory (str): Directory in which to write the shards
+        **kwargs: Options for :class:`ShardedWriter`
+    Returns:
+        (dict) Manifest of the output
+    """
+    return ShardedWriter(directory, **kwargs).write_all(records)
+
+
+def read_shards(directory: str) -> Iterator[dict]:
+    """Read the records from the shards listed in the manifest of a directory
+
+    Args:
+        directory (str): Directory holding the shards and manifest
+    Yields:
+        (dict) Each record, in the order they were written
+    """
+    with open(os.path.join(directory, MANIFEST_NAME)) as fp:
+        manifest = json.load(fp)
+    for shard in manifest['shards']:
+        path = os.path.join(directory, shard['path'])
+        opener = gzip.open if manifest['compression'] == 'gzip' else open
+        with opener(path, 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                yield json.loads(line)
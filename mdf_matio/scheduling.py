@@ -0,0 +1,237 @@
+"""Run parsing tasks in separate pools of workers for each kind of parser
+
+Parsers differ in cost by orders of magnitude: some take microseconds per file, others,
+such as those for DFT calculations or electron microscopy, take seconds.
+In a single stream of tasks, cheap tasks wait behind expensive ones.
+A :class:`Schedule` instead assigns each parser, and its matching adapter, to a named pool
+of worker processes sized for it, with:
+
+- a priority, which orders the tasks of parsers that share a pool
+- a limit on the number of its tasks that run at once, so that memory-hungry parsers
+  cannot use every worker of a pool
+
+Parsers that are not assigned a pool use the ``default`` pool.
+
+Results are produced in task order, as with :func:`~mdf_matio.execution.execute_tasks`.
+The pools work on tasks up to ``lookahead`` tasks past the oldest one without a result,
+which bounds the number of results held until the earlier tasks finish.
+
+When given an :class:`~mdf_matio.instrumentation.IndexingStats`, the schedule records
+the queue depth and utilization of each pool.
+
+Example::
+
+    schedule = Schedule(pools={'default': PoolConfig(workers=2, chunksize=64),
+                               'dft': PoolConfig(workers=6)},
+                        parsers={'dft': ParserPolicy(pool='dft', max_concurrency=4),
+                                 'image': ParserPolicy(pool='dft', priority=1)})
+    records = generate_search_index('/path/to/data', schedule=schedule)
+"""
+
+from materials_io.utils.interface import ParseResult
+from mdf_matio.execution import ParseTask, TaskFailure, _has_result, _run_chunk
+from mdf_matio.instrumentation import IndexingStats
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from collections import deque
+from itertools import islice
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL = 'default'
+"""Name of the pool used by parsers without a policy"""
+
+
+class PoolConfig(NamedTuple):
+    """Size of a pool of worker processes"""
+
+    workers: int = 1
+    """Number of processes in the pool"""
+    chunksize: int = 1
+    """Number of tasks of the same parser sent to a worker at a time"""
+
+
+class ParserPolicy(NamedTuple):
+    """How the tasks of a parser and its matching adapter are scheduled"""
+
+    pool: str = DEFAULT_POOL
+    """Name of the pool that runs the tasks"""
+    priority: int = 0
+    """Tasks of parsers with higher priorities are run first by a shared pool"""
+    max_concurrency: Optional[int] = None
+    """Largest number of tasks run at once. Default is to use every worker of the pool"""
+
+
+class _Pool:
+    """State of a pool of workers during a run"""
+
+    def __init__(self, name: str, config: PoolConfig):
+        self.name = name
+        self.config = config
+        self.queues: Dict[str, deque] = {}  # Indices and tasks waiting to run, by parser
+        self.queued = 0
+        self.running = 0  # Number of tasks sent to the workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def next_chunk(self, policies: Dict[str, ParserPolicy], in_flight: Dict[str, int]) \
+            -> Optional[Tuple[str, List[Tuple[int, ParseTask]]]]:
+        """Take the next tasks to send to the workers
+
+        Args:
+            policies (dict): Policy of each parser
+            in_flight (dict): Number of chunks of each parser sent to the workers
+        Returns:
+            - (str) Name of the parser
+            - ([(int, ParseTask)]) Indices and tasks to run,
+            or ``None`` if no parser has tasks that can run
+        """
+        best = None
+        for parser, queue in self.queues.items():
+            limit = policies[parser].max_concurrency
+            if len(queue) == 0 or (limit is not None and in_flight.get(parser, 0) >= limit):
+                continue
+            rank = (-policies[parser].priority, queue[0][0])
+            if best is None or rank < best[0]:
+                best = (rank, parser)
+        if best is None:
+            return None
+        parser = best[1]
+        queue = self.queues[parser]
+        chunk = [queue.popleft() for _ in range(min(self.config.chunksize, len(queue)))]
+        self.queued -= len(chunk)
+        return parser, chunk
+
+
+class Schedule:
+    """Assignment of parsers to pools of workers, with priorities and concurrency limits"""
+
+    def __init__(self, pools: Optional[Dict[str, PoolConfig]] = None,
+                 parsers: Optional[Dict[str, ParserPolicy]] = None, lookahead: int = 4096):
+        """
+        Args:
+            pools (dict): Size of each pool, keyed by name. A ``default`` pool with
+                one worker is added if not given
+            parsers (dict): Policy for each parser, keyed by parser name.
+                Parsers not listed run in the ``default`` pool with the default policy
+            lookahead (int): Largest number of tasks in progress or holding a result
+                that waits on an earlier task
+        """
+        self.pools = dict(pools or {})
+        self.pools.setdefault(DEFAULT_POOL, PoolConfig())
+        self.parsers = dict(parsers or {})
+        self.lookahead = lookahead
+
+        if lookahead < 1:
+            raise ValueError('Lookahead must be at least 1 task')
+        for name, config in self.pools.items():
+            if config.workers < 1 or config.chunksize < 1:
+                raise ValueError(f'Pool {name} must have at least one worker and chunk size 1')
+        for name, policy in self.parsers.items():
+            if policy.pool not in self.pools:
+                raise ValueError(f'Parser {name} is assigned to an undefined pool: {policy.pool}')
+            if policy.max_concurrency is not None and policy.max_concurrency < 1:
+                raise ValueError(f'Concurrency limit of parser {name} must be at least 1')
+
+    def get_policy(self, parser: str) -> ParserPolicy:
+        """Get the scheduling policy of a parser
+
+        Args:
+            parser (str): Name of the parser
+        Returns:
+            (ParserPolicy) Policy of the parser
+        """
+        return self.parsers.get(parser, ParserPolicy())
+
+    def execute(self, tasks: Iterable[ParseTask], contexts: Optional[dict] = None,
+                stats: Optional[IndexingStats] = None, cache=None) \
+            -> Iterator[Union[ParseResult, TaskFailure, None]]:
+        """Execute parsing tasks in the pools of their parsers
+
+        Args:
+            tasks ([ParseTask]): Tasks to be executed
+            contexts (dict): Context for each parser and adapter, keyed by parser name
+            stats (IndexingStats): Statistics in which to record the execution time of each
+                task and the use of each pool
+            cache (ParseCache): Cache of results keyed by file contents
+                (see :mod:`mdf_matio.cache`)
+        Yields:
+            (ParseResult) Result of each task in task order, ``None`` if the task produced
+                no metadata or a :class:`~mdf_matio.execution.TaskFailure` if it failed
+                for a reason that may not recur
+        """
+        pools = dict((name, _Pool(name, config)) for name, config in self.pools.items())
+        policies: Dict[str, ParserPolicy] = {}
+        pool_stats = {}
+        if stats is not None:
+            pool_stats = dict((name, stats.get_pool(name, pool.config.workers))
+                              for name, pool in pools.items())
+        tasks = iter(tasks)
+        read = 0  # Number of tasks taken from the input
+        done = 0  # Number of results produced
+        results = {}  # Results waiting on an earlier task, keyed by task index
+        futures: Dict[Future, Tuple[_Pool, str, List[Tuple[int, ParseTask]]]] = {}
+        in_flight: Dict[str, int] = {}  # Chunks sent to the workers for each parser
+
+        def update_stats():
+            for name, pool in pools.items():
+                if name in pool_stats:
+                    pool_stats[name].update(pool.queued, pool.running)
+
+        try:
+            while True:
+                # Queue the tasks within the lookahead window
+                for task in islice(tasks, self.lookahead - (read - done)):
+                    policy = policies.get(task.parser)
+                    if policy is None:
+                        policy = policies[task.parser] = self.get_policy(task.parser)
+                    pool = pools[policy.pool]
+                    pool.queues.setdefault(task.parser, deque()).append((read, task))
+                    pool.queued += 1
+                    read += 1
+
+                # Send tasks to the pools with free workers. Pools start when first needed
+                for pool in pools.values():
+                    while pool.running < pool.config.workers * pool.config.chunksize:
+                        chunk = pool.next_chunk(policies, in_flight)
+                        if chunk is None:
+                            break
+                        parser, chunk = chunk
+                        if pool.executor is None:
+                            logger.debug(f'Starting pool {pool.name} with '
+                                         f'{pool.config.workers} workers')
+                            pool.executor = ProcessPoolExecutor(max_workers=pool.config.workers)
+                        future = pool.executor.submit(_run_chunk, [x[1] for x in chunk],
+                                                      contexts, cache)
+                        futures[future] = (pool, parser, chunk)
+                        in_flight[parser] = in_flight.get(parser, 0) + 1
+                        pool.running += len(chunk)
+                update_stats()
+
+                # Produce the results that are ready, in order
+                if done in results:
+                    while done in results:
+                        yield results.pop(done)
+                        done += 1
+                    continue
+                if len(futures) == 0:
+                    return
+
+                # Wait for any pool to finish a chunk
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    pool, parser, chunk = futures.pop(future)
+                    in_flight[parser] -= 1
+                    pool.running -= len(chunk)
+                    for (index, task), (result, duration) in zip(chunk, future.result()):
+                        results[index] = result
+                        if stats is not None:
+                            stats.record_task(task.parser, duration, _has_result(result))
+                            pool_stats[pool.name].record_task(duration)
+        finally:
+            update_stats()
+            for future in futures:
+                future.cancel()
+            for pool in pools.values():
+                if pool.executor is not None:
+                    pool.executor.shutdown(wait=True)
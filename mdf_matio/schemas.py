@@ -0,0 +1,285 @@
+"""Local, persistent store of the MDF schemas
+
+The MDF schemas are fetched from GitHub and saved to a content-addressed
+cache on disk, which is shared by every process on a host.
+Schemas from a commit of the data-schemas repository never change, so they are fetched at most
+once. Schemas from a branch, such as ``master``, are fetched again once the stored copy is older
+than the ``max_age`` of the store. The stored copy is used if the store is offline
+or the schema cannot be fetched.
+The cache can also be filled from a local copy of the schemas, which allows validating
+and adapting records without any network access.
+"""
+
+from urllib.parse import urldefrag, urlsplit
+from urllib.request import urlopen
+from typing import Optional
+from threading import RLock
+import tempfile
+import logging
+import hashlib
+import json
+import time
+import re
+import os
+
+import jsonschema
+
+SCHEMA_URI_TEMPLATE = ("https://raw.githubusercontent.com/materials-data-facility/"
+                       "data-schemas/{}/schemas/")
+"""URI of the MDF schemas for a certain branch of the data-schemas repository"""
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+"""Default age, in seconds, after which schemas from a branch are fetched again"""
+
+logger = logging.getLogger(__name__)
+
+_commit_ref = re.compile(r"/[0-9a-f]{40}/")
+"""Part of a URI that names a commit, whose contents cannot change"""
+
+_cache_dir_env = "MDF_MATIO_SCHEMA_CACHE"
+_schema_dir_env = "MDF_MATIO_SCHEMA_DIR"
+_offline_env = "MDF_MATIO_OFFLINE"
+
+
+def get_schema_uri(schema_branch: Optional[str] = "master",
+                   schema_uri: Optional[str] = None) -> str:
+    """Get the base URI of the MDF schemas
+
+    Arguments:
+        schema_branch (str): The branch of the MDF data-schemas Github repository. Default "master".
+        schema_uri (str): The uri to the MDF schema location. Local and nonlocal locations
+                are supported. Supercedes ``schema_branch``
+
+    Returns:
+        str: The URI of the directory holding the schemas
+    """
+    # Generate URI from Github if branch supplied
+    if not schema_uri:
+        return SCHEMA_URI_TEMPLATE.format(schema_branch)
+    # If URI is bare file path, make into URI
+    elif os.path.exists(schema_uri):
+        return "{}{}{}".format("file://" if not schema_uri.startswith("file://") else "",
+                               os.path.abspath(schema_uri),
+                               "/" if schema_uri.endswith("/") else "")
+    return schema_uri
+
+
+class SchemaStore:
+    """Content-addressed cache of JSON schemas keyed by URI
+
+    Schemas are stored on disk as ``objects/<sha256 of content>.json``, and each URI is
+    mapped to its content by a file named ``uris/<sha256 of URI>``.
+    Schemas are looked up in memory, then on disk, and are only downloaded
+    if the store is not offline.
+    Schemas with a mutable URI, such as those from a branch, are downloaded again once
+    they are older than ``max_age``, including schemas added from a local copy.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, offline: Optional[bool] = None,
+                 max_age: Optional[float] = DEFAULT_MAX_AGE):
+        """
+        Arguments:
+            cache_dir (str): Directory holding the cache. Default is the
+                    ``MDF_MATIO_SCHEMA_CACHE`` environment variable, or
+                    ``~/.cache/mdf_matio/schemas`` if it is not set.
+            offline (bool): Whether to prevent downloading schemas. Default is True if the
+                    ``MDF_MATIO_OFFLINE`` environment variable is set to a non-empty value.
+            max_age (float): Age, in seconds, after which a schema with a mutable URI is
+                    downloaded again. Default one day. None to never download schemas again
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(_cache_dir_env) or \
+                os.path.join(os.path.expanduser("~"), ".cache", "mdf_matio", "schemas")
+        if offline is None:
+            offline = bool(os.environ.get(_offline_env))
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.max_age = max_age
+        self._schemas = {}  # Schema and the time it was stored, keyed by URI
+        self._preloaded = set()
+        self._lock = RLock()
+
+    def _uri_path(self, uri: str) -> str:
+        return os.path.join(self.cache_dir, "uris", hashlib.sha256(uri.encode()).hexdigest())
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, "objects", digest + ".json")
+
+    def is_fresh(self, uri: str, stored: float) -> bool:
+        """Determine whether data from a schema, or derived from it, is still current
+
+        Arguments:
+            uri (str): URI of the schema or of the directory holding it
+            stored (float): Time the data was stored, as from ``time.time()``
+
+        Returns:
+            bool: Whether the URI cannot change or the data is younger than ``max_age``
+        """
+        if self.max_age is None or urlsplit(uri).scheme not in ("http", "https") \
+                or _commit_ref.search(uri):
+            return True
+        return time.time() - stored < self.max_age
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        """Write a file such that other processes never see a partial copy"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(temp_path, path)
+
+    def add(self, uri: str, content: bytes) -> dict:
+        """Add a schema to the store
+
+        Arguments:
+            uri (str): URI of the schema
+            content (bytes): JSON document of the schema
+
+        Returns:
+            dict: The parsed schema
+        """
+        uri = urldefrag(uri)[0]
+        schema = json.loads(content.decode("utf-8"))
+        digest = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(self._object_path(digest)):
+            self._write_atomic(self._object_path(digest), content)
+        self._write_atomic(self._uri_path(uri), digest.encode())
+        with self._lock:
+            self._schemas[uri] = (schema, time.time())
+        return schema
+
+    def preload(self, directory: str, base_uri: str):
+        """Add every schema in a local directory to the store
+
+        Arguments:
+            directory (str): Path to a directory of ``.json`` schema files
+            base_uri (str): URI the schemas are stored under, e.g. the value of
+                    :func:`get_schema_uri` for the branch they were copied from
+        """
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json"):
+                with open(os.path.join(directory, name), "rb") as fp:
+                    self.add(base_uri + name, fp.read())
+
+    def get(self, uri: str) -> dict:
+        """Get a schema from the store, downloading it if needed and allowed
+
+        Arguments:
+            uri (str): URI of the schema. Any fragment is ignored
+
+        Returns:
+            dict: The schema
+        """
+        uri = urldefrag(uri)[0]
+        schema, stored = self._schemas.get(uri, (None, None))
+        if schema is not None and self.is_fresh(uri, stored):
+            return schema
+
+        # Read from disk, which another process may have updated
+        try:
+            path = self._uri_path(uri)
+            stored = os.stat(path).st_mtime
+            with open(path) as fp:
+                digest = fp.read().strip()
+            with open(self._object_path(digest), "rb") as fp:
+                content = fp.read()
+            schema = json.loads(content.decode("utf-8"))
+            with self._lock:
+                self._schemas[uri] = (schema, stored)
+            if self.is_fresh(uri, stored):
+                return schema
+        except FileNotFoundError:
+            pass
+
+        # Fetch from the network, falling back to an outdated copy
+        if self.offline:
+            if schema is not None:
+                return schema
+            raise LookupError("Schema {} is not in the store at {} and the store is offline"
+                              .format(uri, self.cache_dir))
+        try:
+            with urlopen(uri, timeout=60) as resp:
+                content = resp.read()
+        except OSError as exc:
+            if schema is None:
+                raise
+            logger.warning("Could not update schema {}, using the stored copy: {}"
+                           .format(uri, exc))
+            return schema
+        return self.add(uri, content)
+
+    def _artifact_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.cache_dir, "artifacts", "{}-{}.json".format(kind, key))
+
+    def load_artifact(self, kind: str, key: str):
+        """Load data derived from the schemas, such as a processed form of a schema
+
+        Arguments:
+            kind (str): Type of the data
+            key (str): Identifier for the data, which should change if the schemas change
+
+        Returns:
+            The data, or None if it has not been saved
+        """
+        try:
+            with open(self._artifact_path(kind, key)) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_artifact(self, kind: str, key: str, data):
+        """Save data derived from the schemas
+
+        Arguments:
+            kind (str): Type of the data
+            key (str): Identifier for the data
+            data: JSON-serializable data to save
+        """
+        self._write_atomic(self._artifact_path(kind, key), json.dumps(data).encode())
+
+    def get_resolver(self, base_uri: str) -> jsonschema.RefResolver:
+        """Make a resolver for schemas in the store
+
+        Arguments:
+            base_uri (str): URI of the directory holding the schemas
+
+        Returns:
+            jsonschema.RefResolver: Resolver that reads remote schemas through this store
+        """
+        handlers = {}
+        if urlsplit(base_uri).scheme in ("http", "https"):
+            handlers = {"http": self.get, "https": self.get}
+            self._preload_schema_dir(base_uri)
+        return jsonschema.RefResolver(base_uri, None, handlers=handlers)
+
+    def _preload_schema_dir(self, base_uri: str):
+        """Add the schemas from the directory given by ``MDF_MATIO_SCHEMA_DIR``, if set
+
+        That directory holds one subdirectory of schemas per data-schemas branch
+        """
+        schema_dir = os.environ.get(_schema_dir_env)
+        if not schema_dir:
+            return
+        with self._lock:
+            if base_uri in self._preloaded:
+                return
+            for branch in os.listdir(schema_dir):
+                if SCHEMA_URI_TEMPLATE.format(branch) == base_uri:
+                    self.preload(os.path.join(schema_dir, branch), base_uri)
+            self._preloaded.add(base_uri)
+
+
+_default_store = None
+
+
+def get_default_store() -> SchemaStore:
+    """Get the schema store shared by all components in this process
+
+    Returns:
+        SchemaStore: Store using the default cache directory
+    """
+    global _default_store
+    if _default_store is None:
+        _default_store = SchemaStore()
+    return _default_store
@@ -0,0 +1,310 @@
+"""Index a dataset with many nodes by splitting its parsing tasks into shards
+
+Indexing a dataset in shards has three steps:
+
+1. :func:`plan_shards` identifies the parsing tasks of the whole dataset, assigns each to a shard,
+   and saves the plan to storage shared by all nodes.
+2. Each node runs :func:`run_shard` for one shard, which parses the files of that shard and writes
+   the parse results, labeled with the position of their task in the plan, to the shared storage.
+3. One node runs :func:`reduce_shards`, which merges the parse results of all shards back into
+   the order of the tasks in the plan and then groups, merges and validates them exactly as
+   :func:`~mdf_matio.generate_search_index` does for tasks run in a single process.
+
+Because the reduce step sees the same parse results in the same order as a single process,
+groups of files that span shards are merged, scroll IDs are assigned in the same sequence,
+and the dataset size and file aggregates are computed by the same validator,
+so the records are identical to those of an unsharded run.
+
+Tasks are assigned to shards either by the top-level directory that holds them,
+which keeps each directory tree on one node, or by a hash of their directory,
+which balances shards when a few top-level directories hold most of the files.
+"""
+
+from materials_io.utils.interface import ParseResult
+from mdf_matio import _merge_directories, _merge_files, _validate_groups
+from mdf_matio.cache import ParseCache
+from mdf_matio.execution import ParseTask, _task_directory, identify_tasks, run_tasks
+from mdf_matio.incremental import run_incremental
+from mdf_matio.instrumentation import IndexingStats
+from mdf_matio.isolation import Isolation
+from mdf_matio.scheduling import Schedule
+from mdf_matio.validator import MDFValidator
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from heapq import merge
+import logging
+import hashlib
+import pickle
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+"""Version of the format of shard plans"""
+
+STRATEGIES = ('directory', 'hash')
+"""Ways of assigning tasks to shards"""
+
+
+def _top_directory(task: ParseTask, data_url: str) -> str:
+    """Get the directory directly below the root of the dataset that holds the files of a task.
+    Files at the root of the dataset are assigned to the root, an empty string"""
+    directory = os.path.sep.join(_task_directory(task.group))
+    relative = os.path.relpath(directory, data_url)
+    if relative == os.curdir or relative.startswith(os.pardir):
+        return ''
+    return relative.split(os.path.sep)[0]
+
+
+def assign_shards(tasks: List[ParseTask], n_shards: int, data_url: str,
+                  strategy: str = 'directory') -> List[int]:
+    """Assign each task to a shard
+
+    Args:
+        tasks ([ParseTask]): Tasks to be assigned
+        n_shards (int): Number of shards
+        data_url (str): Root directory of the dataset
+        strategy (str): How tasks are assigned to shards:
+            - ``directory``: All tasks in a top-level directory go to the same shard.
+              Directories are assigned, largest first, to the shard with the fewest tasks
+            - ``hash``: Tasks go to a shard chosen by a hash of their directory
+    Returns:
+        ([int]) Shard of each task
+    """
+    if n_shards < 1:
+        raise ValueError('Number of shards must be at least 1')
+    if strategy == 'hash':
+        def _hash(task):
+            # Hash the path relative to the dataset, so every node assigns the same shards
+            directory = os.path.relpath(os.path.sep.join(_task_directory(task.group)), data_url)
+            return int(hashlib.sha1(directory.encode()).hexdigest()[:8], 16) % n_shards
+        return [_hash(task) for task in tasks]
+    elif strategy != 'directory':
+        raise ValueError(f'Unknown sharding strategy: {strategy}. Options: {STRATEGIES}')
+
+    # Count the tasks in each top-level directory
+    top_dirs = [_top_directory(task, data_url) for task in tasks]
+    counts: Dict[str, int] = {}
+    for name in top_dirs:
+        counts[name] = counts.get(name, 0) + 1
+
+    # Give each directory, from the largest, to the least-loaded shard
+    loads = [0] * n_shards
+    owner = {}
+    for name, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+        shard = min(range(n_shards), key=lambda i: (loads[i], i))
+        owner[name] = shard
+        loads[shard] += count
+    return [owner[name] for name in top_dirs]
+
+
+class ShardPlan:
+    """Tasks of a dataset and the shard each belongs to"""
+
+    def __init__(self, data_url: str, tasks: List[ParseTask], shards: List[int], n_shards: int,
+                 strategy: str):
+        """
+        Args:
+            data_url (str): Root directory of the dataset
+            tasks ([ParseTask]): Tasks, in the order their results are merged
+            shards ([int]): Shard of each task
+            n_shards (int): Number of shards
+            strategy (str): Strategy used to assign the shards
+        """
+        self.data_url = data_url
+        self.tasks = tasks
+        self.shards = shards
+        self.n_shards = n_shards
+        self.strategy = strategy
+
+    def get_tasks(self, shard: int) -> List[Tuple[int, ParseTask]]:
+        """Get the tasks of one shard
+
+        Args:
+            shard (int): Index of the shard
+        Returns:
+            ([(int, ParseTask)]) Position of each task in the plan, and the task
+        """
+        return [(i, task) for i, (task, s) in enumerate(zip(self.tasks, self.shards))
+                if s == shard]
+
+    def save(self, path: str):
+        """Save the plan as JSON
+
+        Args:
+            path (str): Path to the plan
+        """
+        with open(path + '.part', 'w') as fp:
+            json.dump({'version': PLAN_VERSION, 'data_url': self.data_url,
+                       'n_shards': self.n_shards, 'strategy': self.strategy,
+                       'tasks': [[t.parser, list(t.group), s]
+                                 for t, s in zip(self.tasks, self.shards)]}, fp)
+        os.replace(path + '.part', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ShardPlan':
+        """Load a plan saved with :meth:`save`
+
+        Args:
+            path (str): Path to the plan
+        Returns:
+            (ShardPlan) The plan
+        """
+        with open(path) as fp:
+            data = json.load(fp)
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError(f'Unsupported shard plan version: {data.get("version")}')
+        tasks = [ParseTask(parser, tuple(group)) for parser, group, _ in data['tasks']]
+        shards = [shard for _, _, shard in data['tasks']]
+        return cls(data['data_url'], tasks, shards, data['n_shards'], data['strategy'])
+
+
+def plan_shards(data_url: str, parsers: Iterable[str], n_shards: int,
+                contexts: Optional[dict] = None, strategy: str = 'directory',
+                tasks: Optional[List[ParseTask]] = None) -> ShardPlan:
+    """Identify the tasks of a dataset and assign them to shards
+
+    Args:
+        data_url (str): Root directory of the dataset
+        parsers ([str]): Names of the parsers to run
+        n_shards (int): Number of shards
+        contexts (dict): Context for each parser, keyed by parser name
+        strategy (str): How tasks are assigned to shards (see :func:`assign_shards`)
+        tasks ([ParseTask]): Tasks to use instead of identifying them with the parsers.
+            Must be in the order of :func:`~mdf_matio.execution.identify_tasks`
+    Returns:
+        (ShardPlan) The plan
+    """
+    if tasks is None:
+        tasks = identify_tasks(data_url, parsers, contexts)
+    shards = assign_shards(tasks, n_shards, data_url, strategy)
+    plan = ShardPlan(data_url, list(tasks), shards, n_shards, strategy)
+    counts = [shards.count(i) for i in range(n_shards)]
+    logger.info(f'Assigned {len(tasks)} tasks to {n_shards} shards. Sizes: {counts}')
+    return plan
+
+
+def get_shard_path(output_dir: str, shard: int) -> str:
+    """Get the path of the results of a shard
+
+    Args:
+        output_dir (str): Directory holding the results of all shards
+        shard (int): Index of the shard
+    Returns:
+        (str) Path to the results
+    """
+    return os.path.join(output_dir, f'shard-{shard:05d}.pkl')
+
+
+def run_shard(plan: ShardPlan, shard: int, output_dir: str, contexts: Optional[dict] = None,
+              workers: int = 1, manifest_path: Optional[str] = None,
+              stats: Optional[IndexingStats] = None, cache: Optional[ParseCache] = None,
+              schedule: Optional[Schedule] = None, isolation: Optional[Isolation] = None) -> int:
+    """Parse the files of one shard and save the results
+
+    Results are written as they are produced, so memory use does not grow with the shard size.
+    The results file is only given its final name once every task has finished.
+
+    Args:
+        plan (ShardPlan): Plan for the whole dataset
+        shard (int): Index of the shard to run
+        output_dir (str): Directory, shared by all nodes, in which to write the results
+        contexts (dict): Context for each parser and adapter, keyed by parser name
+        workers (int): Number of processes to use on this node
+        manifest_path (str): Path to a manifest of the results of earlier runs of this shard
+            (see :mod:`mdf_matio.incremental`). Default is to run every task
+        stats (IndexingStats): Statistics in which to record the execution time of each task
+        cache (ParseCache): Cache of results keyed by file contents, which may be shared
+            by the nodes (see :mod:`mdf_matio.cache`)
+        schedule (Schedule): Pools of workers for each parser, used instead of ``workers``
+            (see :mod:`mdf_matio.scheduling`)
+        isolation (Isolation): Limits on the time and memory of each task
+            (see :mod:`mdf_matio.isolation`)
+    Returns:
+        (int) Number of parse results written
+    """
+    indexed_tasks = plan.get_tasks(shard)
+    positions = dict(((task.parser, task.group), i) for i, task in indexed_tasks)
+    tasks = [task for _, task in indexed_tasks]
+    if manifest_path is None:
+        results = run_tasks(tasks, contexts, workers=workers, stats=stats, cache=cache,
+                            schedule=schedule, isolation=isolation)
+    else:
+        results = run_incremental(tasks, manifest_path, contexts, workers=workers, stats=stats,
+                                  cache=cache, schedule=schedule, isolation=isolation)
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = get_shard_path(output_dir, shard)
+    count = 0
+    with open(path + '.part', 'wb') as fp:
+        for result in results:
+            position = positions[(result.parser, tuple(result.group))]
+            pickle.dump((position, result), fp, pickle.HIGHEST_PROTOCOL)
+            count += 1
+    os.replace(path + '.part', path)
+    logger.info(f'Shard {shard} produced {count} parse results from {len(tasks)} tasks')
+    return count
+
+
+def _read_shard(path: str) -> Iterator[Tuple[int, ParseResult]]:
+    """Read the results of a shard, in the order they were written"""
+    with open(path, 'rb') as fp:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
+
+
+def iter_shard_results(plan: ShardPlan, output_dir: str) -> Iterator[ParseResult]:
+    """Merge the results of every shard into the order of the tasks in the plan
+
+    Args:
+        plan (ShardPlan): Plan for the whole dataset
+        output_dir (str): Directory holding the results of all shards
+    Yields:
+        (ParseResult) Each parse result, in the same order as running the tasks in one process
+    Raises:
+        ValueError: If any shard has not finished
+    """
+    paths = [get_shard_path(output_dir, i) for i in range(plan.n_shards)]
+    missing = [i for i, path in enumerate(paths) if not os.path.isfile(path)]
+    if len(missing) > 0:
+        raise ValueError(f'Shards have not finished: {missing}')
+    for _, result in merge(*map(_read_shard, paths), key=lambda x: x[0]):
+        yield result
+
+
+def reduce_shards(plan: ShardPlan, output_dir: str, dataset_metadata: dict,
+                  validation_params: Optional[dict] = None, parse_config: Optional[dict] = None,
+                  vald: Optional[MDFValidator] = None, spill_threshold: Optional[int] = None,
+                  validation_batch_size: int = 256,
+                  stats: Optional[IndexingStats] = None) -> Iterator[dict]:
+    """Produce the records of a dataset from the results of all shards
+
+    Args:
+        plan (ShardPlan): Plan for the whole dataset
+        output_dir (str): Directory holding the results of all shards
+        dataset_metadata (dict): Metadata of the dataset
+        validation_params (dict): Additional validation configuration
+        parse_config (dict): Parsing options specific to certain directories,
+            as for :func:`~mdf_matio.generate_search_index`
+        vald (MDFValidator): Validator to use. Default is to validate against the MDF schemas
+        spill_threshold (int): Number of records the grouping steps hold in memory
+            before moving them to disk
+        validation_batch_size (int): Number of records validated together
+        stats (IndexingStats): Statistics to fill in with the time spent in each stage
+    Yields:
+        (dict) Dataset entry, and then the validated records
+    """
+    parse_results = iter_shard_results(plan, output_dir)
+    grouped_dirs = [path for path, cfg in (parse_config or {}).items()
+                    if cfg.get('group_by_directory', False)]
+    held = {}
+    parse_results = _merge_directories(parse_results, grouped_dirs, spill_threshold, stats,
+                                       ordered=True, held=held)
+    groups = _merge_files(parse_results, spill_threshold, stats, ordered=True, held=held)
+    if vald is None:
+        vald = MDFValidator(schema_branch='master')
+    yield from _validate_groups(groups, vald, dataset_metadata, validation_params,
+                                validation_batch_size, stats)
@@ -0,0 +1,199 @@
+"""Temporary on-disk storage for the parse results of large datasets
+
+The grouping operations must see every parse result before producing their first group.
+These classes keep the records in memory for small datasets and move them into a
+temporary SQLite database once the number of records passes a threshold,
+which keeps memory use roughly constant with respect to the size of a dataset.
+"""
+
+from materials_io.utils.interface import ParseResult
+from typing import Iterable, Iterator, List, Optional, Tuple
+from operator import itemgetter
+from itertools import groupby
+import tempfile
+import sqlite3
+import pickle
+import os
+
+DEFAULT_SPILL_THRESHOLD = 1000000
+"""Number of records held in memory before grouping operations move them to disk"""
+
+
+def _get_threshold(spill_threshold: Optional[int]) -> int:
+    """Get the spill threshold to use
+
+    Args:
+        spill_threshold (int): User-provided threshold. ``None`` to use the default
+    Returns:
+        (int) Number of records to hold in memory
+    """
+    return DEFAULT_SPILL_THRESHOLD if spill_threshold is None else spill_threshold
+
+
+class SQLiteStore:
+    """Temporary SQLite database holding records and the files they contain
+
+    Each record is stored with a sort key, which can be updated after all records are added.
+    The database file is deleted when the store is closed.
+    """
+
+    def __init__(self, directory: Optional[str] = None, cache_size: int = 16384):
+        """
+        Args:
+            directory (str): Directory in which to create the database.
+                Default is the system temporary directory
+            cache_size (int): Maximum size of the SQLite page cache, in kB
+        """
+        fd, self.path = tempfile.mkstemp(prefix='mdf_matio-', suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self._conn = sqlite3.connect(self.path)
+        # The data are temporary, so durability is not needed
+        self._conn.execute('PRAGMA journal_mode=OFF')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        self._conn.execute(f'PRAGMA cache_size=-{cache_size}')
+        self._conn.execute('CREATE TABLE records (id INTEGER PRIMARY KEY, key, data BLOB)')
+        self._conn.execute('CREATE TABLE files (path TEXT PRIMARY KEY, owner INTEGER)')
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, record: ParseResult, key=None) -> int:
+        """Add a record to the store
+
+        Args:
+            record (ParseResult): Record to be stored
+            key: Sort key for the record. Must be a type supported by SQLite
+        Returns:
+            (int) ID of the record, which are assigned sequentially starting at 0
+        """
+        my_id = self._count
+        self._conn.execute('INSERT INTO records VALUES (?, ?, ?)',
+                           (my_id, key, pickle.dumps(record, pickle.HIGHEST_PROTOCOL)))
+        self._count += 1
+        return my_id
+
+    def set_keys(self, keys: Iterable[Tuple[int, object]]):
+        """Update the sort keys of records
+
+        Args:
+            keys ([(int, key)]): Pairs of record ID and new key
+        """
+        self._conn.executemany('UPDATE records SET key = ? WHERE id = ?',
+                               ((key, my_id) for my_id, key in keys))
+
+    def claim_file(self, path: str, record_id: int) -> int:
+        """Mark a file as belonging to a record, if it is not already claimed
+
+        Args:
+            path (str): Path of the file
+            record_id (int): ID of the record claiming the file
+        Returns:
+            (int) ID of the first record to claim the file
+        """
+        row = self._conn.execute('SELECT owner FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            return row[0]
+        self._conn.execute('INSERT INTO files VALUES (?, ?)', (path, record_id))
+        return record_id
+
+    def iterate(self, ordered: bool = False) -> Iterator[Tuple[object, ParseResult]]:
+        """Iterate over the records in the store
+
+        Args:
+            ordered (bool): Whether to sort records by key. Records with equal keys,
+                or all records if ``ordered`` is False, are produced in the order they were added
+        Yields:
+            (key, ParseResult) Each record and its sort key
+        """
+        query = 'SELECT key, data FROM records ORDER BY {}'.format('key, id' if ordered else 'id')
+        for key, data in self._conn.execute(query):
+            yield key, pickle.loads(data)
+
+    def close(self):
+        """Close and delete the database"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            os.unlink(self.path)
+
+
+class RecordBuffer:
+    """List of records that moves to a temporary SQLite database once it grows too large
+
+    Records can be stored with a sort key and retrieved in groups of equal keys.
+    """
+
+    def __init__(self, spill_threshold: Optional[int] = None, directory: Optional[str] = None):
+        """
+        Args:
+            spill_threshold (int): Number of records to hold in memory before moving to disk.
+                Default is :data:`DEFAULT_SPILL_THRESHOLD`
+            directory (str): Directory in which to create the temporary database
+        """
+        self.spill_threshold = _get_threshold(spill_threshold)
+        self.directory = directory
+        self._records = []
+        self._store = None
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the records have been moved to disk"""
+        return self._store is not None
+
+    def __len__(self):
+        return len(self._store) if self.spilled else len(self._records)
+
+    def __iter__(self) -> Iterator[ParseResult]:
+        if self.spilled:
+            return map(itemgetter(1), self._store.iterate())
+        return map(itemgetter(1), self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, record: ParseResult, key=None):
+        """Add a record to the buffer
+
+        Args:
+            record (ParseResult): Record to be stored
+            key: Sort key used when grouping records
+        """
+        if not self.spilled and len(self._records) >= self.spill_threshold:
+            self._store = SQLiteStore(self.directory)
+            for my_key, my_record in self._records:
+                self._store.add(my_record, my_key)
+            self._records = None
+        if self.spilled:
+            self._store.add(record, key)
+        else:
+            self._records.append((key, record))
+
+    def groups(self) -> Iterator[List[ParseResult]]:
+        """Get the records grouped by their keys
+
+        Yields:
+            ([ParseResult]) Records with the same key, in the order of the sorted keys
+        """
+        if self.spilled:
+            sorted_data = self._store.iterate(ordered=True)
+        else:
+            sorted_data = sorted(self._records, key=itemgetter(0))
+        for key, group in groupby(sorted_data, key=itemgetter(0)):
+            yield [x[1] for x in group]
+
+    def close(self):
+        """Release the storage"""
+        if self.spilled:
+            self._store.close()
+        self._records = []
+        self._store = None
@@ -1,18 +1,19 @@
 """Tools for validating against MDF schema"""
 
-from jsonschema import Draft7Validator, RefResolver
+from jsonschema import Draft7Validator
+
+from mdf_matio.schemas import get_default_store, get_schema_uri
 
 
 # Make the schema resolver: Using a module-level variable to leverage RefResolvers' cache
-_schema_repo = "https://raw.githubusercontent.com/materials-data-facility/" \
-               "data-schemas/master/schemas/"
-_ref_resolver = RefResolver(_schema_repo, None)
+_ref_resolver = get_default_store().get_resolver(get_schema_uri("master"))
 
 
 def validate_against_mdf_schemas(document):
     """Validate a metadata record against the MDF record schema
 
-    Note: Requires an internet connection to GitHub
+    Note: Requires an internet connection to GitHub unless the schemas
+    are in the local schema store (see :mod:`mdf_matio.schemas`)
 
     Args:
         document (dict): Document instance to be validated
@@ -1,30 +1,106 @@
 from datetime import datetime
+from functools import lru_cache
+from math import isfinite
+from urllib.parse import urljoin, urlsplit
 import json
+import re
 
 import jsonschema
+from jsonschema.exceptions import best_match
 
+from mdf_matio.schemas import get_default_store, get_schema_uri
 
-def _remove_nulls(data, skip=None):
-    """Remove all null/None/empty values from a dict or list, except those listed in skip."""
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+_element_symbol = re.compile(r"[A-Z][a-z]*")
+
+
+@lru_cache(maxsize=4096)
+def _get_elements(composition):
+    """Get the element symbols in a composition, such as "Ca(OH)2" or "CuSO4·5H2O".
+
+    A symbol is an uppercase letter followed by any lowercase letters. Anything else
+    (numbers, parentheses, hydrate separators, whitespace, words like "and") is skipped.
+    Results are cached, as many records in a dataset share a composition.
+
+    Returns:
+        tuple of str: The unique symbols, sorted.
+    """
+    return tuple(sorted(set(_element_symbol.findall(composition))))
+
+
+def _check_json_value(value):
+    """Check that a value that is not a container or None is allowed in strict JSON.
+
+    Raises:
+        ValueError: If the value is a float that is NaN or infinite.
+        TypeError: If the value is not serializable as JSON.
+    """
+    if isinstance(value, float):
+        if not isfinite(value):
+            raise ValueError("Out of range float values are not JSON compliant: {}"
+                             .format(value))
+    elif not isinstance(value, (str, int)):
+        raise TypeError("Object of type {} is not JSON serializable"
+                        .format(type(value).__name__))
+
+
+def _sanitize(data, skip=None):
+    """Prepare a dict or list for ingestion in one pass, modifying it in place.
+
+    Removes all null/None values from dicts and lists, except dict values with a key
+    listed in skip, converts tuples to lists, and checks that every value is strict JSON.
+
+    Returns:
+        The sanitized data, which is the same object as `data` unless `data` is a tuple.
+
+    Raises:
+        ValueError: If the data contains NaN or infinite floats.
+        TypeError: If the data contains values that are not serializable as JSON.
+    """
     if isinstance(data, dict):
-        new_dict = {}
+        null_keys = []
         for key, val in data.items():
-            new_val = _remove_nulls(val, skip=skip)
-            if new_val is not None or (skip is not None and key in skip):
-                new_dict[key] = new_val
-        return new_dict
-    elif isinstance(data, list):
-        new_list = []
-        for val in data:
-            new_val = _remove_nulls(val, skip=skip)
-            if new_val is not None:
-                new_list.append(new_val)
-        return new_list
+            # bool is a subclass of int, so bool keys are allowed too
+            if key is not None and not isinstance(key, (str, int, float)):
+                raise TypeError("keys must be str, int, float, bool or None, not {}"
+                                .format(type(key).__name__))
+            val_type = type(val)
+            if val is None:
+                if skip is None or key not in skip:
+                    null_keys.append(key)
+            elif val_type is dict or val_type is list or isinstance(val, (dict, list, tuple)):
+                data[key] = _sanitize(val, skip)
+            elif val_type is not str and val_type is not int and val_type is not bool:
+                _check_json_value(val)
+        for key in null_keys:
+            del data[key]
+        return data
+    elif isinstance(data, (list, tuple)):
+        if isinstance(data, tuple):
+            data = list(data)
+        has_nulls = False
+        for i, val in enumerate(data):
+            val_type = type(val)
+            if val is None:
+                has_nulls = True
+            elif val_type is dict or val_type is list or isinstance(val, (dict, list, tuple)):
+                data[i] = _sanitize(val, skip)
+            elif val_type is not str and val_type is not int and val_type is not bool:
+                _check_json_value(val)
+        if has_nulls:
+            data[:] = [val for val in data if val is not None]
+        return data
     # Could delete required but empty blocks - services, etc.
     # elif hasattr(data, "__len__") and len(data) <= 0:
     #    return None
-    else:
-        return data
+    elif data is not None:
+        _check_json_value(data)
+    return data
 
 
 class ValidationError(Exception):
@@ -53,24 +129,133 @@ class MDFValidator():
         record_entry = vald_gen.send(r)
         record.entries.append(record_entry)
     vald_gen.send(None)
+    aggregates = vald_obj.finalize()
+    ```
+
+    Records can also be validated in batches, after the dataset entry is produced:
+
+    ```
+    record_entries = vald_obj.validate_records(records)
     ```
     """
-    def __init__(self, schema_branch="master"):
+    def __init__(self, schema_branch="master", backend="jsonschema", schema_store=None,
+                 file_list_path=None):
         """Create an MDFValidator.
 
         Arguments:
             schema_branch (str): The GitHub branch of the MDF schema to use in validation.
                     See https://github.com/materials-data-facility/data-schemas
+            backend (str): The library used to validate records.
+                    "jsonschema": Validate with the jsonschema library. Default.
+                    "fastjsonschema": Validate records with code generated by the
+                            fastjsonschema library, which must be installed.
+                            Records that fail are validated again with jsonschema
+                            to produce a detailed error message.
+            schema_store (SchemaStore): The store used to retrieve the MDF schemas.
+                    Default None, to use the store shared by the whole process.
+            file_list_path (str): Path of a file to which the file entries of every valid
+                    record are written, one JSON object per line. Default None, to keep
+                    only the dataset aggregates (see `finalize()`).
         """
+        if backend not in ("jsonschema", "fastjsonschema"):
+            raise ValueError("Unknown validation backend: '{}'".format(backend))
+        if backend == "fastjsonschema" and fastjsonschema is None:
+            raise ImportError("The fastjsonschema backend requires the fastjsonschema package")
         self.__dataset = None
         self.__scroll_id = None
         self.__ingest_date = datetime.utcnow().isoformat("T") + "Z"
-        self.__indexed_files = []
-        self.ref_resolver = jsonschema.RefResolver("https://raw.githubusercontent.com/materials-"
-                                                   "data-facility/data-schemas/{}/schemas/"
-                                                   .format(schema_branch), None)
+        self.__file_count = 0
+        self.__data_types = {}
+        self.__file_list_path = file_list_path
+        self.__file_list = None
+        self.__backend = backend
+        self.__validators = {}
+        schema_store = schema_store or get_default_store()
+        self.ref_resolver = schema_store.get_resolver(get_schema_uri(schema_branch))
+
+    def _get_validators(self, schema_name, batch=False):
+        """Get the validators for one of the MDF schemas.
+        Validators are built once per MDFValidator and reused for every document.
+        Not intended for calling directly.
 
-    def validate_mdf_dataset(self, ds_md, validation_info=None):
+        Arguments:
+            schema_name (str): The name of the schema file (e.g., "record.json").
+            batch (bool): Whether to get validators for a list of documents,
+                    each of which must match the schema. Default False.
+
+        Returns:
+            tuple: The jsonschema validator and, if the fastjsonschema backend is selected,
+                    the compiled validation function (otherwise None).
+        """
+        validators = self.__validators.get((schema_name, batch))
+        if validators is None:
+            _, schema = self.ref_resolver.resolve(schema_name)
+            # Check the schema only once, rather than for each document
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            schema_uri = urljoin(self.ref_resolver.resolution_scope, schema_name)
+            if batch:
+                schema = {"type": "array", "items": {"$ref": schema_uri}}
+            validator = cls(schema, resolver=self.ref_resolver)
+
+            compiled = None
+            if self.__backend == "fastjsonschema":
+                # Give the schema its URI so fastjsonschema can resolve relative $refs,
+                # and fetch referenced schemas through our resolver to share its cache
+                if not batch:
+                    schema = dict(schema, **{"$id": schema_uri})
+                handlers = {urlsplit(schema_uri).scheme: self.ref_resolver.resolve_from_url}
+                compiled = fastjsonschema.compile(schema, handlers=handlers, use_default=False,
+                                                  use_formats=False)
+            validators = (validator, compiled)
+            self.__validators[(schema_name, batch)] = validators
+        return validators
+
+    def _validate_schema(self, document, schema_name):
+        """Validate a document against one of the MDF schemas.
+        Not intended for calling directly.
+
+        Arguments:
+            document (dict): The document to validate.
+            schema_name (str): The name of the schema file (e.g., "record.json").
+
+        Raises:
+            jsonschema.ValidationError: If the document is invalid.
+        """
+        validator, compiled = self._get_validators(schema_name)
+        if compiled is not None:
+            try:
+                compiled(document)
+                return
+            except fastjsonschema.JsonSchemaException:
+                # Use jsonschema to produce the detailed error message
+                pass
+        error = best_match(validator.iter_errors(document))
+        if error is not None:
+            raise error
+
+    def _is_valid_batch(self, documents, schema_name):
+        """Check whether every document in a list matches one of the MDF schemas
+        with a single call to the validator.
+        Not intended for calling directly.
+
+        Arguments:
+            documents (list of dict): The documents to check.
+            schema_name (str): The name of the schema file (e.g., "record.json").
+
+        Returns:
+            bool: Whether all of the documents are valid.
+        """
+        validator, compiled = self._get_validators(schema_name, batch=True)
+        if compiled is not None:
+            try:
+                compiled(documents)
+                return True
+            except fastjsonschema.JsonSchemaException:
+                return False
+        return validator.is_valid(documents)
+
+    def validate_mdf_dataset(self, ds_md, validation_info=None, state=None):
         """Begin validating a new dataset against the MDF schema.
 
         This function is a generator. You must initialize it with the following arguments,
@@ -89,6 +274,9 @@ class MDFValidator():
                 allowed_nulls (list of str): Fields allowed to be null/empty. Default None.
                 base_acl (list of str): The ACL to set on entries. Default None,
                         which sets a public ACL.
+            state (dict): The state of an earlier, interrupted validation of the same dataset,
+                    from `get_state()`. Scroll IDs, the ingest date, the dataset aggregates
+                    and the file list continue from that state. Default None.
 
         Yields:
             dict: Validated MDF-format metadata, ready for Search ingestion.
@@ -101,18 +289,19 @@ class MDFValidator():
             None: Finish validating.
         """
         # Validate, save, and yield dataset
-        dataset = self._validate_dataset(ds_md, validation_info)
+        dataset = self._validate_dataset(ds_md, validation_info, state)
         self.__dataset = dataset
         # Fetch first record
         record = yield dataset
         # Process all records the user has
         while record is not None:
             record = yield self._validate_record(record)
+        self.finalize()
         # Yield once more to avoid forcing user to catch StopIteration
         # Effect is .send(None) returns None, which is logical
         yield
 
-    def _validate_dataset(self, ds_md, validation_info=None):
+    def _validate_dataset(self, ds_md, validation_info=None, state=None):
         """Validate a dataset entry.
         Not intended for calling directly.
 
@@ -125,6 +314,8 @@ class MDFValidator():
                 allowed_nulls (list of str): Fields allowed to be null/empty. Default None.
                 base_acl (list of str): The ACL to set on entries. Default None,
                         which sets a public ACL.
+            state (dict): The state from which to continue validating the dataset.
+                    Default None.
 
         Returns:
             dict: The validated dataset entry.
@@ -136,9 +327,6 @@ class MDFValidator():
         self.__allowed_nulls = validation_info.get("allowed_nulls", None)
         self.__base_acl = validation_info.get("base_acl", None)
 
-        # Load schema
-        _, schema = self.ref_resolver.resolve("dataset.json")
-
         # if not ds_md.get("dc") or not isinstance(ds_md["dc"], dict):
         #    ds_md["dc"] = {}
         if not ds_md.get("mdf") or not isinstance(ds_md["mdf"], dict):
@@ -155,8 +343,12 @@ class MDFValidator():
         self.__scroll_id = 0
         ds_md["mdf"]["scroll_id"] = self.__scroll_id
         self.__scroll_id += 1
+        if state is not None:
+            self.__scroll_id = state["scroll_id"]
 
         # ingest_date
+        if state is not None:
+            self.__ingest_date = state["ingest_date"]
         ds_md["mdf"]["ingest_date"] = self.__ingest_date
 
         # resource_type
@@ -182,6 +374,20 @@ class MDFValidator():
         # Data
         ds_md["data"] = ds_md.get("data", {})
         ds_md["data"]["total_size"] = 0
+        self.__file_count = 0
+        self.__data_types = {}
+        if state is not None:
+            ds_md["data"]["total_size"] = state["total_size"]
+            self.__file_count = state["file_count"]
+            self.__data_types = dict(state["data_types"])
+        if self.__file_list_path:
+            self.finalize()
+            if state is None:
+                self.__file_list = open(self.__file_list_path, "w")
+            else:
+                # Drop any entries written after the state was saved
+                self.__file_list = open(self.__file_list_path, "a")
+                self.__file_list.truncate(state.get("file_list_offset") or 0)
 
         # BLOCK: custom
         # Make all values into strings
@@ -191,19 +397,16 @@ class MDFValidator():
                 new_custom[key] = str(val)
             ds_md["custom"] = new_custom
 
-        # Require strict JSON
+        # Require strict JSON and remove null/None values
         try:
-            json.dumps(ds_md, allow_nan=False)
-        except (ValueError, json.JSONDecodeError) as e:
+            ds_md = _sanitize(ds_md, self.__allowed_nulls)
+        except ValueError as e:
             raise ValidationError("Dataset metadata is not valid JSON: {}"
                                   .format(str(e))) from e
 
-        # Remove null/None values
-        ds_md = _remove_nulls(ds_md, self.__allowed_nulls)
-
         # Validate against schema
         try:
-            jsonschema.validate(ds_md, schema, resolver=self.ref_resolver)
+            self._validate_schema(ds_md, "dataset.json")
         except jsonschema.ValidationError as e:
             raise ValidationError("Invalid dataset metadata: {}"
                                   .format(str(e).split("\n")[0])) from e
@@ -246,8 +449,127 @@ class MDFValidator():
                 raise ValidationError("Missing organization metadata: '{}' are required"
                                       .format(missing))
 
-        # Ensure dataset JSON-sanitized before return
-        return json.loads(json.dumps(ds_md))
+        # Dataset was JSON-sanitized in place above
+        return ds_md
+
+    def validate_records(self, records):
+        """Validate a batch of records against the MDF schema.
+
+        Equivalent to sending each record to the generator from `validate_mdf_dataset()`,
+        which must already have produced the dataset entry.
+        The MDF fields are added to each record and each record is sanitized in turn,
+        but the whole batch is then checked against the schema with one call to the validator
+        and the file list is written once for the batch.
+        Scroll IDs and the dataset size are assigned exactly as when records are sent
+        to the generator, including when a record in the batch fails validation.
+
+        Arguments:
+            records (list of dict): The records to validate.
+
+        Returns:
+            list of dict: The validated records, in the same order.
+
+        Raises:
+            ValidationError: If any record is invalid. The records before the invalid record
+                    are counted in the dataset. Records after it may have been modified.
+                    If validation stops with another exception once all records are
+                    sanitized, the dataset is left as it was before the batch.
+        """
+        self._require_dataset()
+        records = list(records)
+        start = self._get_counters()
+
+        # Add the MDF fields and sanitize each record, which stops at an invalid record
+        # with the dataset as the generator would leave it
+        states = []
+        for i, rc_md in enumerate(records):
+            records[i] = self._sanitize_record(self._prepare_record(rc_md))
+            states.append(self._get_counters())
+
+        # Validate the whole batch against the schema, and find the first invalid record
+        # only if there is one
+        try:
+            if not self._is_valid_batch(records, "record.json"):
+                for i, rc_md in enumerate(records):
+                    try:
+                        self._check_record(rc_md)
+                    except ValidationError:
+                        self._set_counters(states[i])
+                        self._write_file_list(records[:i])
+                        raise
+        except ValidationError:
+            raise
+        except BaseException:
+            self._set_counters(start)
+            raise
+        self._write_file_list(records)
+        return records
+
+    def _require_dataset(self):
+        """Ensure that a dataset has been started.
+        Not intended to be called directly."""
+        if not self.__dataset:
+            raise ValidationError("Dataset not started. Records cannot be validated without "
+                                  "a dataset. Call .validate_mdf_dataset() instead.")
+
+    def _get_counters(self):
+        """Get the counters that are updated as records are validated.
+        Not intended to be called directly."""
+        return (self.__scroll_id, self.__dataset["data"]["total_size"], self.__file_count,
+                dict(self.__data_types))
+
+    def _set_counters(self, counters):
+        """Restore the counters that are updated as records are validated.
+        Not intended to be called directly."""
+        (self.__scroll_id, self.__dataset["data"]["total_size"], self.__file_count,
+         self.__data_types) = counters
+
+    def get_state(self):
+        """Get the state of the dataset being validated, to continue validating it later.
+
+        Returns:
+            dict: The state, which can be serialized as JSON:
+                scroll_id (int): The scroll ID of the next record.
+                ingest_date (str): The ingest date of the dataset.
+                total_size, file_count, data_types: The dataset aggregates so far.
+                file_list_offset (int): The length of the file list, if one is written.
+        """
+        self._require_dataset()
+        scroll_id, total_size, file_count, data_types = self._get_counters()
+        file_list_offset = None
+        if self.__file_list is not None:
+            self.__file_list.flush()
+            file_list_offset = self.__file_list.tell()
+        return {
+            "scroll_id": scroll_id,
+            "ingest_date": self.__ingest_date,
+            "total_size": total_size,
+            "file_count": file_count,
+            "data_types": data_types,
+            "file_list_offset": file_list_offset
+        }
+
+    def finalize(self):
+        """Finish the dataset and get the aggregate statistics of its files.
+        Called automatically when None is sent to the `validate_mdf_dataset()` generator,
+        and may be called again at any time.
+
+        Returns:
+            dict: The dataset aggregates:
+                file_count (int): The number of files in all records.
+                total_size (int): The total length of those files, in bytes.
+                data_types (dict): The number of files of each data type.
+                file_list_path (str): The path of the file list, if one was requested.
+        """
+        if self.__file_list is not None:
+            self.__file_list.close()
+            self.__file_list = None
+        return {
+            "file_count": self.__file_count,
+            "total_size": self.__dataset["data"]["total_size"] if self.__dataset else 0,
+            "data_types": dict(self.__data_types),
+            "file_list_path": self.__file_list_path
+        }
 
     def _validate_record(self, rc_md):
         """Process and validate a record against the MDF schema.
@@ -259,12 +581,21 @@ class MDFValidator():
         Returns:
             dict: The validated record.
         """
-        if not self.__dataset:
-            raise ValidationError("Dataset not started. Records cannot be validated without "
-                                  "a dataset. Call .validate_mdf_dataset() instead.")
+        rc_md = self._prepare_record(rc_md)
+        rc_md = self._sanitize_record(rc_md)
+        return self._finish_record(rc_md)
+
+    def _prepare_record(self, rc_md):
+        """Add the dataset-level fields to a record and update the dataset.
+        Not intended to be called directly.
+
+        Arguments:
+            rc_md (dict): The record metadata to process.
 
-        # Load schema
-        _, schema = self.ref_resolver.resolve("record.json")
+        Returns:
+            dict: The processed record.
+        """
+        self._require_dataset()
 
         # Add any missing blocks
         if not rc_md.get("mdf"):
@@ -306,57 +637,90 @@ class MDFValidator():
             rc_md["mdf"]["organizations"] = self.__dataset["mdf"]["organizations"]
 
         # BLOCK: files
-        # Add file data to dataset
+        # Add file data to dataset aggregates
         if rc_md["files"]:
-            self.__indexed_files += rc_md["files"]
+            data_types = self.__data_types
             for f in rc_md["files"]:
                 self.__dataset["data"]["total_size"] += f.get("length", 0)
+                data_type = f.get("data_type")
+                if isinstance(data_type, str):
+                    data_types[data_type] = data_types.get(data_type, 0) + 1
+            self.__file_count += len(rc_md["files"])
 
         # BLOCK: material
         # elements
         if rc_md["material"].get("composition"):
-            composition = rc_md["material"]["composition"].replace("and", "")
-            str_of_elem = ""
-            for char in list(composition):
-                if char.isupper():  # Start of new element symbol
-                    str_of_elem += " " + char
-                elif char.islower():  # Continuation of symbol
-                    str_of_elem += char
-                # Anything else is not an element (numbers, whitespace, etc.)
-
-            # Split elements in string (on whitespace), make unique and JSON-serializable
-            list_of_elem = list(set(str_of_elem.split()))
-            # Ensure deterministic results
-            list_of_elem.sort()
-
-            rc_md["material"]["elements"] = list_of_elem
+            rc_md["material"]["elements"] = list(
+                _get_elements(rc_md["material"]["composition"]))
         elif rc_md["material"].get("elemental_proportions"):
             rc_md["material"]["elements"] = list(rc_md["material"]["elemental_proportions"].keys())
             rc_md["material"]["elements"].sort()
+        return rc_md
+
+    def _sanitize_record(self, rc_md):
+        """Convert custom values to strings, require strict JSON, and remove null values,
+        all in place and in a single pass over the record.
+        Not intended to be called directly.
 
+        Arguments:
+            rc_md (dict): The record metadata to sanitize.
+
+        Returns:
+            dict: The sanitized record.
+
+        Raises:
+            ValidationError: If the record contains values not allowed in JSON.
+        """
         # BLOCK: custom
         # Make all values into strings
         if rc_md.get("custom"):
-            new_custom = {}
-            for key, val in rc_md["custom"].items():
-                new_custom[key] = str(val)
-            rc_md["custom"] = new_custom
+            custom = rc_md["custom"]
+            for key, val in custom.items():
+                custom[key] = str(val)
 
-        # Require strict JSON
+        # Require strict JSON and remove null/None values
         try:
-            json.dumps(rc_md, allow_nan=False)
-        except (ValueError, json.JSONDecodeError) as e:
+            return _sanitize(rc_md, self.__allowed_nulls)
+        except ValueError as e:
             raise ValidationError("Record is not valid JSON: {}".format(str(e))) from e
 
-        # Remove null/None values
-        rc_md = _remove_nulls(rc_md, self.__allowed_nulls)
+    def _finish_record(self, rc_md):
+        """Validate a sanitized record against the MDF schema.
+        Not intended to be called directly.
 
-        # Validate against schema
+        Arguments:
+            rc_md (dict): The record metadata to validate.
+
+        Returns:
+            dict: The validated record.
+        """
+        self._check_record(rc_md)
+        self._write_file_list([rc_md])
+        return rc_md
+
+    def _check_record(self, rc_md):
+        """Validate a sanitized record against the MDF schema, without saving its files.
+        Not intended to be called directly.
+
+        Arguments:
+            rc_md (dict): The record metadata to validate.
+
+        Raises:
+            ValidationError: If the record is invalid.
+        """
         try:
-            jsonschema.validate(rc_md, schema, resolver=self.ref_resolver)
+            self._validate_schema(rc_md, "record.json")
         except jsonschema.ValidationError as e:
             raise ValidationError("Invalid record metadata: {}"
                                   .format(str(e).split("\n")[0])) from e
 
-        # Return results
-        return rc_md
+    def _write_file_list(self, records):
+        """Save the file entries of valid records to the file list, if one is written.
+        Not intended to be called directly.
+
+        Arguments:
+            records (list of dict): The validated records.
+        """
+        if self.__file_list is not None:
+            self.__file_list.writelines(json.dumps(f) + "\n" for rc_md in records
+                                        for f in rc_md.get("files") or ())
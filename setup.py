@@ -11,7 +11,10 @@ setup(
     name="mdf_matio",
     version=version,
     packages=find_packages(),
-    install_requires=['pypif_sdk', 'jsonschema>3', 'mdf_toolbox>=0.5.3'],
+    install_requires=['pypif_sdk', 'jsonschema>3', 'mdf_toolbox>=0.5.3', 'requests'],
+    extras_require={
+        'fast': ['fastjsonschema', 'numpy']
+    },
     include_package_data=True,
     entry_points={
         'materialsio.adapter': [
@@ -0,0 +1,70 @@
+"""Fixtures shared by the tests of the indexing pipeline"""
+
+from mdf_matio import execution
+from mdf_matio.schemas import SchemaStore, get_schema_uri
+import pytest
+import os
+
+
+class FakeParser:
+    """Parser that treats each file as its own group"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def identify_files(self, path, context=None):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                yield (os.path.join(root, f),)
+
+
+def fake_execute(name, group, context=None, adapter=None):
+    """Fake parser execution that fails on files named "bad" and returns nothing for "empty" """
+    filename = os.path.basename(group[0])
+    if filename == 'bad':
+        raise ValueError('Bad file')
+    elif filename == 'empty':
+        return None
+    with open(group[0]) as fp:
+        content = fp.read().strip()
+    return {'parser': name, 'file': filename, 'content': content, 'context': context}
+
+
+@pytest.fixture
+def fake_parsers(monkeypatch):
+    """Replace the MaterialsIO parsers with :class:`FakeParser` and :func:`fake_execute`"""
+    monkeypatch.setattr(execution, 'get_parser', FakeParser)
+    monkeypatch.setattr(execution, 'execute_parser', fake_execute)
+
+
+@pytest.fixture
+def example_paths():
+    """Paths of the files in ``data_dir``, in the order tasks are sorted"""
+    return ['b.in', 'bad', 'empty', os.path.join('a', 'x.in'), os.path.join('a', 'c', 'x.in'),
+            os.path.join('a', 'd', 'x.in'), os.path.join('a-e', 'x.in')]
+
+
+@pytest.fixture
+def data_dir(tmpdir, example_paths):
+    """Directory of files to be parsed with the fake parsers"""
+    data_dir = os.path.join(tmpdir, 'data')
+    for path in example_paths[::-1]:
+        path = os.path.join(data_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            print('data', file=fp)
+    return data_dir
+
+
+@pytest.fixture
+def schema_dir():
+    """Directory holding the simplified MDF schemas used by the tests"""
+    return os.path.join(os.path.dirname(__file__), 'data', 'schemas')
+
+
+@pytest.fixture
+def schema_store(tmpdir, schema_dir):
+    """Schema store with the test schemas, which does not use the network"""
+    store = SchemaStore(str(tmpdir.join('schemas')), offline=True)
+    store.preload(schema_dir, get_schema_uri('test'))
+    return store
@@ -0,0 +1,25 @@
+"""Make sure the benchmarks run"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import run_benchmarks  # noqa: E402
+
+
+def test_benchmarks(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    results = run_benchmarks.main(['--records', '64', '--csv-rows', '16', '--list-size', '4',
+                                   '--in-process', '--json', output])
+    assert [x['component'] for x in results] == list(run_benchmarks.COMPONENTS)
+    assert all(x['records_in'] > 0 for x in results)
+    assert os.path.isfile(output)
+
+
+def test_nesting():
+    # The nested metadata reaches the records given to the validator, which accepts them
+    results = run_benchmarks.main(['--records', '16', '--nesting', '3', '--in-process',
+                                   '--components', 'validate_record', 'validate_records'])
+    assert all(x['records_out'] == x['records_in'] == 16 for x in results)
+    record = run_benchmarks.synthetic.make_records(1, nesting=3)[0]
+    assert record['custom']['extra']['child']['child']['series']
@@ -0,0 +1,183 @@
+"""Tests for the cache of parse results shared between datasets"""
+
+from mdf_matio import execution
+from mdf_matio.cache import ParseCache, _Rebaser
+from mdf_matio.execution import ParseTask, identify_tasks, run_tasks
+from pytest import fixture
+import pickle
+import os
+
+calls = []
+
+
+def path_execute(name, group, context=None, adapter=None):
+    """Produce metadata with absolute and relative paths, as does the file adapter"""
+    calls.append(group)
+    if os.path.basename(group[0]) == 'empty':
+        return None
+    root = context['root_dir']
+    with open(group[0]) as fp:
+        content = fp.read().strip()
+    return {'files': [{'path': os.path.relpath(f, root), 'filename': os.path.basename(f),
+                       'url': 'globus://endpoint' + f} for f in group],
+            'custom': {'content': content, 'directory': os.path.dirname(group[0]),
+                       'option': context.get('option')}}
+
+
+class FileParser:
+    def __init__(self, name):
+        self.name = name
+
+    def identify_files(self, path, context=None):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                yield (os.path.join(root, f),)
+
+    def version(self):
+        return '1.0'
+
+
+@fixture
+def datasets(tmpdir, monkeypatch):
+    """Two datasets holding the same files in different directories"""
+    monkeypatch.setattr(execution, 'get_parser', FileParser)
+    monkeypatch.setattr(execution, 'execute_parser', path_execute)
+    calls.clear()
+    roots = [str(tmpdir.join('first')), str(tmpdir.join('second', 'data'))]
+    layouts = [['a.in', os.path.join('x', 'b.in'), os.path.join('x', 'empty')],
+               ['a.in', os.path.join('y', 'z', 'b.in'), os.path.join('y', 'empty')]]
+    for root, layout in zip(roots, layouts):
+        for path, content in zip(layout, ['a', 'b', '']):
+            path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fp:
+                print(content, file=fp)
+    return roots
+
+
+def _run(root, cache=None, workers=1, option=None):
+    tasks = identify_tasks(root, ['file'])
+    return list(run_tasks(tasks, {'file': {'root_dir': root, 'option': option}},
+                          workers=workers, cache=cache))
+
+
+def test_rebase(datasets, tmpdir):
+    first, second = datasets
+    cache = ParseCache(str(tmpdir.join('cache.db')))
+    assert _run(first, cache) == _run(first)
+    assert len(cache) == 3
+
+    # Files with the same contents in the other dataset are not parsed again,
+    #  and the paths in their results point to the new files
+    calls.clear()
+    assert _run(second, cache) == _run(second)
+    assert len(calls) == 3  # Only from the run without the cache
+    assert cache.hits == 3
+
+    # Results are stored without paths
+    for f in ['a.in', os.path.join('x', 'b.in')]:
+        task = ParseTask('file', (os.path.join(first, f),))
+        key = cache.make_key(task, {'root_dir': first, 'option': None})
+        row = cache._connect().execute('SELECT data FROM results WHERE key = ?',
+                                       (key,)).fetchone()
+        assert first not in str(pickle.loads(row[0]))
+
+    # Files moved to or from the root of the dataset are parsed again,
+    #  as are changes to the contents or the parser options
+    os.rename(os.path.join(second, 'a.in'), os.path.join(second, 'y', 'a.in'))
+    with open(os.path.join(second, 'y', 'z', 'b.in'), 'w') as fp:
+        print('c', file=fp)
+    calls.clear()
+    assert _run(second, cache) == _run(second)
+    assert len(calls) == 2 + 3
+    calls.clear()
+    _run(second, cache, option='new')
+    assert len(calls) == 3
+
+
+def test_rebaser():
+    rebaser = _Rebaser((os.path.join('/data', 'a', 'f.in'),), {'root_dir': '/data'})
+    for value in ['/data/a', '/data/a/f.in', '/data/a/b/g.in', 'a', 'a/f.in', 'x:/data/a/f.in',
+                  '/data/ab', 'ab/f.in', '/data', 'f.in', 5]:
+        value = value.replace('/', os.path.sep) if isinstance(value, str) else value
+        assert rebaser.fill(rebaser.strip(value)) == value
+
+    # Paths are moved to the new location, but names that match the directory are not
+    stored = rebaser.strip({'path': ['a/f.in'.replace('/', os.path.sep)], 'name': 'a',
+                            'url': 'x:' + os.path.join('/data', 'a', 'f.in')})
+    moved = _Rebaser((os.path.join('/other', 'b', 'c', 'f.in'),), {'root_dir': '/other'})
+    assert moved.fill(stored) == {'path': [os.path.join('b', 'c', 'f.in')], 'name': 'a',
+                                  'url': 'x:' + os.path.join('/other', 'b', 'c', 'f.in')}
+
+    # Files in the root directory of the file system
+    rebaser = _Rebaser((os.path.sep + 'f.in',), None)
+    assert rebaser.strip(os.path.sep + 'f.in') != os.path.sep + 'f.in'
+    assert moved.fill(rebaser.strip(os.path.sep + 'f.in')) == \
+        os.path.join('/other', 'b', 'c', 'f.in')
+
+
+def test_dataset_paths(tmpdir):
+    root = str(tmpdir.join('data'))
+    group = (os.path.join(root, 'a', 'f.in'),)
+    cache = ParseCache(str(tmpdir.join('cache.db')))
+
+    # Results with paths to other parts of the dataset are not stored, as they would
+    #  appear in the records of other datasets
+    for context in [{'root_dir': root}, None]:
+        for metadata in [{'input': os.path.join(root, 'b', 'pot.in')}, {'root': root},
+                         [{'files': {os.path.join(root, 'b'): 1}}]]:
+            key = cache.make_key(ParseTask('file', group), context)
+            cache.store(key, ParseTask('file', group), context,
+                        execution.ParseResult(group, 'file', metadata))
+            assert len(cache) == 0
+    cache.store('key', ParseTask('file', group), {'root_dir': root},
+                execution.ParseResult(group, 'file', {'path': group[0], 'other': root + 'x'}))
+    assert len(cache) == 1
+
+
+def test_lazy_metadata(tmpdir, monkeypatch):
+    # Records produced as they are iterated over are read by the cache and by the caller
+    monkeypatch.setattr(execution, 'execute_parser',
+                        lambda *args, **kwargs: ({'row': i} for i in range(3)))
+    task = ParseTask('file', (str(tmpdir.join('f.in')),))
+    tmpdir.join('f.in').write('data')
+    cache = ParseCache(str(tmpdir.join('cache.db')))
+    for _ in range(2):
+        assert list(execution.run_task(task, cache=cache).metadata) == \
+            [{'row': i} for i in range(3)]
+    assert cache.hits == 1
+
+
+def test_eviction(tmpdir):
+    cache = ParseCache(str(tmpdir.join('cache.db')), max_bytes=4000)
+    group = (str(tmpdir.join('f.in')),)
+    for i in range(40):
+        cache.store(f'key{i}', ParseTask('file', group), None,
+                    execution.ParseResult(group, 'file', {'data': 'x' * 200}))
+        assert cache.size <= 4000
+
+        # Keep using the first result, which stays in the cache
+        assert cache.load('key0', ParseTask('file', group))[0]
+    assert cache.load('key39', ParseTask('file', group))[0]
+    assert not cache.load('key1', ParseTask('file', group))[0]
+    assert 10 < len(cache) < 20
+
+    # The size is shared with other connections
+    assert ParseCache(cache.path).size == cache.size
+
+
+def test_workers(datasets, tmpdir):
+    # Several processes write to the cache at once
+    first, second = datasets
+    cache = ParseCache(str(tmpdir.join('cache.db')))
+    for i in range(20):
+        with open(os.path.join(first, f'{i}.in'), 'w') as fp:
+            print(i, file=fp)
+    expected = _run(first)
+    assert _run(first, cache, workers=4) == expected
+    assert len(cache) == len(expected) + 1
+
+    # Every result is then read from the cache
+    calls.clear()
+    assert _run(first, cache) == expected
+    assert len(calls) == 0
@@ -0,0 +1,86 @@
+"""Tests for resuming interrupted indexing runs"""
+
+from mdf_matio import _validate_groups
+from mdf_matio.checkpoint import IndexCheckpoint, make_run_key
+from mdf_matio.validator import MDFValidator
+from materials_io.utils.interface import ParseResult
+from pytest import raises, mark
+import json
+import time
+import os
+
+
+def _groups():
+    """Merged groups of files, including list-type and generic-only metadata"""
+    for i in range(40):
+        if i % 7 == 3:
+            yield ParseResult([f'/data/{i}'], 'generic', {'files': [{'length': 1}]})
+        elif i % 5 == 0:
+            yield ParseResult([f'/data/{i}'], 'csv', [
+                {'files': [{'length': j, 'data_type': 'text'}], 'custom': {'row': j}}
+                for j in range(i % 4 + 1)])
+        else:
+            yield ParseResult([f'/data/{i}'], 'json', {
+                'files': [{'length': i, 'data_type': 'json'}],
+                'material': {'composition': 'NaCl'}})
+
+
+def _dataset():
+    return {'mdf': {'source_id': 'test_v1', 'source_name': 'test'}}
+
+
+def _run(schema_store, tmpdir, checkpoint=None, stop_after=None):
+    """Produce the serialized output of a run, stopping after a certain number of items"""
+    vald = MDFValidator(schema_branch='test', schema_store=schema_store,
+                        file_list_path=str(tmpdir.join('files.ndjson')))
+    gen = _validate_groups(_groups(), vald, _dataset(), batch_size=4, checkpoint=checkpoint)
+    output = []
+    for item in gen:
+        output.append(json.dumps(item, sort_keys=True))
+        if stop_after is not None and len(output) >= stop_after:
+            gen.close()  # The run is interrupted
+            break
+    else:
+        output.append(json.dumps(vald.finalize(), sort_keys=True))
+    return output
+
+
+@mark.parametrize('stop_after', [1, 5, 17, 30])
+def test_resume(schema_store, tmpdir, stop_after):
+    expected = _run(schema_store, tmpdir)
+    with open(tmpdir.join('files.ndjson')) as fp:
+        expected_files = fp.read()
+    time.sleep(0.01)  # A new run would get a different ingest date
+
+    # Interrupt a run and then resume it
+    path = str(tmpdir.join('checkpoint.json'))
+    first = _run(schema_store, tmpdir, IndexCheckpoint(path, 'key', interval=0), stop_after)
+    checkpoint = IndexCheckpoint(path, 'key', interval=0)
+    yielded = 0 if checkpoint.state is None else checkpoint.state['yielded']
+    assert yielded <= len(first)
+    time.sleep(0.01)
+    rest = _run(schema_store, tmpdir, checkpoint)
+
+    # The records kept from the first run and those of the second should match a full run
+    # started at the same time as the first. With no checkpoint, the second run starts over
+    date = json.loads((first if yielded > 0 else rest)[0])['mdf']['ingest_date']
+    expected = [x.replace(json.loads(expected[0])['mdf']['ingest_date'], date) for x in expected]
+    assert first[:yielded] + rest == expected
+    with open(tmpdir.join('files.ndjson')) as fp:
+        assert fp.read() == expected_files
+
+    # The checkpoint is removed once the run finishes
+    assert not os.path.exists(path)
+    assert IndexCheckpoint(path, 'key').state is None
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir.join('checkpoint.json'))
+    checkpoint = IndexCheckpoint(path, make_run_key(data_url='/data'), interval=3600)
+    assert not checkpoint.is_due()
+    checkpoint.save(3, 10, {'scroll_id': 10})
+    assert IndexCheckpoint(path, make_run_key(data_url='/data')).state['groups'] == 3
+
+    # Checkpoints from runs with other options are not used
+    with raises(ValueError, match='different options'):
+        IndexCheckpoint(path, make_run_key(data_url='/other'))
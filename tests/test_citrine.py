@@ -1,7 +1,11 @@
 """Tests for the Citrine adapters"""
 
-from mdf_matio.adapters.citrine import PIFDFTAdapter
-from pytest import fixture
+from mdf_matio.adapters.citrine import CitrineAdapter, PIFDFTAdapter, flatten_pif, _flatten_simple
+from pypif_sdk.interop.mdf import _to_user_defined as pif_to_feedstock
+from pypif.pif import loado
+from pytest import fixture, mark, raises
+from random import Random
+from copy import deepcopy
 import json
 import os
 
@@ -20,3 +24,73 @@ def test_pif_dft(example_dft):
                         'cutoff_energy': 650.0},
                 'origin': {'type': 'computation', 'name': 'VASP', 'version': '5.3.2'}}
     assert PIFDFTAdapter().transform(example_dft) == expected
+
+
+def _random_scalar(rng: Random):
+    value = rng.choice([1, 1.0, True, '1', 'PAW', 2.5, None])
+    return value if value is not None and rng.random() < 0.5 else {'value': value}
+
+
+def _random_value(rng: Random, kind: str = 'value') -> dict:
+    """Make a PIF Value or Property with a few distinct names, so that names are reused"""
+    output = {'name': rng.choice(['Converged', 'XC Functional', 'Cutoff Energy', 'VASP', '',
+                                  'Cutoff_Energy', 'Number of atoms in unit cell'])}
+    if rng.random() < 0.5:
+        output['units'] = rng.choice(['eV', 'eV/atom', None, '$\\AA^{3}$'])
+    choice = rng.random()
+    if choice < 0.5:
+        output['scalars'] = [_random_scalar(rng) for _ in range(rng.randint(0, 2))]
+    elif choice < 0.8:
+        output['vectors'] = [[_random_scalar(rng) for _ in range(2)]
+                             for _ in range(rng.randint(1, 2))]
+    if kind == 'property':
+        if rng.random() < 0.7:
+            output['conditions'] = [_random_value(rng) for _ in range(rng.randint(0, 3))]
+        if rng.random() < 0.5:
+            output['methods'] = [{'name': rng.choice(['DFT', 'VASP']), 'software': [
+                {'name': 'VASP', 'version': rng.choice(['5.3.2', '5.4'])}]}]
+        output['dataType'] = 'COMPUTATIONAL'
+    return output
+
+
+@mark.parametrize('seed', range(300))
+def test_flatten(seed):
+    rng = Random(seed)
+    pif = {'category': 'system.chemical', 'chemicalFormula': rng.choice(['Al', 'Al2O3', 'Fe0.5Ni']),
+           'properties': [_random_value(rng, 'property') for _ in range(rng.randint(0, 5))]}
+
+    # Include fields the fast path does not handle in some PIFs
+    if rng.random() < 0.1:
+        pif['composition'] = [{'element': 'Al', 'actualAtomicPercent': {'value': 100}}]
+    if rng.random() < 0.1:
+        pif['properties'].append({'name': 'Temperature', 'scalars': {'value': 1}})
+
+    try:
+        expected = pif_to_feedstock(loado(deepcopy(pif)))
+    except TypeError:
+        with raises(TypeError):
+            flatten_pif(pif)
+        return
+    assert json.dumps(flatten_pif(pif), sort_keys=True) == json.dumps(expected, sort_keys=True)
+
+
+def test_transform_many(example_dft):
+    # The fast path should handle the output of the DFT parser
+    assert _flatten_simple(example_dft) == pif_to_feedstock(loado(example_dft))
+
+    adapter = PIFDFTAdapter()
+    records = adapter.transform_many([example_dft, example_dft])
+    assert records == [adapter.transform(example_dft)] * 2
+    assert records[0]['origin'] is not records[1]['origin']
+
+    # Each PIF keeps the origin of its own software
+    other = deepcopy(example_dft)
+    software = other['properties'][0]['methods'][0]['software'][0]
+    software['name'] = 'Other'
+    software.pop('version', None)
+    pifs = [example_dft, other, example_dft]
+    assert adapter.transform_many(iter(pifs)) == [adapter.transform(x) for x in pifs]
+    assert 'version' not in adapter.transform_many([other])[0]['origin']
+    assert adapter.get_compiled_translations() is adapter.get_compiled_translations()
+    assert CitrineAdapter().get_compiled_translations() == \
+        (('material', (('elemental_proportion', 'elemental_proportions', dict),)),)
@@ -0,0 +1,37 @@
+"""Tests for running parsers as independent tasks"""
+
+from mdf_matio.execution import ParseTask, identify_tasks, run_tasks
+import pytest
+import os
+
+
+def test_identify(fake_parsers, data_dir, example_paths):
+    tasks = identify_tasks(data_dir, ['y', 'x'])
+    assert len(tasks) == 14
+    assert all(isinstance(x, ParseTask) for x in tasks)
+
+    # Tasks should be sorted by directory, with subdirectories next to their parents
+    paths = [os.path.relpath(x.group[0], data_dir) for x in tasks]
+    assert list(dict.fromkeys(paths)) == example_paths
+
+    # Within a directory, tasks are sorted by parser
+    assert [x.parser for x in tasks[:6]] == ['x'] * 3 + ['y'] * 3
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3])
+def test_run(fake_parsers, data_dir, workers):
+    contexts = {'x': {'option': True}}
+    tasks = identify_tasks(data_dir, ['x', 'y'], contexts)
+    results = list(run_tasks(tasks, contexts, workers=workers, chunksize=2))
+
+    # Failed and empty tasks should be skipped, others kept in order
+    assert len(results) == len(tasks) - 4
+    assert [x.group for x in results] == [x.group for x in tasks
+                                          if os.path.basename(x.group[0]) not in ['bad', 'empty']]
+    assert results[0].metadata['context'] == {'option': True}
+    assert results[1].metadata['context'] is None
+
+
+def test_bad_workers():
+    with pytest.raises(ValueError):
+        list(run_tasks([], workers=0))
@@ -0,0 +1,62 @@
+"""Tests for the generic MDF adapter"""
+
+from mdf_matio.adapters import generic
+from mdf_matio.adapters.basic_adapters import JSONAdapter
+from mdf_matio.adapters.generic import GenericMDFAdapter
+from mdf_matio.schemas import SchemaStore, get_schema_uri
+import shutil
+import json
+import os
+
+
+def test_transform(schema_store):
+    adapter = GenericMDFAdapter(schema_branch='test', schema_store=schema_store)
+    assert adapter.automap['dft.cutoff_energy'] == 'dft.cutoff_energy'
+    output = adapter.transform({'dft': {'cutoff_energy': 520, 'converged': None}, 'other': 1,
+                                'material': {'composition': 'NaCl', 'notes': 'salt'}})
+    assert output == {'dft': {'cutoff_energy': 520}, 'material': {'composition': 'NaCl'}}
+
+
+def test_shared_automap(schema_store, monkeypatch):
+    monkeypatch.setattr(generic, '_automaps', {})
+    first = GenericMDFAdapter(schema_branch='test', schema_store=schema_store)
+    second = JSONAdapter(schema_branch='test', schema_store=schema_store)
+    assert first.automap is second.automap
+
+    # A new process should load the automap from disk rather than rebuild it
+    monkeypatch.setattr(generic, '_automaps', {})
+
+    def no_expand(*args, **kwargs):
+        raise AssertionError('Schema should not be expanded')
+    monkeypatch.setattr(generic.mdf_toolbox, 'expand_jsonschema', no_expand)
+    third = GenericMDFAdapter(schema_branch='test', schema_store=schema_store)
+    assert third.automap == first.automap
+    assert third.automap is not first.automap
+
+    # Adapters re-use the automap of the store without reading any schemas
+    def no_resolver(*args, **kwargs):
+        raise AssertionError('Schemas should not be read')
+    monkeypatch.setattr(schema_store, 'get_resolver', no_resolver)
+    assert JSONAdapter(schema_branch='test', schema_store=schema_store).automap is third.automap
+
+
+def test_referenced_schema_change(schema_store, schema_dir, tmpdir, monkeypatch):
+    monkeypatch.setattr(generic, '_automaps', {})
+    first = GenericMDFAdapter(schema_branch='test', schema_store=schema_store)
+    assert 'mdf.new_field' not in first.automap
+
+    # Change a schema referenced by the record schema, but not the record schema itself
+    new_dir = str(tmpdir.join('new_schemas'))
+    shutil.copytree(schema_dir, new_dir)
+    with open(os.path.join(new_dir, 'mdf.json')) as fp:
+        mdf = json.load(fp)
+    mdf['properties']['new_field'] = {'type': 'string'}
+    with open(os.path.join(new_dir, 'mdf.json'), 'w') as fp:
+        json.dump(mdf, fp)
+
+    # A new process using the same cache should not load the stale automap
+    store = SchemaStore(schema_store.cache_dir, offline=True)
+    store.preload(new_dir, get_schema_uri('test'))
+    monkeypatch.setattr(generic, '_automaps', {})
+    second = GenericMDFAdapter(schema_branch='test', schema_store=store)
+    assert second.automap['mdf.new_field'] == 'mdf.new_field'
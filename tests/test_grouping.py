@@ -1,6 +1,11 @@
 """Test the functions that group files into chunks"""
 
-from mdf_matio.grouping import groupby_directory, groupby_file
+from mdf_matio.grouping import DirectoryIndex, groupby_directory, groupby_file
+from mdf_matio import _merge_directories, _merge_files
+from mdf_matio.execution import _task_directory
+from mdf_matio import spill
+from materials_io.utils.interface import ParseResult
+import random
 import pytest
 import os
 
@@ -57,3 +62,247 @@ def test_groupby_file(example_files):
     assert sorted(map(len, groups)) == [1, 1, 3]
     assert isinstance(groups[0], list)
     assert isinstance(groups[0][0], tuple)
+
+
+def _reference_groupby_file(records):
+    """Iterative grouping algorithm used before the union-find implementation"""
+    current_groups = [(set(x[0]), [x]) for x in records]
+    while True:
+        matched_groups = []
+        while len(current_groups) > 0:
+            my_files, my_records = current_groups.pop()
+            matched = False
+            for files, group_records in matched_groups:
+                if not my_files.isdisjoint(files):
+                    matched = True
+                    files.update(my_files)
+                    group_records.extend(my_records)
+                    break
+            if matched:
+                continue
+            matched_ids = set(i for i, x in enumerate(current_groups)
+                              if not x[0].isdisjoint(my_files))
+            if len(matched_ids) == 0:
+                yield my_records
+            else:
+                for i in matched_ids:
+                    my_files.update(current_groups[i][0])
+                    my_records.extend(current_groups[i][1])
+                current_groups = [e for i, e in enumerate(current_groups) if i not in matched_ids]
+                matched_groups.append((my_files, my_records))
+        if len(matched_groups) == 0:
+            return
+        current_groups = matched_groups
+
+
+def _as_id_sets(groups):
+    """Convert a list of groups to a set of record IDs, which are stored in the metadata"""
+    return set(frozenset(x[2]['id'] for x in group) for group in groups)
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_groupby_file_equivalence(seed):
+    rng = random.Random(seed)
+    n_records = rng.randint(1, 200)
+    n_files = rng.randint(1, 2 * n_records)
+    records = []
+    for i in range(n_records):
+        files = tuple(f'{rng.randrange(n_files)}.in' for _ in range(rng.randint(1, 4)))
+        records.append((files, 'fake', {'id': i}))
+
+    groups = list(groupby_file(records))
+    assert _as_id_sets(groups) == _as_id_sets(_reference_groupby_file(records))
+
+    # Groups and their members should be in the order they were received
+    first_ids = [group[0][2]['id'] for group in groups]
+    assert first_ids == sorted(first_ids)
+    for group in groups:
+        ids = [x[2]['id'] for x in group]
+        assert ids == sorted(ids)
+
+
+def test_groupby_file_chain():
+    # Each record shares a file with only the next one, which previously required many passes
+    records = [((f'{i}.in', f'{i + 1}.in'), 'fake', {'id': i}) for i in range(100)]
+    groups = list(groupby_file(records, max_passes=1))
+    assert len(groups) == 1
+    assert [x[2]['id'] for x in groups[0]] == list(range(100))
+
+
+@pytest.mark.parametrize('spill_threshold', [0, 3])
+def test_grouping_spill(example_files, spill_threshold):
+    # Grouping on disk should produce the same groups in the same order
+    assert list(groupby_directory(example_files, spill_threshold=spill_threshold)) == \
+        list(groupby_directory(example_files))
+    assert list(groupby_file(example_files, spill_threshold=spill_threshold)) == \
+        list(groupby_file(example_files))
+
+    rng = random.Random(1)
+    records = [(tuple(f'{rng.randrange(100)}.in' for _ in range(2)), 'fake', {'id': i})
+               for i in range(100)]
+    assert list(groupby_file(records, spill_threshold=spill_threshold)) == \
+        list(groupby_file(records))
+
+
+def _sorted_records(rng, n_records):
+    """Make records whose files are in or below their directory, sorted by directory"""
+    directories = [()] + [tuple(rng.choice('abc') for _ in range(rng.randint(1, 3)))
+                          for _ in range(10)]
+    records = []
+    for i in range(n_records):
+        directory = rng.choice(directories)
+        files = []
+        for _ in range(rng.randint(1, 3)):
+            below = tuple(rng.choice('ab') for _ in range(rng.randint(0, 2)))
+            files.append(os.path.join('root', *directory, *below, f'{rng.randrange(3)}.in'))
+        records.append(ParseResult(tuple(files), 'fake', {'id': i}))
+    records.sort(key=lambda x: _task_directory(x.group))
+    return records
+
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('spill_threshold', [None, 5])
+def test_groupby_file_ordered(seed, spill_threshold):
+    records = _sorted_records(random.Random(seed), 150)
+
+    # Groups are the same, and in the same order, as when grouping all records at once
+    expected = list(groupby_file(records))
+    assert list(groupby_file(iter(records), ordered=True,
+                             spill_threshold=spill_threshold)) == expected
+
+
+def test_groupby_file_streaming():
+    # Groups are produced once the records move past the directories of their files
+    records = [ParseResult(('a.in', os.path.join('x', 'a.in')), 'fake', {}),
+               ParseResult(('b.in',), 'fake', {}),
+               ParseResult((os.path.join('x', 'a.in'),), 'fake', {}),
+               ParseResult((os.path.join('y', 'a.in'),), 'fake', {}),
+               ParseResult((os.path.join('z', 'a.in'),), 'fake', {})]
+    consumed = []
+
+    def produce():
+        for record in records:
+            consumed.append(record)
+            yield record
+
+    output = []
+    for group in groupby_file(produce(), ordered=True):
+        output.append((group, len(consumed)))
+    assert [len(x[0]) for x in output] == [2, 1, 1, 1]
+    assert [x[1] for x in output] == [4, 4, 5, 5]
+
+
+def test_merge_files_held():
+    # A record spanning the boundary of a grouped directory is held until that directory ends,
+    #  so it reaches the file grouping after records from later directories
+    records = [ParseResult(('a.in', os.path.join('g', 'a.in')), 'fake', {'id': [0]}),
+               ParseResult(('a.in',), 'fake', {'id': [1]}),
+               ParseResult((os.path.join('f', 'a.in'),), 'fake', {'id': [2]}),
+               ParseResult((os.path.join('g', 'a.in'),), 'fake', {'id': [3]}),
+               ParseResult((os.path.join('h', 'a.in'),), 'fake', {'id': [4]})]
+
+    def merge(ordered):
+        held = {}
+        output = _merge_directories(iter(records), ['g'], ordered=ordered, held=held)
+        groups = _merge_files(output, ordered=ordered, held=held)
+        return [sorted(x.metadata['id']) for x in groups]
+
+    assert merge(True) == merge(False)
+    assert [0, 1, 3] in merge(True)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_merge_directories_ordered(seed):
+    # Records are merged into the same groups with and without ordering, including records
+    #  from different grouped directories that share their common directory
+    rng = random.Random(seed)
+    for _ in range(100):
+        records = [ParseResult(x.group, x.parser, {'id': [x.metadata['id']]})
+                   for x in _sorted_records(rng, rng.randint(1, 12))]
+        grouped = list(set(os.path.join('root', *rng.choice(['a', 'ab', 'b', 'ba', 'c', 'aa']))
+                           for _ in range(rng.randint(1, 3))))
+
+        def merge(ordered):
+            held = {}
+            output = _merge_directories(iter(records), grouped, ordered=ordered, held=held)
+            groups = _merge_files(output, ordered=ordered, held=held)
+            return sorted((sorted(x.group), sorted(x.metadata['id'])) for x in groups)
+
+        assert merge(True) == merge(False)
+
+    # Two grouped directories whose records share the common directory "d"
+    j = os.path.join
+    records = [ParseResult((j('d', 'f3'), j('d', 's0', 'f2')), 'fake', {'id': [0]}),
+               ParseResult((j('d', 's1', 'f5'), j('d', 's2', 's3', 'f7')), 'fake', {'id': [1]})]
+    for ordered in [False, True]:
+        output = list(_merge_directories(iter(records), [j('d', 's0'), j('d', 's1')],
+                                         ordered=ordered))
+        assert [sorted(x.metadata['id']) for x in output] == [[0, 1]]
+
+
+def test_directory_index():
+    index = DirectoryIndex([os.path.join('a', 'b'), os.path.join('a', 'b', 'c'),
+                            os.path.join('x', '')])
+
+    # The outermost directory owns a file
+    assert index.find_owner(os.path.join('a', 'b', 'f')) == os.path.join('a', 'b')
+    assert index.find_owner(os.path.join('a', 'b', 'c', 'd', 'f')) == os.path.join('a', 'b')
+    assert index.find_owner(os.path.join('x', 'f')) == os.path.join('x', '')
+
+    # Only whole path components match
+    assert index.find_owner(os.path.join('a', 'f')) is None
+    assert index.find_owner(os.path.join('a', 'bc', 'f')) is None
+    assert index.find_owner('f') is None
+
+    # Records belong to the outermost directory of any of their files
+    record = ParseResult([os.path.join('a', 'b', 'c', 'f'), os.path.join('a', 'b', 'f'), 'f'],
+                         'fake', {})
+    assert index.find_record_owner(record) == os.path.join('a', 'b')
+
+
+def test_merge_directories():
+    # Records sorted by directory, as produced by the task-based execution
+    paths = ['f', os.path.join('a', 'f'), os.path.join('a', 'f2'), os.path.join('a', 'b', 'f'),
+             os.path.join('a', 'b', 'f2'), os.path.join('a', 'c', 'f'), os.path.join('d', 'f'),
+             os.path.join('d', 'f2'), os.path.join('e', 'f')]
+    records = [ParseResult([p], 'fake', {'path': [p]}) for p in paths]
+    grouped = [os.path.join('a', 'b'), 'a', 'd']
+
+    def directories(output):
+        return [os.path.dirname(x.group[0]) for x in output]
+
+    # Without ordering, all grouped records are merged at the end
+    output = list(_merge_directories(records, grouped))
+    assert directories(output) == ['', 'e', 'a', os.path.join('a', 'b'),
+                                   os.path.join('a', 'c'), 'd']
+    assert sorted(output[2].metadata['path']) == paths[1:3]
+
+    # With ordering, each grouped directory is merged once the records move past it
+    ordered = []
+    for record in _merge_directories(iter(records), grouped, ordered=True):
+        ordered.append(record)
+        if len(ordered) == 4:
+            # "a" is complete once the first record from "d" arrives
+            assert directories(ordered) == ['', 'a', os.path.join('a', 'b'),
+                                            os.path.join('a', 'c')]
+    assert directories(ordered) == ['', 'a', os.path.join('a', 'b'), os.path.join('a', 'c'),
+                                    'd', 'e']
+    assert sorted(map(str, ordered)) == sorted(map(str, output))
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_merge_directories_spill(ordered, monkeypatch):
+    # Records moved to disk while held are grouped without being written to disk again
+    stores = []
+
+    class CountedStore(spill.SQLiteStore):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            stores.append(self)
+
+    monkeypatch.setattr(spill, 'SQLiteStore', CountedStore)
+    records = [ParseResult([os.path.join('g', 'd', f'{i}.in')], 'fake', {'id': [i]})
+               for i in range(10)]
+    output = list(_merge_directories(iter(records), ['g'], spill_threshold=3, ordered=ordered))
+    assert [sorted(x.metadata['id']) for x in output] == [list(range(10))]
+    assert len(stores) == 1
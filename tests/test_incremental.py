@@ -0,0 +1,122 @@
+"""Tests for re-using parse results between runs"""
+
+from mdf_matio import execution, incremental
+from mdf_matio.execution import identify_tasks, run_tasks
+from mdf_matio.incremental import run_incremental
+import pytest
+import os
+
+
+@pytest.fixture
+def counted_parsers(fake_parsers, monkeypatch):
+    """Record the files parsed by the fake parser"""
+    parsed = []
+    fake_execute = execution.execute_parser
+
+    def counted_execute(name, group, **kwargs):
+        parsed.append(os.path.basename(group[0]))
+        return fake_execute(name, group, **kwargs)
+    monkeypatch.setattr(execution, 'execute_parser', counted_execute)
+    return parsed
+
+
+def _run(data_dir, manifest_path, contexts=None, **kwargs):
+    tasks = identify_tasks(data_dir, ['x'], contexts)
+    return list(run_incremental(tasks, manifest_path, contexts, **kwargs))
+
+
+def _full_run(data_dir, contexts=None):
+    return list(run_tasks(identify_tasks(data_dir, ['x'], contexts), contexts))
+
+
+@pytest.mark.parametrize('use_hash', [False, True])
+def test_incremental(counted_parsers, data_dir, tmpdir, use_hash):
+    manifest_path = os.path.join(tmpdir, 'manifest.db')
+
+    # The first run parses everything
+    first = _run(data_dir, manifest_path, use_hash=use_hash)
+    assert len(counted_parsers) == 7
+    assert first == _full_run(data_dir)
+    assert len(first) == 5
+
+    # The second run parses nothing
+    counted_parsers.clear()
+    assert _run(data_dir, manifest_path, use_hash=use_hash) == first
+    assert counted_parsers == []
+
+    # Add, change, touch and delete files
+    with open(os.path.join(data_dir, 'new.in'), 'w') as fp:
+        print('new', file=fp)
+    with open(os.path.join(data_dir, 'a', 'x.in'), 'w') as fp:
+        print('changed', file=fp)
+    stat = os.stat(os.path.join(data_dir, 'b.in'))
+    os.utime(os.path.join(data_dir, 'b.in'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.unlink(os.path.join(data_dir, 'a-e', 'x.in'))
+
+    counted_parsers.clear()
+    third = _run(data_dir, manifest_path, use_hash=use_hash)
+    assert sorted(counted_parsers) == (['new.in', 'x.in'] if use_hash else
+                                       ['b.in', 'new.in', 'x.in'])
+    assert third == _full_run(data_dir)
+    assert len(third) == 5
+
+    # Changing the options for the parser should run it again
+    counted_parsers.clear()
+    contexts = {'x': {'option': True}}
+    fourth = _run(data_dir, manifest_path, contexts)
+    assert len(counted_parsers) == 7
+    assert fourth == _full_run(data_dir, contexts)
+
+
+class _Versioned:
+    def __init__(self, version):
+        self._version = version
+
+    def version(self):
+        return self._version
+
+
+def test_versions(counted_parsers, data_dir, tmpdir, monkeypatch):
+    manifest_path = os.path.join(tmpdir, 'manifest.db')
+    first = _run(data_dir, manifest_path)
+
+    # Upgrading the adapter, the parser or this package should run the parser again
+    fake_parser = execution.get_parser
+
+    def upgraded_parser(name):
+        parser = fake_parser(name)
+        parser.version = lambda: '2.0'
+        return parser
+    patches = [(execution, 'get_adapter', lambda name: _Versioned('2.0')),
+               (execution, 'get_parser', upgraded_parser),
+               (incremental, '__version__', '99.0')]
+    for module, name, value in patches:
+        monkeypatch.setattr(module, name, value)
+        counted_parsers.clear()
+        assert _run(data_dir, manifest_path) == first
+        assert len(counted_parsers) == 7
+
+        # The new versions are then stored
+        counted_parsers.clear()
+        assert _run(data_dir, manifest_path) == first
+        assert counted_parsers == []
+
+
+def test_failures(counted_parsers, data_dir, tmpdir, monkeypatch):
+    manifest_path = os.path.join(tmpdir, 'manifest.db')
+    counted_execute = execution.execute_parser
+
+    def low_memory_execute(name, group, **kwargs):
+        if os.path.basename(group[0]) == 'b.in':
+            counted_parsers.append('b.in')
+            raise MemoryError()
+        return counted_execute(name, group, **kwargs)
+    monkeypatch.setattr(execution, 'execute_parser', low_memory_execute)
+    assert len(_run(data_dir, manifest_path)) == 4
+
+    # Files that failed for lack of memory are parsed again, but not those that failed to parse
+    monkeypatch.setattr(execution, 'execute_parser', counted_execute)
+    counted_parsers.clear()
+    second = _run(data_dir, manifest_path)
+    assert counted_parsers == ['b.in']
+    assert second == _full_run(data_dir)
@@ -0,0 +1,157 @@
+"""Tests for the bulk ingest client, using a local server in place of Globus Search"""
+
+from mdf_matio.ingest import SearchIngestClient, IngestError, make_batches
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Event
+from pytest import fixture, raises
+import json
+import time
+
+
+class _Recorder:
+    """State of the stand-in search service"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.batches = []
+        self.failures = []  # Status codes to return before accepting requests
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+        self.release = Event()
+        self.release.set()
+        self.headers = []
+
+
+@fixture()
+def server():
+    recorder = _Recorder()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            with recorder.lock:
+                recorder.active += 1
+                recorder.max_active = max(recorder.max_active, recorder.active)
+                recorder.headers.append(dict(self.headers))
+                status = recorder.failures.pop(0) if recorder.failures else 200
+            recorder.release.wait()
+            time.sleep(recorder.delay)
+            with recorder.lock:
+                recorder.active -= 1
+                if status == 200:
+                    recorder.batches.append(json.loads(body))
+            reply = json.dumps({'acknowledged': True, 'task_id': str(len(recorder.batches))})
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(reply)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(reply.encode())
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1]), recorder
+    recorder.release.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _records(n: int):
+    for i in range(n):
+        yield {'mdf': {'source_id': 'test_v1', 'scroll_id': i, 'acl': ['public']},
+               'data': 'x' * (i % 50)}
+
+
+def test_batches():
+    batches = list(make_batches(_records(100), max_bytes=2000, max_records=10))
+    assert sum(b.records for b in batches) == 100
+    assert [b.index for b in batches] == list(range(len(batches)))
+    for batch in batches:
+        assert len(batch.body) <= 2000 and batch.records <= 10
+        document = json.loads(batch.body)
+        assert document['ingest_type'] == 'GMetaList'
+        assert len(document['ingest_data']['gmeta']) == batch.records
+    entry = json.loads(batches[0].body)['ingest_data']['gmeta'][0]
+    assert entry['subject'] == 'test_v1.0'
+    assert entry['visible_to'] == ['public']
+    assert entry['content'] == next(_records(1))
+
+    # Records larger than the limit are sent alone
+    assert [b.records for b in make_batches(_records(3), max_bytes=10)] == [1, 1, 1]
+
+
+def test_ingest(server):
+    url, recorder = server
+    recorder.delay = 0.05
+
+    class Authorizer:
+        def get_authorization_header(self):
+            return 'Bearer token'
+
+    with SearchIngestClient('index', base_url=url, authorizer=Authorizer(), max_records=7,
+                            max_in_flight=3) as client:
+        summary = client.ingest(_records(100))
+    assert summary['records'] == 100 and summary['batches'] == 15
+    assert len(summary['task_ids']) == 15
+    assert 1 < recorder.max_active <= 3
+    assert all(h['Authorization'] == 'Bearer token' for h in recorder.headers)
+
+    # Every record should arrive exactly once
+    subjects = sorted(e['content']['mdf']['scroll_id']
+                      for b in recorder.batches for e in b['ingest_data']['gmeta'])
+    assert subjects == list(range(100))
+
+
+def test_retries(server):
+    url, recorder = server
+    recorder.failures = [503, 429, 500]
+    client = SearchIngestClient('index', base_url=url, max_in_flight=1, backoff=0.01)
+    summary = client.ingest(_records(10))
+    assert summary['retries'] == 3 and summary['records'] == 10
+    assert len(recorder.batches) == 1
+
+    # Requests that are rejected or fail too often raise errors
+    recorder.failures = [400]
+    with raises(IngestError, match='HTTP 400'):
+        client.ingest(_records(10))
+    recorder.failures = [503] * 3
+    client.max_retries = 2
+    with raises(IngestError, match='3 attempts'):
+        client.ingest(_records(10))
+
+    # Connection errors are retried too
+    client = SearchIngestClient('index', base_url='http://127.0.0.1:1', max_retries=1,
+                                backoff=0.01, timeout=1)
+    with raises(IngestError, match='2 attempts'):
+        client.ingest(_records(1))
+
+
+def test_backpressure(server):
+    url, recorder = server
+    recorder.release.clear()
+    pulled = []
+
+    def _tracked():
+        for record in _records(1000):
+            pulled.append(record)
+            yield record
+
+    client = SearchIngestClient('index', base_url=url, max_records=10, max_in_flight=2)
+    thread = Thread(target=client.ingest, args=(_tracked(),))
+    thread.start()
+
+    # While the server holds the requests, only enough records for the batches
+    # in flight and the one waiting to be sent should be read
+    time.sleep(0.5)
+    assert len(pulled) <= 3 * 10 + 1
+    recorder.release.set()
+    thread.join()
+    assert len(pulled) == 1000
+    assert sum(len(b['ingest_data']['gmeta']) for b in recorder.batches) == 1000
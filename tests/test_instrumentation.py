@@ -0,0 +1,70 @@
+"""Tests for the timing and counters of indexing stages"""
+
+from mdf_matio.instrumentation import IndexingStats, LatencyHistogram, measure, track_stage
+from mdf_matio.execution import identify_tasks, run_tasks
+import pytest
+import time
+
+
+def _slow(items, delay):
+    for x in items:
+        time.sleep(delay)
+        yield x
+
+
+def test_stages():
+    reports = []
+    stats = IndexingStats(callback=reports.append)
+
+    # Chain two stages, the second of which groups the outputs of the first
+    source = track_stage(stats, 'source', _slow(range(4), 0.01))
+    pairs = track_stage(stats, 'pair', source,
+                        lambda x: (list(y) for y in _slow(zip(x, x), 0.02)), size=len)
+    with measure(stats, 'consume') as stage:
+        assert list(pairs) == [[0, 1], [2, 3]]
+        stage.records_in += 2
+
+    # Time in each stage excludes the time spent in the stages feeding it
+    output = stats.to_dict()['stages']
+    assert output['source']['records_out'] == 4
+    assert output['source']['wall_time'] == pytest.approx(0.04, abs=0.02)
+    assert output['pair']['records_in'] == 4
+    assert output['pair']['records_out'] == 2
+    assert output['pair']['max_size'] == 2
+    assert output['pair']['wall_time'] == pytest.approx(0.06, abs=0.02)
+    assert output['consume']['records_in'] == 2
+    assert output['consume']['wall_time'] < 0.02
+
+    stats.report()
+    assert reports == [stats.to_dict()]
+
+
+def test_disabled():
+    source = iter(range(4))
+    assert track_stage(None, 'source', source) is source
+    assert list(track_stage(None, 'pair', [1, 2], lambda x: map(str, x))) == ['1', '2']
+    with measure(None, 'consume') as stage:
+        assert stage is None
+
+
+def test_histogram():
+    hist = LatencyHistogram()
+    for duration in [0, 1e-4, 2e-4, 1e6]:
+        hist.add(duration)
+    output = hist.to_dict()
+    assert output['counts'][:3] == [2, 1, 0]
+    assert output['counts'][-1] == 1
+    assert output['count'] == 4
+    assert output['max'] == 1e6
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_tasks(fake_parsers, data_dir, workers):
+    stats = IndexingStats()
+    tasks = identify_tasks(data_dir, ['x', 'y'])
+    results = list(run_tasks(tasks, workers=workers, stats=stats))
+    output = stats.to_dict()['parsers']
+    assert sorted(output) == ['x', 'y']
+    assert output['x']['calls'] == len(tasks) // 2
+    assert output['x']['results'] + output['y']['results'] == len(results)
+    assert output['x']['latency']['count'] == len(tasks) // 2
@@ -0,0 +1,98 @@
+"""Tests for running parsers in isolated worker processes"""
+
+from mdf_matio import execution
+from mdf_matio.execution import ParseTask, run_tasks
+from mdf_matio.incremental import run_incremental
+from mdf_matio.instrumentation import IndexingStats
+from mdf_matio.isolation import Isolation, _get_rss
+from mdf_matio.scheduling import Schedule
+import pytest
+import time
+import os
+
+_big = 512 * 1024 ** 2
+
+
+def misbehaving_execute(name, group, context=None, adapter=None):
+    """Loop on files named "loop", use too much memory on "big" and crash on "crash" """
+    filename = os.path.basename(group[0])
+    if filename == 'loop':
+        time.sleep(60)
+    elif filename == 'big':
+        data = b'x' * _big  # noqa: F841
+        time.sleep(60)
+    elif filename == 'crash':
+        os._exit(3)
+    elif filename == 'empty':
+        return None
+    return {'file': filename, 'pid': os.getpid()}
+
+
+@pytest.fixture
+def tasks(monkeypatch):
+    monkeypatch.setattr(execution, 'execute_parser', misbehaving_execute)
+    names = ['a', 'loop', 'b', 'big', 'c', 'crash', 'd', 'empty', 'e', 'f']
+    return [ParseTask('x', (f'/data/{name}',)) for name in names]
+
+
+@pytest.mark.skipif(_get_rss(os.getpid()) is None, reason='Memory use cannot be measured')
+@pytest.mark.parametrize('workers', [1, 3])
+def test_isolation(tasks, workers):
+    stats = IndexingStats()
+    isolation = Isolation(timeout=1, max_rss=_get_rss(os.getpid()) + _big // 2, max_tasks=2,
+                          poll_interval=0.02)
+    start = time.perf_counter()
+    results = list(run_tasks(tasks, workers=workers, stats=stats, isolation=isolation))
+    assert time.perf_counter() - start < 10
+
+    # The misbehaving files are skipped, and the others are parsed in order
+    assert [x.metadata['file'] for x in results] == ['a', 'b', 'c', 'd', 'e', 'f']
+    skipped = dict((os.path.basename(x.task.group[0]), x.reason) for x in isolation.skipped)
+    assert sorted(skipped) == ['big', 'crash', 'loop']
+    assert 'time limit' in skipped['loop']
+    assert 'memory limit' in skipped['big']
+    assert 'code 3' in skipped['crash']
+    assert stats.to_dict()['parsers']['x']['skipped'] == 3
+    assert stats.to_dict()['parsers']['x']['calls'] == len(tasks)
+
+    # Workers are replaced after two tasks
+    pids = [x.metadata['pid'] for x in results]
+    assert all(pids.count(pid) <= 2 for pid in pids)
+    assert os.getpid() not in pids
+
+
+def test_no_limits(tasks):
+    tasks = [x for x in tasks if os.path.basename(x.group[0]) in 'abcdef']
+    isolation = Isolation()
+    results = list(run_tasks(tasks, workers=2, isolation=isolation))
+    assert [x.metadata['file'] for x in results] == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert isolation.skipped == []
+
+
+def test_bad_isolation():
+    with pytest.raises(ValueError):
+        Isolation(timeout=0)
+    with pytest.raises(ValueError):
+        Isolation(poll_interval=0)
+    with pytest.raises(ValueError):
+        list(run_tasks([], workers=0, isolation=Isolation()))
+    with pytest.raises(ValueError):
+        list(run_tasks([], schedule=Schedule(), isolation=Isolation()))
+
+
+def test_incremental(tasks, tmpdir):
+    # Create the files, so the manifest can record them
+    data_dir = str(tmpdir.join('data'))
+    os.makedirs(data_dir)
+    tasks = [ParseTask('x', (os.path.join(data_dir, name),)) for name in ['a', 'loop', 'b']]
+    for task in tasks:
+        with open(task.group[0], 'w'):
+            pass
+
+    # Skipped tasks are run again in the next run, as the limits may not be exceeded again
+    manifest_path = str(tmpdir.join('manifest.db'))
+    for _ in range(2):
+        isolation = Isolation(timeout=0.5)
+        results = list(run_incremental(tasks, manifest_path, isolation=isolation))
+        assert [x.metadata['file'] for x in results] == ['a', 'b']
+        assert [x.task for x in isolation.skipped] == [tasks[1]]
@@ -1,4 +1,11 @@
-from materials_io.utils.interface import execute_parser
+from materials_io.utils.interface import ParseResult, execute_parser
+from mdf_matio.adapters.mappable import CSVAdapter, CSVRecords
+from mdf_matio import _merge_records
+from decimal import Decimal
+import numpy as np
+import pytest
+import pickle
+import math
 import os
 
 csv_file = os.path.join(os.path.dirname(__file__), '..', 'notebooks',
@@ -15,3 +22,75 @@ def test_csv():
     # No effect
     assert execute_parser('csv', [csv_file], adapter='csv', context={}) is None
     assert execute_parser('csv', [csv_file], adapter='csv') is None
+
+
+def _make_table(n_rows):
+    return {'records': [{'composition': 'NaCl', 'energy': Decimal(i) / 4, 'count': np.int64(i),
+                         'label': None if i % 2 else 'x', 'other': i} for i in range(n_rows)]}
+
+
+def test_transform():
+    mapping = {'material.composition': 'composition', 'dft.cutoff_energy': 'energy',
+               'crystal_structure.number_of_atoms': 'count', 'custom.label': 'label',
+               'custom.missing': 'not_a_column'}
+    adapter = CSVAdapter()
+    assert adapter.get_builder(mapping) is adapter.get_builder(dict(mapping))
+
+    # Values are copied as they are by default
+    output = adapter.transform(_make_table(3), {'mapping': mapping})
+    assert output[1] == {'material': {'composition': 'NaCl'}, 'dft': {'cutoff_energy': 0.25},
+                         'crystal_structure': {'number_of_atoms': 1}, 'custom': {'label': None}}
+    assert isinstance(output[1]['dft']['cutoff_energy'], Decimal)
+
+    # Numeric columns are converted to native numbers with the columnar option
+    columnar = adapter.transform(_make_table(3), {'mapping': mapping, 'columnar': True,
+                                                  'chunk_size': 2})
+    assert columnar == output
+    assert all(type(x['dft']['cutoff_energy']) is float for x in columnar)
+    assert all(type(x['crystal_structure']['number_of_atoms']) is int for x in columnar)
+
+    # Records are only made when needed in streaming mode
+    stream = adapter.transform(_make_table(3), {'mapping': mapping, 'stream': True})
+    assert isinstance(stream, CSVRecords)
+    assert list(pickle.loads(pickle.dumps(stream))) == output
+
+    # No record is made until the stream is iterated over
+    class NoIteration(list):
+        def __iter__(self):
+            raise AssertionError('Rows were read')
+    table = {'records': NoIteration(_make_table(3)['records'])}
+    assert isinstance(adapter.transform(table, {'mapping': mapping, 'stream': True}), CSVRecords)
+
+    # Rows without mapped columns do not produce records
+    assert adapter.transform(_make_table(3), {'mapping': {'custom.a': 'a'}}) is None
+    assert adapter.transform(_make_table(3), {'mapping': {'custom.a': 'a'}, 'stream': True}) \
+        is None
+    assert adapter.transform(_make_table(0), {'mapping': mapping, 'stream': True}) is None
+
+    with pytest.raises(ValueError):
+        adapter.transform(_make_table(1), {'mapping': {'dft': 'energy', 'dft.x': 'count'}})
+
+
+def test_non_finite():
+    # Records with values that are not valid JSON are the same with and without columns,
+    #  so they are rejected by validation in both modes
+    rows = [{'energy': v} for v in [1.5, float('nan'), float('inf'), -float('inf')]]
+    mapping = {'dft.cutoff_energy': 'energy'}
+    adapter = CSVAdapter()
+    output = adapter.transform({'records': rows}, {'mapping': mapping})
+    assert adapter.transform({'records': rows}, {'mapping': mapping, 'columnar': True}) == output
+
+    decimals = [{'energy': Decimal(v)} for v in ['1.5', 'NaN', 'Infinity', '-Infinity']]
+    columnar = adapter.transform({'records': decimals}, {'mapping': mapping, 'columnar': True})
+    values = [x['dft']['cutoff_energy'] for x in columnar]
+    assert values[0] == 1.5 and math.isnan(values[1]) and values[2:] == [math.inf, -math.inf]
+
+
+def test_merge_stream():
+    records = CSVRecords(_make_table(4)['records'], {'material.composition': 'composition'})
+    group = [ParseResult(['a.csv'], 'csv', records),
+             ParseResult(['a.csv'], 'generic', {'files': [{'filename': 'a.csv'}]})]
+    merged = _merge_records(group)
+    assert not isinstance(merged.metadata, list)
+    assert list(merged.metadata) == [{'material': {'composition': 'NaCl'},
+                                      'files': [{'filename': 'a.csv'}]}] * 4
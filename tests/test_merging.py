@@ -0,0 +1,113 @@
+"""Tests for the linear-time metadata merging"""
+
+from mdf_matio import _merge_records
+from mdf_matio.merging import merge_metadata, broadcast_metadata
+from materials_io.utils.interface import ParseResult
+from mdf_toolbox import dict_merge
+from functools import reduce, partial
+from copy import deepcopy
+from random import Random
+import pytest
+
+_reference = partial(dict_merge, append_lists=True)
+
+
+def _random_value(rng: Random, depth: int):
+    """Make a random JSON-like value with few distinct keys and values, so they overlap"""
+    kind = rng.choice(['int', 'float', 'str', 'bool', 'none', 'list', 'dict'] if depth > 0
+                      else ['int', 'float', 'str', 'bool', 'none'])
+    if kind == 'int':
+        return rng.randint(0, 3)
+    elif kind == 'float':
+        return rng.choice([0.5, 1.0, 2.0])
+    elif kind == 'str':
+        return rng.choice('abc')
+    elif kind == 'bool':
+        return rng.random() > 0.5
+    elif kind == 'none':
+        return None
+    elif kind == 'list':
+        return [_random_value(rng, depth - 1) for _ in range(rng.randint(0, 3))]
+    return _random_dict(rng, depth - 1)
+
+
+def _random_dict(rng: Random, depth: int) -> dict:
+    return dict((rng.choice('pqrstu'), _random_value(rng, depth))
+                for _ in range(rng.randint(0, 4)))
+
+
+def _walk_containers(value):
+    """Get the IDs of every list and dictionary in a value"""
+    if isinstance(value, dict):
+        yield id(value)
+        for v in value.values():
+            yield from _walk_containers(v)
+    elif isinstance(value, list):
+        yield id(value)
+        for v in value:
+            yield from _walk_containers(v)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_equivalence(seed):
+    rng = Random(seed)
+    group = [_random_dict(rng, 3) for _ in range(rng.randint(1, 6))]
+    original = deepcopy(group)
+
+    result = merge_metadata(group)
+    assert result == reduce(_reference, original)
+
+    # The inputs should not be changed or share containers with the output
+    assert group == original
+    inputs = set(_walk_containers(group))
+    assert inputs.isdisjoint(_walk_containers(result))
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_broadcast(seed):
+    rng = Random(seed)
+    rows = [_random_dict(rng, 2) for _ in range(4)]
+    addition = _random_dict(rng, 2)
+    result = broadcast_metadata(rows, addition)
+    assert result == [_reference(x, addition) for x in rows]
+
+    # Each row should have its own copy of the added metadata
+    ids = [set(_walk_containers(x)) for x in result]
+    assert all(a.isdisjoint(b) for i, a in enumerate(ids) for b in ids[i + 1:])
+
+
+def test_lists():
+    # Only new values are added to top-level lists, comparing values of any type
+    result = merge_metadata([{'a': [1, {'x': [1]}, [2]]},
+                             {'a': [True, 1.0, {'x': [1]}, [2], {'x': [2]}, 3, 3]}])
+    assert result == {'a': [1, {'x': [1]}, [2], {'x': [2]}, 3]}
+
+    # Lists in nested dictionaries are not extended
+    assert merge_metadata([{'a': {'b': [1]}}, {'a': {'b': [2], 'c': [3]}}]) == \
+        {'a': {'b': [1], 'c': [3]}}
+
+    # Unhashable values are compared to every value
+    result = merge_metadata([{'a': [{1, 2}]}, {'a': [frozenset([1, 2]), {3}, {3}]}])
+    assert result == {'a': [{1, 2}, {3}]}
+
+
+def test_merge_records():
+    # A group of records that each share a file with the next
+    group = [ParseResult(['f{}'.format(i), 'f{}'.format(i + 1)], 'p{}'.format(i % 3),
+                         {'files': [{'filename': 'f{}'.format(i)}], 'index': i})
+             for i in range(5000)]
+    result = _merge_records(group)
+    assert result.group == ['f{}'.format(i) for i in range(5001)]
+    assert result.parser == 'p0-p1-p2'
+    assert result.metadata['index'] == 0
+    assert len(result.metadata['files']) == 5000
+
+    # List-type metadata is broadcast
+    group = [ParseResult(['a'], 'csv', [{'x': 1}, {'x': 2}]),
+             ParseResult(['a'], 'p', {'y': [1]}), ParseResult(['a'], 'q', {'y': [2], 'x': 0})]
+    result = _merge_records(group)
+    assert result.metadata == [{'x': 1, 'y': [1, 2]}, {'x': 2, 'y': [1, 2]}]
+    assert result.metadata[0]['y'] is not result.metadata[1]['y']
+
+    with pytest.raises(NotImplementedError):
+        _merge_records(group + [ParseResult(['a'], 'csv2', [{}])])
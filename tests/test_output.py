@@ -0,0 +1,86 @@
+"""Tests for the sharded output of records"""
+
+from mdf_matio.output import ShardedWriter, write_shards, read_shards, MANIFEST_NAME
+from pytest import raises, mark
+import json
+import gzip
+import os
+
+
+def _records(n: int):
+    for i in range(n):
+        yield {'mdf': {'source_id': 'test_v1'}, 'index': i, 'text': 'é' * (i % 7)}
+
+
+@mark.parametrize('compress', [True, False])
+def test_write(tmpdir, compress):
+    manifest = write_shards(_records(1000), str(tmpdir), max_bytes=4000, compress=compress,
+                            batch_size=16)
+    assert manifest['record_count'] == 1000
+    assert manifest['compression'] == ('gzip' if compress else None)
+    assert len(manifest['shards']) > 1
+
+    # Each shard should hold whole records and respect the size limit
+    opener = gzip.open if compress else open
+    for shard in manifest['shards']:
+        with opener(os.path.join(tmpdir, shard['path']), 'rb') as fp:
+            data = fp.read()
+        assert len(data) == shard['bytes'] <= 4000
+        assert data.count(b'\n') == shard['records']
+    assert manifest['total_bytes'] == sum(x['bytes'] for x in manifest['shards'])
+    assert not any(x.endswith('.part') for x in os.listdir(tmpdir))
+
+    # The records should be read back in order
+    assert list(read_shards(str(tmpdir))) == list(_records(1000))
+    with open(os.path.join(tmpdir, MANIFEST_NAME)) as fp:
+        assert json.load(fp) == manifest
+
+
+def test_limits(tmpdir):
+    # Limit on the number of records
+    manifest = write_shards(_records(10), str(tmpdir), max_records=3, compress=False)
+    assert [x['records'] for x in manifest['shards']] == [3, 3, 3, 1]
+
+    # Records larger than the limit get their own shard
+    big = [{'a': 1}, {'a': 'x' * 100}, {'a': 2}]
+    manifest = write_shards(big, str(tmpdir.join('big')), max_bytes=50)
+    assert [x['records'] for x in manifest['shards']] == [1, 1, 1]
+    assert list(read_shards(str(tmpdir.join('big')))) == big
+
+    # No records
+    manifest = write_shards([], str(tmpdir.join('empty')))
+    assert manifest['record_count'] == 0 and manifest['shards'] == []
+
+
+def test_modified(tmpdir):
+    # Records are written as they were when given to the writer, such as the dataset entry,
+    #  which is updated as the records that follow it are validated
+    dataset = {'data': {'total_size': 0}}
+    with ShardedWriter(str(tmpdir), batch_size=4) as writer:
+        writer.write(dataset)
+        for record in _records(3):
+            dataset['data']['total_size'] += 1
+            writer.write(record)
+    assert next(read_shards(str(tmpdir))) == {'data': {'total_size': 0}}
+
+
+def test_errors(tmpdir):
+    # Records that cannot be serialized stop the writer without saving a manifest
+    with raises(TypeError):
+        write_shards([{'a': 1}, {'a': object()}], str(tmpdir), batch_size=1, queue_size=1)
+    assert not os.path.exists(os.path.join(tmpdir, MANIFEST_NAME))
+    assert not any(x.endswith('.part') for x in os.listdir(tmpdir))
+
+    # Errors in the producer stop the writer without saving a manifest
+    def _failing():
+        yield {'a': 1}
+        raise ValueError()
+    with raises(ValueError):
+        write_shards(_failing(), str(tmpdir.join('failed')))
+    assert not os.path.exists(tmpdir.join('failed', MANIFEST_NAME))
+
+    with ShardedWriter(str(tmpdir.join('closed'))) as writer:
+        writer.write({'a': 1})
+    assert writer.manifest['record_count'] == 1
+    with raises(ValueError):
+        writer.write({'a': 2})
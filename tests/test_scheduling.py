@@ -0,0 +1,109 @@
+"""Tests for running parsers in separate pools of workers"""
+
+from mdf_matio import execution
+from mdf_matio.execution import ParseTask, run_tasks
+from mdf_matio.instrumentation import IndexingStats
+from mdf_matio.scheduling import ParserPolicy, PoolConfig, Schedule
+import pytest
+import time
+import os
+
+
+def timed_execute(name, group, context=None, adapter=None):
+    """Sleep for a time set by the context and record when the task ran"""
+    start = time.time()
+    time.sleep(context['delay'])
+    path = os.path.join(context['log'], f'{name}-{os.path.basename(group[0])}')
+    with open(path, 'w') as fp:
+        print(start, time.time(), file=fp)
+    if group[0].endswith('empty'):
+        return None
+    return {'parser': name, 'file': group[0]}
+
+
+def _read_log(log_dir):
+    """Get the name, start and end time of each task"""
+    output = []
+    for name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, name)) as fp:
+            start, end = map(float, fp.read().split())
+        output.append((name, start, end))
+    return sorted(output, key=lambda x: x[1])
+
+
+def _max_overlap(log, prefix):
+    events = []
+    for name, start, end in log:
+        if name.startswith(prefix):
+            events.extend([(start, 1), (end, -1)])
+    count = best = 0
+    for _, change in sorted(events):
+        count += change
+        best = max(best, count)
+    return best
+
+
+@pytest.fixture
+def log_tasks(tmpdir, monkeypatch):
+    monkeypatch.setattr(execution, 'execute_parser', timed_execute)
+    log_dir = str(tmpdir.join('log'))
+    os.makedirs(log_dir)
+    names = ['slow', 'fast', 'fast', 'fast', 'slow', 'fast', 'slow', 'slow', 'fast', 'slow']
+    tasks = [ParseTask(name, (f'/data/{i}' if i != 5 else '/data/empty',))
+             for i, name in enumerate(names)]
+    contexts = {'slow': {'delay': 0.2, 'log': log_dir}, 'fast': {'delay': 0.01, 'log': log_dir}}
+    return tasks, contexts, log_dir
+
+
+@pytest.mark.parametrize('lookahead', [1, 3, 100])
+def test_order(log_tasks, lookahead):
+    tasks, contexts, _ = log_tasks
+    expected = list(run_tasks(tasks, contexts))
+    assert len(expected) == len(tasks) - 1
+
+    schedule = Schedule(pools={'slow': PoolConfig(workers=3), 'fast': PoolConfig(chunksize=2)},
+                        parsers={'slow': ParserPolicy(pool='slow'),
+                                 'fast': ParserPolicy(pool='fast')},
+                        lookahead=lookahead)
+    assert list(run_tasks(tasks, contexts, schedule=schedule)) == expected
+
+
+def test_limits(log_tasks):
+    tasks, contexts, log_dir = log_tasks
+    stats = IndexingStats()
+    schedule = Schedule(pools={'default': PoolConfig(workers=3)},
+                        parsers={'slow': ParserPolicy(max_concurrency=1),
+                                 'fast': ParserPolicy(priority=1)})
+    results = list(run_tasks(tasks, contexts, stats=stats, schedule=schedule))
+    assert [x.group for x in results] == [x.group for x in tasks if 'empty' not in x.group[0]]
+
+    # Only one slow task runs at once, and the fast tasks run before the slow ones
+    log = _read_log(log_dir)
+    assert _max_overlap(log, 'slow') == 1
+    assert _max_overlap(log, 'fast') > 1
+    assert [x[0].split('-')[0] for x in log[:3]] == ['fast'] * 3
+    last_fast = max(x[2] for x in log if x[0].startswith('fast'))
+    assert last_fast < sorted(x[2] for x in log if x[0].startswith('slow'))[1]
+
+    # The use of the pool is recorded
+    output = stats.to_dict()
+    assert output['parsers']['slow']['calls'] == 5
+    pool = output['pools']['default']
+    assert pool['workers'] == 3
+    assert pool['tasks'] == len(tasks)
+    assert pool['max_queue_depth'] == len(tasks) - 3
+    assert pool['queue_depth'] == pool['running'] == 0
+    assert 0.2 < pool['utilization'] < 0.5  # One of three workers was busy for most of the time
+    assert pool['wall_time'] == pytest.approx(1., abs=0.5)
+    assert 0 < pool['mean_queue_depth'] < len(tasks)
+
+
+def test_bad_schedule():
+    with pytest.raises(ValueError):
+        Schedule(pools={'default': PoolConfig(workers=0)})
+    with pytest.raises(ValueError):
+        Schedule(parsers={'x': ParserPolicy(pool='missing')})
+    with pytest.raises(ValueError):
+        Schedule(parsers={'x': ParserPolicy(max_concurrency=0)})
+    with pytest.raises(ValueError):
+        Schedule(lookahead=0)
@@ -0,0 +1,84 @@
+"""Tests for the local schema store"""
+
+from mdf_matio import schemas
+from mdf_matio.schemas import SchemaStore, get_schema_uri
+from jsonschema import RefResolutionError
+from io import BytesIO
+import pytest
+import json
+import os
+
+
+def test_uri(schema_dir):
+    assert get_schema_uri('dev') == ('https://raw.githubusercontent.com/materials-data-facility/'
+                                     'data-schemas/dev/schemas/')
+    assert get_schema_uri('dev', schema_dir + '/') == 'file://' + os.path.abspath(schema_dir) + '/'
+    assert get_schema_uri(None, 'https://example.com/') == 'https://example.com/'
+
+
+def test_store(tmpdir, schema_dir):
+    base_uri = get_schema_uri('test')
+    store = SchemaStore(str(tmpdir), offline=True)
+    store.preload(schema_dir, base_uri)
+
+    # Resolve a schema and its references without the network
+    resolver = store.get_resolver(base_uri)
+    _, schema = resolver.resolve('record.json')
+    assert schema['properties']['files']['items']['$ref'] == 'file.json#'
+    with resolver.resolving('record.json'):
+        _, mdf = resolver.resolve(schema['properties']['mdf']['$ref'])
+    assert 'scroll_id' in mdf['properties']
+
+    # A new store should find the schemas on disk
+    new_store = SchemaStore(str(tmpdir), offline=True)
+    assert new_store.get(base_uri + 'record.json') == schema
+    assert new_store.get(base_uri + 'record.json#/properties') == schema
+    assert len(os.listdir(os.path.join(tmpdir, 'objects'))) == 4
+
+    # Schemas from other branches are not available offline
+    with pytest.raises(LookupError):
+        new_store.get(get_schema_uri('other') + 'record.json')
+    with pytest.raises(RefResolutionError):
+        new_store.get_resolver(get_schema_uri('other')).resolve('record.json')
+
+
+def test_schema_dir(tmpdir, monkeypatch, schema_dir):
+    monkeypatch.setenv('MDF_MATIO_SCHEMA_DIR', os.path.dirname(schema_dir))
+    store = SchemaStore(str(tmpdir), offline=True)
+    _, schema = store.get_resolver(get_schema_uri('schemas')).resolve('dataset.json')
+    assert 'data' in schema['properties']
+
+
+def test_refresh(tmpdir, monkeypatch):
+    responses = []
+
+    def fake_urlopen(uri, timeout=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return BytesIO(json.dumps(response).encode())
+    monkeypatch.setattr(schemas, 'urlopen', fake_urlopen)
+
+    # Schemas from a branch are fetched again once they are too old
+    uri = get_schema_uri('master') + 'record.json'
+    store = SchemaStore(str(tmpdir), offline=False, max_age=0)
+    store.add(uri, b'{"version": 1}')
+    responses.append({'version': 2})
+    assert store.get(uri) == {'version': 2}
+    assert responses == []
+
+    # Stored copies are used if they cannot be fetched
+    responses.append(OSError('No network'))
+    assert store.get(uri) == {'version': 2}
+    assert SchemaStore(str(tmpdir), offline=True, max_age=0).get(uri) == {'version': 2}
+
+    # Schemas from a commit, or in a store without a maximum age, are never fetched again
+    commit_uri = get_schema_uri('0123456789abcdef0123456789abcdef01234567') + 'record.json'
+    store.add(commit_uri, b'{"version": 1}')
+    assert store.get(commit_uri) == {'version': 1}
+    store = SchemaStore(str(tmpdir), offline=False, max_age=None)
+    assert store.get(uri) == {'version': 2}
+
+    # Schemas that are young enough are not fetched again
+    store = SchemaStore(str(tmpdir), offline=False)
+    assert store.get(uri) == {'version': 2}
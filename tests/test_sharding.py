@@ -0,0 +1,157 @@
+"""Tests for indexing a dataset in shards"""
+
+from mdf_matio import execution, _merge_directories, _merge_files, _validate_groups
+from mdf_matio.execution import ParseTask, run_tasks
+from mdf_matio.sharding import (ShardPlan, assign_shards, plan_shards, run_shard,
+                                iter_shard_results, reduce_shards)
+from mdf_matio.validator import MDFValidator
+from concurrent.futures import ProcessPoolExecutor
+from pytest import fixture, mark, raises
+import json
+import os
+
+paths = ['a/1.in', 'a/2.in', 'a/sub/3.in', 'b/1.in', 'b/grouped/1.in', 'b/grouped/x/2.in',
+         'c/1.in', 'c/2.in', 'c/3.in', 'd/1.in', 'top.in']
+
+
+class TwoFileParser:
+    """Parser that reads each file alone, each pair of files named "1.in" and "2.in",
+    and a pair of files from different top-level directories"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def identify_files(self, path, context=None):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                yield (os.path.join(root, f),)
+            if self.name == 'pair' and '1.in' in files and '2.in' in files:
+                yield (os.path.join(root, '1.in'), os.path.join(root, '2.in'))
+        if self.name == 'pair':
+            yield (os.path.join(path, 'top.in'), os.path.join(path, 'd', '1.in'))
+
+
+def schema_execute(name, group, context=None, adapter=None):
+    """Produce metadata matching the test schema"""
+    if os.path.basename(group[0]) == '3.in':
+        return None
+    return {'files': [{'filename': os.path.basename(f), 'path': f, 'length': len(f)}
+                      for f in group],
+            'custom': {name: len(group)}}
+
+
+@fixture
+def data(tmpdir, monkeypatch):
+    monkeypatch.setattr(execution, 'get_parser', TwoFileParser)
+    monkeypatch.setattr(execution, 'execute_parser', schema_execute)
+    data_dir = str(tmpdir.join('data'))
+    for path in paths:
+        path = os.path.join(data_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            print('data', file=fp)
+    return data_dir
+
+
+def _dataset():
+    return {'mdf': {'source_id': 'test_v1', 'source_name': 'test'}}
+
+
+def _collect(records, vald, path):
+    """Serialize the records, the dataset aggregates and the file list of a run"""
+    output = [json.dumps(x, sort_keys=True) for x in records]
+    output.append(json.dumps(vald.finalize(), sort_keys=True))
+
+    # Use the same ingest date and file list path for every run
+    date = json.loads(output[0])['mdf']['ingest_date']
+    output = [x.replace(date, 'DATE').replace(path, 'FILES') for x in output]
+    with open(path) as fp:
+        return output, fp.read()
+
+
+def test_assign(data):
+    tasks = execution.identify_tasks(data, ['pair', 'single'])
+
+    # Directories stay together, and the largest goes to the first shard
+    shards = assign_shards(tasks, 3, data)
+    by_dir = {}
+    for task, shard in zip(tasks, shards):
+        top = os.path.relpath(task.group[0], data).split(os.path.sep)[0]
+        by_dir.setdefault(top if top != 'top.in' else '', set()).add(shard)
+    assert all(len(x) == 1 for x in by_dir.values())
+    assert by_dir['a'] == {0}
+    assert set(shards) == {0, 1, 2}
+
+    # Hashing depends only on the directory, relative to the root of the dataset
+    shards = assign_shards(tasks, 4, data, strategy='hash')
+    moved = [ParseTask(t.parser, tuple(x.replace(data, '/mnt/data') for x in t.group))
+             for t in tasks]
+    assert shards == assign_shards(moved, 4, '/mnt/data', strategy='hash')
+    assert all(0 <= x < 4 for x in shards)
+
+    with raises(ValueError):
+        assign_shards(tasks, 0, data)
+    with raises(ValueError):
+        assign_shards(tasks, 2, data, strategy='random')
+
+
+@mark.parametrize('strategy', ['directory', 'hash'])
+@mark.parametrize('n_shards', [1, 3, 5])
+def test_reduce(data, tmpdir, schema_store, strategy, n_shards):
+    grouped = [os.path.join(data, 'b', 'grouped')]
+
+    # Run every task in one process
+    tasks = execution.identify_tasks(data, ['pair', 'single'])
+    results = _merge_directories(run_tasks(tasks), grouped, ordered=True)
+    path = str(tmpdir.join('expected.ndjson'))
+    vald = MDFValidator(schema_branch='test', schema_store=schema_store, file_list_path=path)
+    expected = _collect(_validate_groups(_merge_files(results), vald, _dataset()), vald, path)
+
+    # Run each shard in its own process, as if on a separate node
+    plan_path = str(tmpdir.join('plan.json'))
+    plan_shards(data, ['pair', 'single'], n_shards, strategy=strategy).save(plan_path)
+    plan = ShardPlan.load(plan_path)
+    assert plan.tasks == tasks
+    if strategy == 'directory' and n_shards > 1:
+        # Some files are parsed on more than one shard
+        owners = {}
+        for task, shard in zip(plan.tasks, plan.shards):
+            for f in task.group:
+                owners.setdefault(f, set()).add(shard)
+        assert any(len(x) > 1 for x in owners.values())
+    output_dir = str(tmpdir.join('shards'))
+    with ProcessPoolExecutor(n_shards) as pool:
+        counts = list(pool.map(run_shard, [plan] * n_shards, range(n_shards),
+                               [output_dir] * n_shards))
+    assert sum(counts) == len([x for x in run_tasks(tasks)])
+
+    # The reduce step must produce the same records
+    assert [x.group for x in iter_shard_results(plan, output_dir)] == \
+        [x.group for x in run_tasks(tasks)]
+    path = str(tmpdir.join('reduced.ndjson'))
+    vald = MDFValidator(schema_branch='test', schema_store=schema_store, file_list_path=path)
+    records = reduce_shards(plan, output_dir, _dataset(), vald=vald,
+                            parse_config={grouped[0]: {'group_by_directory': True}})
+    assert _collect(records, vald, path) == expected
+
+
+def test_missing_shard(data, tmpdir):
+    plan = plan_shards(data, ['single'], 2)
+    output_dir = str(tmpdir.join('shards'))
+    run_shard(plan, 1, output_dir)
+    with raises(ValueError, match=r'\[0\]'):
+        list(iter_shard_results(plan, output_dir))
+
+
+def test_resume_shard(data, tmpdir):
+    plan = plan_shards(data, ['single'], 2)
+    output_dir = str(tmpdir.join('shards'))
+    manifest = str(tmpdir.join('manifest.db'))
+    first = run_shard(plan, 0, output_dir, manifest_path=manifest)
+    with open(os.path.join(output_dir, 'shard-00000.pkl'), 'rb') as fp:
+        content = fp.read()
+
+    # A repeated run of the shard loads its results from the manifest
+    assert run_shard(plan, 0, output_dir, manifest_path=manifest) == first
+    with open(os.path.join(output_dir, 'shard-00000.pkl'), 'rb') as fp:
+        assert fp.read() == content
@@ -0,0 +1,37 @@
+"""Tests for the on-disk storage of parse results"""
+
+from mdf_matio.spill import RecordBuffer, SQLiteStore
+import os
+
+
+def test_store():
+    with SQLiteStore() as store:
+        assert os.path.isfile(store.path)
+        assert store.add((('a.in',), 'fake', {}), 'b') == 0
+        assert store.add((('b.in',), 'fake', {}), 'a') == 1
+        assert len(store) == 2
+
+        # Check ordering by key and insertion
+        assert [x[0] for x in store.iterate()] == ['b', 'a']
+        assert [x[0] for x in store.iterate(ordered=True)] == ['a', 'b']
+        store.set_keys([(0, 'a')])
+        assert [x[1][0] for x in store.iterate(ordered=True)] == [('a.in',), ('b.in',)]
+
+        # Check file ownership
+        assert store.claim_file('a.in', 0) == 0
+        assert store.claim_file('a.in', 1) == 0
+        assert store.claim_file('b.in', 1) == 1
+        path = store.path
+    assert not os.path.exists(path)
+
+
+def test_buffer():
+    records = [((f'{i}.in',), 'fake', {}) for i in range(5)]
+    with RecordBuffer(spill_threshold=2) as buffer:
+        for i, record in enumerate(records):
+            buffer.append(record, i % 2)
+            assert buffer.spilled == (i >= 2)
+        assert len(buffer) == 5
+        assert list(buffer) == records
+        assert list(buffer.groups()) == [records[::2], records[1::2]]
+    assert not buffer.spilled
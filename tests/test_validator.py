@@ -0,0 +1,155 @@
+"""Tests for the MDF validator, using a local copy of simplified MDF schemas"""
+
+from mdf_matio.validator import MDFValidator, ValidationError, _get_elements
+import pytest
+import json
+
+
+@pytest.fixture(params=['jsonschema', 'fastjsonschema'])
+def backend(request):
+    if request.param == 'fastjsonschema':
+        pytest.importorskip('fastjsonschema')
+    return request.param
+
+
+def test_validate(backend, schema_store):
+    vald = MDFValidator(schema_branch='test', backend=backend, schema_store=schema_store)
+    vald_gen = vald.validate_mdf_dataset({'mdf': {'source_id': 'test_v1', 'source_name': 'test'}})
+    dataset = next(vald_gen)
+    assert dataset['mdf']['scroll_id'] == 0
+
+    # Validate a few records
+    record = vald_gen.send({'files': [{'length': 3}], 'material': {'composition': 'NaCl'}})
+    assert record['mdf']['scroll_id'] == 1
+    assert record['material']['elements'] == ['Cl', 'Na']
+    record = vald_gen.send({'custom': {'a': 1}, 'dft': {'converged': None}})
+    assert record['mdf']['scroll_id'] == 2
+    assert record['custom'] == {'a': '1'}
+    assert record['dft'] == {}
+    assert dataset['data']['total_size'] == 3
+
+    # The validators should be built only once
+    assert vald._get_validators('record.json') is vald._get_validators('record.json')
+
+    # Check the error messages
+    with pytest.raises(ValidationError, match='999 is greater than the maximum of 230'):
+        vald_gen.send({'crystal_structure': {'space_group_number': 999}})
+
+
+def test_backend():
+    with pytest.raises(ValueError):
+        MDFValidator(backend='unknown')
+
+
+def _make_records():
+    return [{'files': [{'length': i}], 'material': {'composition': 'NaCl'}, 'custom': {'i': i}}
+            for i in range(8)]
+
+
+def test_batch(backend, schema_store, monkeypatch):
+    # Validate records one at a time
+    vald = MDFValidator(schema_branch='test', backend=backend, schema_store=schema_store)
+    vald_gen = vald.validate_mdf_dataset({'mdf': {'source_id': 'test_v1', 'source_name': 'test'}})
+    dataset = next(vald_gen)
+    expected = [vald_gen.send(r) for r in _make_records()]
+
+    # Validate them in batches
+    vald = MDFValidator(schema_branch='test', backend=backend, schema_store=schema_store)
+    with pytest.raises(ValidationError, match='Dataset not started'):
+        vald.validate_records(_make_records())
+    batch_gen = vald.validate_mdf_dataset({'mdf': {'source_id': 'test_v1', 'source_name': 'test'}})
+    batch_dataset = next(batch_gen)
+    records = _make_records()
+    results = vald.validate_records(records[:5]) + vald.validate_records(records[5:])
+    for record in results + expected:
+        del record['mdf']['ingest_date']
+    assert results == expected
+    assert batch_dataset['data']['total_size'] == dataset['data']['total_size'] == 28
+
+    # Failures should leave the counters as if records were sent one at a time
+    records = _make_records()
+    records[2]['dft'] = {'cutoff_energy': float('nan')}
+    with pytest.raises(ValidationError, match='not valid JSON'):
+        vald.validate_records(records)
+    assert batch_dataset['data']['total_size'] == 28 + 3
+    records = _make_records()
+    records[1]['crystal_structure'] = {'space_group_number': 999}
+    with pytest.raises(ValidationError, match='Invalid record metadata'):
+        vald.validate_records(records)
+    assert batch_dataset['data']['total_size'] == 28 + 3 + 1
+    assert vald.validate_records([{}])[0]['mdf']['scroll_id'] == 8 + 3 + 2 + 1
+
+    # Valid batches are checked against the schema in one call
+    def fail(*args):
+        raise RuntimeError()
+    monkeypatch.setattr(vald, '_check_record', fail)
+    assert len(vald.validate_records(_make_records())) == 8
+
+    # Other errors leave the dataset as it was before the batch
+    state = vald.get_state()
+    monkeypatch.setattr(vald, '_is_valid_batch', fail)
+    with pytest.raises(RuntimeError):
+        vald.validate_records(_make_records())
+    assert vald.get_state() == state
+
+
+def test_sanitize(schema_store):
+    vald = MDFValidator(schema_branch='test', schema_store=schema_store)
+    vald_gen = vald.validate_mdf_dataset({'mdf': {'source_id': 'test_v1', 'source_name': 'test'},
+                                          'dc': {'subjects': None}},
+                                         validation_info={'allowed_nulls': ['subjects']})
+    dataset = next(vald_gen)
+    assert dataset['dc'] == {'subjects': None}
+
+    # Nulls are removed in place, except the allowed ones, and tuples become lists
+    record = {'files': [{'length': 1, 'filename': None}],
+              'material': {'composition': 'NaCl', 'elements': None},
+              'origin': {'subjects': None, 'name': None, 'tags': ('a', None)}}
+    result = vald_gen.send(record)
+    assert result is record
+    assert record['files'] == [{'length': 1}]
+    assert record['material'] == {'composition': 'NaCl', 'elements': ['Cl', 'Na']}
+    assert record['origin'] == {'subjects': None, 'tags': ['a']}
+
+    # Non-finite floats are rejected
+    with pytest.raises(ValidationError, match='not valid JSON'):
+        vald_gen.send({'dft': {'cutoff_energy': float('inf')}})
+
+
+def test_elements():
+    assert _get_elements('NaCl') == ('Cl', 'Na')
+    assert _get_elements('Ca(OH)2') == ('Ca', 'H', 'O')
+    assert _get_elements('Ca3(PO4)2') == ('Ca', 'O', 'P')
+    assert _get_elements('CuSO4\u00b75H2O') == ('Cu', 'H', 'O', 'S')
+    assert _get_elements('CuSO4*5H2O') == ('Cu', 'H', 'O', 'S')
+    assert _get_elements('NdFeB and SmCo5') == ('B', 'Co', 'Fe', 'Nd', 'Sm')
+    assert _get_elements('') == ()
+
+    # Results are cached
+    before = _get_elements.cache_info().hits
+    _get_elements('NaCl')
+    assert _get_elements.cache_info().hits == before + 1
+
+
+def test_aggregates(schema_store, tmpdir):
+    file_list = str(tmpdir.join('files.ndjson'))
+    vald = MDFValidator(schema_branch='test', schema_store=schema_store,
+                        file_list_path=file_list)
+    vald_gen = vald.validate_mdf_dataset({'mdf': {'source_id': 'test_v1', 'source_name': 'test'}})
+    next(vald_gen)
+    vald_gen.send({'files': [{'length': 3, 'data_type': 'text'},
+                             {'length': 4, 'data_type': 'image'}]})
+    vald.validate_records([{'files': [{'length': 5, 'data_type': 'text'}]}, {}])
+    with pytest.raises(ValidationError):
+        vald.validate_records([{'files': [{'length': 6}]},
+                               {'files': [{'length': 1, 'data_type': 'text', 'unknown': 1}]},
+                               {'files': [{'length': 7}]}])
+    assert vald_gen.send(None) is None
+
+    # Invalid records count toward the totals, as for the dataset size, but are not listed.
+    #  Records after an invalid record in a batch are not counted
+    assert vald.finalize() == {'file_count': 5, 'total_size': 19,
+                               'data_types': {'text': 3, 'image': 1},
+                               'file_list_path': file_list}
+    with open(file_list) as fp:
+        assert [json.loads(line)['length'] for line in fp] == [3, 4, 5, 6]